@@ -1,16 +1,22 @@
 import streamlit as st
 from streamlit_gsheets import GSheetsConnection
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
 import pytz, random, os, base64, io, qrcode, glob, math, mimetypes, json, requests, re, textwrap, time, ast
-import html
-from PIL import Image
+import sqlite3, threading, hashlib, tempfile, zipfile, shutil, abc
+from collections import OrderedDict, deque, Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import html, unicodedata, difflib, weakref, http.server
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import folium
-from streamlit_folium import st_folium
+import streamlit.components.v1 as components
 from folium.plugins import HeatMap, MarkerCluster
 from PIL import Image, ImageOps  # ✅ เพิ่ม ImageOps เข้ามา
+import image_pipeline, pdf_documents
 
 # ==========================================
 # 0. GLOBAL CONFIG & DATA (ต้องอยู่บนสุด)
@@ -48,31 +54,41 @@ def get_target_sheet_name():
     ac_year = current_buddhist_year if now_th.month >= 5 else current_buddhist_year - 1
     return f"Investigation_{ac_year}"
 # ✅ 1. คง Cache ข้อมูลไว้ (3 ชม.) เพื่อไม่ให้ยิง Google Sheets ถี่เกินไป
-@st.cache_data(ttl=10800)
-def get_safe_map_data(sheet_name):
+# แคชใน namespace "hazard_map" ผูกกับเวอร์ชันไฟล์รายปี: ไฟล์ปีปัจจุบันถูกโหลดใหม่เมื่อไหร่ แผนที่ได้ข้อมูลใหม่ (ผู้ใช้ไม่ต้องรอ)
+HAZARD_MAP_TTL = 10800
+
+def get_safe_map_data(sheet_names, force=False):
+    # หลายปีการศึกษารวมกัน (อ่านจากไฟล์แคชรายปีในเครื่อง ดึงจากชีตเฉพาะปีที่ยังไม่มี/ปีปัจจุบัน)
+    # คืน (DataFrame, เวอร์ชันของ DataFrame นั้น) -> ค่าเก่าที่ส่งระหว่างโหลดใหม่ก็ได้เวอร์ชันเก่าของมันเอง ไม่ใช่เวอร์ชันไฟล์ล่าสุด
+    store, key = get_case_year_store(), tuple(sheet_names)
+    def load():
+        df = store.load(list(key), force=force)
+        return df, store.version(key)
     try:
-        conn = st.connection("gsheets", type=GSheetsConnection)
-        df = conn.read(worksheet=sheet_name, ttl=10800)
-        return pd.DataFrame(df)
+        if force: return get_scoped_cache().refresh("hazard_map", key, load, store.version(key))
+        return get_scoped_cache().get("hazard_map", key, load, ttl=HAZARD_MAP_TTL, version=store.version(key))
     except Exception as e:
         st.error(f"Error reading data: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(), None
 
 # ✅ 2. ฟังก์ชันสร้างแผนที่ (ถอด @st.cache_resource ออก เพื่อให้แผนที่แสดงผลทุกครั้ง)
 # การวาดแผนที่ใหม่จากข้อมูลใน Memory (Cache Data) ทำได้เร็วมากและไม่ทำให้ระบบล่ม
 from folium.features import DivIcon # เพิ่มบรรทัดนี้ไว้ด้านบนสุดของไฟล์ด้วยนะครับ
 
-def create_hazard_map_obj(_df):
+def create_hazard_map_obj(_df, risk_counts=None, points=None, layers=(), hotspots=None, tiles=None):
     if _df.empty: return None
     
-    # 1. นับความถี่รายอาคาร
-    risk_counts = _df['Location'].value_counts().to_dict()
+    # 1. นับความถี่รายอาคาร (ส่งตัวนับสะสมมาได้ ไม่ต้องนับใหม่)
+    if risk_counts is None: risk_counts = _df['Location'].value_counts().to_dict()
     
     # 2. ตั้งค่าแผนที่
     m = folium.Map(location=[16.29359, 103.97250], zoom_start=18)
+    # tiles = URL ของพร็อกซีในเครื่อง (satellite_tiles_url()) หรือ None = ดึงจาก Google โดยตรง
+    # พร็อกซีมีเฉพาะพื้นที่/ช่วงซูมรอบโรงเรียน -> บอก Leaflet ไม่ให้ขอ tile นอกนั้น
+    limits = dict(min_zoom=TILE_PROXY_ZOOMS[0], max_zoom=TILE_PROXY_ZOOMS[-1], bounds=campus_bounds()) if tiles and tiles != SATELLITE_TILE_URL else {}
     folium.TileLayer(
-        tiles='https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}',
-        attr='Google Satellite', name='Google Satellite', overlay=False, control=True
+        tiles=tiles or SATELLITE_TILE_URL,
+        attr='Google Satellite', name='Google Satellite', overlay=False, control=True, **limits
     ).add_to(m)
 
     # 3. วนลูปปักหมุดตามพิกัดอาคาร
@@ -125,8 +141,53 @@ def create_hazard_map_obj(_df):
                 """
             )
         ).add_to(m)
+
+    # 4. จุดเสี่ยงนอกอาคาร (พิกัดที่ไม่ใกล้อาคารใด รวมเป็นช่องตาราง)
+    if hotspots is not None and len(hotspots):
+        for lat, lon, count in hotspots[['lat', 'lon', 'count']].itertuples(index=False):
+            folium.CircleMarker(location=[lat, lon], radius=min(5 + int(count), 14), color='#475569', weight=1,
+                                fill=True, fill_color='#94a3b8', fill_opacity=0.8, tooltip=f"จุดนอกอาคาร: {count} ครั้ง").add_to(m)
+
+    # 5. ชั้นข้อมูลจากพิกัดที่แจ้งเหตุ (lat/lon) เปิด/ปิดได้จากมุมขวาบนของแผนที่
+    if points is not None and len(points) and layers:
+        if "heat" in layers:
+            HeatMap(points[['lat', 'lon']].to_numpy().tolist(), name="🔥 ความหนาแน่น", radius=18, blur=14, min_opacity=0.3).add_to(m)
+        if "cluster" in layers:
+            cluster = MarkerCluster(name="📍 จุดแจ้งเหตุ").add_to(m)
+            for lat, lon, kind in points[['lat', 'lon', 'Incident_Type']].itertuples(index=False):
+                folium.Marker([lat, lon], tooltip=str(kind)).add_to(cluster)
+        folium.LayerControl(collapsed=False).add_to(m)
         
     return m
+
+def hazard_view(sheet_key, df, version, date_range=None, types=(), hours=(0, 23)):
+    # มุมมองที่กรองแล้ว (ช่วงวันที่ / ประเภท / ชั่วโมง) คำนวณครั้งเดียวต่อเงื่อนไข+เวอร์ชันข้อมูล ใช้ซ้ำทุกผู้ใช้
+    # version = เวอร์ชันของ df ที่ส่งมาจริง (จาก get_safe_map_data) ไม่อ่านจากไฟล์ใหม่ ไม่งั้นค่าเก่าจะถูกแคชด้วยเวอร์ชันใหม่
+    def build():
+        mask = pd.Series(True, index=df.index)
+        ts = df['Event_Time'] if 'Event_Time' in df.columns else pd.Series(pd.NaT, index=df.index)
+        if date_range: mask &= ts.dt.date.between(date_range[0], date_range[1])
+        if types: mask &= df['Incident_Type'].isin(types)
+        if tuple(hours) != (0, 23): mask &= ts.dt.hour.between(hours[0], hours[1])
+        sub = df[mask]
+        has_xy = {'lat', 'lon'} <= set(sub.columns)
+        pts = sub[sub['lat'].notna() & sub['lon'].notna()][['lat', 'lon', 'Incident_Type']].reset_index(drop=True) if has_xy else pd.DataFrame(columns=['lat', 'lon', 'Incident_Type'])
+        counts, hotspots = location_counts(sub)
+        return {"n": len(sub), "counts": counts, "points": pts, "hotspots": hotspots}
+    key = (sheet_key, tuple(date_range) if date_range else None, tuple(sorted(types)), tuple(hours))
+    return get_scoped_cache().get("hazard_view", key, build, ttl=HAZARD_MAP_TTL, version=version)
+
+def hazard_map_html(df, risk_counts, points=None, layers=(), hotspots=None):
+    # HTML ของแผนที่แคชตาม hash ของจำนวนรายอาคาร + จุด + ชั้นข้อมูล (ไม่ต้องสร้าง folium / serialize ใหม่ทุก rerun)
+    layers = tuple(sorted(layers)) if points is not None and len(points) else ()
+    pts_hash = int(pd.util.hash_pandas_object(points, index=False).sum()) if layers else 0
+    hot = hotspots[['lat', 'lon', 'count']].round(7).values.tolist() if hotspots is not None else []
+    tiles = satellite_tiles_url()
+    key = hashlib.sha1(json.dumps([sorted((str(k), int(v)) for k, v in risk_counts.items()), layers, pts_hash, hot, tiles], ensure_ascii=False).encode()).hexdigest()
+    def build():
+        m = create_hazard_map_obj(df, risk_counts, points, layers, hotspots, tiles=tiles)
+        return m.get_root().render() if m else None
+    return get_scoped_cache().get("hazard_map_html", key, build, ttl=HAZARD_MAP_TTL)
 # ✅ 3. ในส่วนของ module ให้เรียกใช้แบบนี้
 def hazard_analytics_module():
     # --- 1. ส่วนหัวเว็บ (Header) ให้เหมือนส่วนอื่นๆ ของระบบ ---
@@ -140,7 +201,9 @@ def hazard_analytics_module():
     col_btn1, col_btn2, col_btn3 = st.columns([6, 2, 2])
     with col_btn2:
         if st.button("🔄 รีเฟรชข้อมูล", use_container_width=True):
-            st.cache_data.clear()
+            # ล้างเฉพาะแคชของแผนที่: ผู้กดโหลดปีที่เลือกใหม่ทันที ชุดอื่นจะโหลดใหม่เบื้องหลังเมื่อมีคนเปิด
+            get_scoped_cache().invalidate("hazard_map")
+            get_safe_map_data(tuple(sorted(st.session_state.get("hazard_years") or [get_target_sheet_name()], key=case_sheet_year)), force=True)
             st.rerun()
     with col_btn3:
         if st.button("🏠 กลับเมนูหลัก", use_container_width=True):
@@ -168,24 +231,44 @@ def hazard_analytics_module():
     # --- 4. การแสดงผลแผนที่ ---
     try:
         target_sheet = get_target_sheet_name()
-        df_inv = get_safe_map_data(target_sheet)
+        year_sheets = get_case_year_store().sheets() or [target_sheet]
+        sel_sheets = st.multiselect("📅 ปีการศึกษา", year_sheets, default=[target_sheet] if target_sheet in year_sheets else year_sheets[-1:],
+                                    format_func=lambda s: s.split('_')[1], key="hazard_years")
+        df_inv, inv_version = get_safe_map_data(tuple(sorted(sel_sheets, key=case_sheet_year)))
 
         if not df_inv.empty:
-            map_obj = create_hazard_map_obj(df_inv)
-            if map_obj:
+            sheet_key = tuple(sorted(sel_sheets, key=case_sheet_year))
+            inc_stats = get_incident_aggregates("year_cache", "+".join(sorted(sel_sheets)), df_inv)
+
+            # --- ตัวกรองช่วงเวลา / ประเภท / ชั่วโมง + ชั้นข้อมูลจากพิกัด ---
+            with st.expander("🔎 กรองช่วงเวลา / ประเภทเหตุ / ชั้นข้อมูลแผนที่"):
+                f1, f2 = st.columns(2)
+                days = df_inv['Event_Time'].dropna() if 'Event_Time' in df_inv.columns else pd.Series(dtype="datetime64[ns]")
+                date_range = None
+                if not days.empty:
+                    lo, hi = days.min().date(), days.max().date()
+                    picked = f1.date_input("ช่วงวันที่", (lo, hi), min_value=lo, max_value=hi, key="hazard_dates")
+                    if isinstance(picked, (list, tuple)) and len(picked) == 2 and tuple(picked) != (lo, hi): date_range = tuple(picked)
+                types = f2.multiselect("ประเภทเหตุ", sorted(inc_stats["type"]), key="hazard_types")
+                hours = st.slider("ช่วงเวลา (ชั่วโมง)", 0, 23, (0, 23), key="hazard_hours")
+                layers = [k for k, label in (("heat", "🔥 Heatmap ความหนาแน่น"), ("cluster", "📍 จุดแจ้งเหตุ (Cluster)")) if st.checkbox(label, key=f"hazard_layer_{k}")]
+
+            # นับรายอาคารจากพิกัด (ผูกเข้าอาคารที่ใกล้สุด) + ชื่อสถานที่กรณีไม่มีพิกัด คำนวณครั้งเดียวต่อเงื่อนไข
+            filtered = bool(date_range or types or tuple(hours) != (0, 23))
+            view = hazard_view(sheet_key, df_inv, inv_version, date_range, types, hours)
+            risk_counts = view["counts"]
+            if layers and view["points"].empty: st.caption("ℹ️ ไม่มีพิกัด (lat/lon) ในเหตุที่เลือก จึงแสดงเฉพาะจำนวนรายอาคาร")
+            if filtered: st.caption(f"แสดง {view['n']:,} จาก {len(df_inv):,} เหตุการณ์ตามตัวกรอง")
+            if len(view["hotspots"]): st.caption(f"⚪ จุดสีเทา = เหตุนอกอาคาร {int(view['hotspots']['count'].sum()):,} ครั้ง (รวมเป็นช่อง {HOTSPOT_CELL_M} ม.)")
+
+            map_html = hazard_map_html(df_inv, risk_counts, view["points"], layers, view["hotspots"])
+            if map_html:
                 # ปรับขนาดแผนที่ให้พอดี (เล็กลงเล็กน้อย 450px)
-                st_folium(
-                    map_obj,
-                    width="100%",
-                    height=600,
-                    key=f"hazard_map_v3_{target_sheet}",
-                    returned_objects=[],
-                    use_container_width=True
-                )
+                components.html(map_html, height=600)
             
             # แสดงกราฟสถิติประกอบ
             st.write("### 📊 สถิติจุดเสี่ยงรายอาคาร")
-            st.bar_chart(df_inv['Location'].value_counts())
+            st.bar_chart(count_series(Counter(risk_counts)))
             
         else:
             st.warning("⚠️ ไม่พบข้อมูลการแจ้งเหตุในฐานข้อมูล")
@@ -193,11 +276,11 @@ def hazard_analytics_module():
         st.error(f"❌ เกิดข้อผิดพลาดในการโหลดแผนที่: {e}")
         # แม้ระบบขัดข้อง ปุ่ม "กลับเมนูหลัก" ด้านบนก็จะยังคงอยู่ให้กดได้ครับ
 #--------------------
-# PDF & Chart Libraries
+# PDF & Chart Libraries (WeasyPrint ใช้ใน pdf_documents.py)
 try:
-    from weasyprint import HTML, CSS
-    from weasyprint.text.fonts import FontConfiguration
-except: pass
+    from pypdf import PdfWriter  # ใช้ตอนรวม PDF หลายไฟล์เป็นไฟล์เดียว (ไม่มีก็ยังส่งออกแบบ ZIP ได้)
+except ImportError:
+    PdfWriter = None
 from reportlab.pdfgen import canvas
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
@@ -327,6 +410,169 @@ LOGO_BASE64 = ""
 if LOGO_PATH and os.path.exists(LOGO_PATH):
     with open(LOGO_PATH, "rb") as f: LOGO_BASE64 = base64.b64encode(f.read()).decode()
 
+# Map helpers
+# --- ดัชนีพิกัดอาคาร: ผูกพิกัดที่แจ้งเหตุ (lat/lon) เข้ากับอาคารที่ใกล้ที่สุดใน COORD_MAP แบบ vectorized ---
+# แปลงเป็นเมตรแบบระนาบ (พื้นที่โรงเรียนเล็กพอ) อาคารมีไม่กี่สิบจุด -> เทียบทุกอาคารพร้อมกันด้วย numpy ครั้งเดียว
+# จุดที่ไกลเกิน SNAP_RADIUS_M จากทุกอาคาร -> รวมเป็นช่องตาราง HOTSPOT_CELL_M เมตร แสดงเป็นจุดเสี่ยงนอกอาคาร
+SNAP_RADIUS_M = 35
+HOTSPOT_CELL_M = 15
+
+class BuildingIndex:
+    def __init__(self, coord_map, skip=("อื่นๆ",)):
+        items = [(k, v) for k, v in coord_map.items() if k not in skip]
+        self.names = np.array([k for k, _ in items], dtype=object)
+        self.lat0 = np.mean([v['lat'] for _, v in items])
+        self.lon0 = np.mean([v['lon'] for _, v in items])
+        self.xy = self.project(np.array([v['lat'] for _, v in items]), np.array([v['lon'] for _, v in items]))
+
+    def project(self, lat, lon):
+        # องศา -> เมตรรอบจุดกึ่งกลาง (equirectangular)
+        return np.column_stack(((np.asarray(lon, float) - self.lon0) * 111320 * math.cos(math.radians(self.lat0)),
+                                (np.asarray(lat, float) - self.lat0) * 110540))
+
+    def unproject(self, xy):
+        return xy[:, 1] / 110540 + self.lat0, xy[:, 0] / (111320 * math.cos(math.radians(self.lat0))) + self.lon0
+
+    def snap(self, lat, lon, radius=SNAP_RADIUS_M):
+        # คืน (ชื่ออาคาร หรือ None, ระยะเมตร) ของทุกจุด
+        pts = self.project(lat, lon)
+        d2 = ((pts[:, None, :] - self.xy[None, :, :]) ** 2).sum(axis=2)
+        near = d2.argmin(axis=1) if len(self.xy) else np.zeros(len(pts), int)
+        dist = np.sqrt(d2[np.arange(len(pts)), near]) if len(pts) and len(self.xy) else np.full(len(pts), np.inf)
+        names = np.where(dist <= radius, self.names[near] if len(self.xy) else None, None)
+        return names, dist
+
+    def hotspots(self, lat, lon, cell=HOTSPOT_CELL_M):
+        # รวมจุดเป็นช่องตาราง -> DataFrame (lat, lon, count) จุดกึ่งกลางช่อง
+        if len(lat) == 0: return pd.DataFrame(columns=['lat', 'lon', 'count'])
+        ij = np.floor(self.project(lat, lon) / cell).astype(np.int64)
+        cells, counts = np.unique(ij, axis=0, return_counts=True)
+        c_lat, c_lon = self.unproject((cells + 0.5) * cell)
+        return pd.DataFrame({'lat': c_lat, 'lon': c_lon, 'count': counts}).sort_values('count', ascending=False, ignore_index=True)
+
+BUILDING_INDEX = BuildingIndex(COORD_MAP)
+
+def location_counts(df):
+    # จำนวนเหตุรายอาคาร: มีพิกัด -> อาคารที่ใกล้ที่สุด, ไม่มีพิกัด -> ชื่อสถานที่ที่กรอก; คืน (counts, hotspots นอกอาคาร)
+    loc = df['Location'].astype(str) if 'Location' in df.columns else pd.Series("", index=df.index)
+    if {'lat', 'lon'} <= set(df.columns):
+        lat, lon = pd.to_numeric(df['lat'], errors='coerce').to_numpy(), pd.to_numeric(df['lon'], errors='coerce').to_numpy()
+    else:
+        lat = lon = np.full(len(df), np.nan)
+    has_xy = ~(np.isnan(lat) | np.isnan(lon))
+    snapped, _ = BUILDING_INDEX.snap(lat[has_xy], lon[has_xy])
+    names = loc.to_numpy(dtype=object).copy()
+    names[has_xy] = snapped
+    counts = pd.Series(names[pd.notna(names)]).value_counts().to_dict() if len(names) else {}
+    counts = {k: int(v) for k, v in counts.items() if k}
+    lost = has_xy.copy(); lost[has_xy] = pd.isna(snapped)
+    return counts, BUILDING_INDEX.hotspots(lat[lost], lon[lost])
+
+# --- ภาพดาวเทียม: พร็อกซี tile ในเครื่อง + แคชบนดิสก์ (ทางเลือก) ---
+# เปิดด้วย secrets: TILE_PROXY_PORT = 8765 และ TILE_PROXY_URL = "http://<ip เครื่องนี้>:8765" (URL ที่เบราว์เซอร์ใน LAN เข้าถึงได้)
+# ค่าเริ่มต้นรับเฉพาะเครื่องนี้ (127.0.0.1) ให้ใน LAN ใช้ได้ตั้ง TILE_PROXY_HOST = "<ip เครื่องนี้>" (หรือ "0.0.0.0")
+# ให้บริการเฉพาะ tile รอบโรงเรียนในช่วงซูม TILE_PROXY_ZOOMS เท่านั้น นอกนั้นตอบ 404 (ไม่เป็นพร็อกซีเปิดไป Google / ดิสก์ไม่โตไม่จำกัด)
+# เปิดครั้งแรกจะโหลด tile รอบพื้นที่โรงเรียน (จากพิกัดใน COORD_MAP) เก็บไว้ก่อน ครั้งต่อไปเบราว์เซอร์/จอ War Room โหลดจากเครื่องนี้
+# หมายเหตุ: ถ้าเว็บเปิดผ่าน https ตัวพร็อกซีก็ต้องอยู่หลัง https ด้วย (เบราว์เซอร์บล็อก mixed content)
+SATELLITE_TILE_URL = 'https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}'
+TILE_PROXY_PORT = int(st.secrets.get("TILE_PROXY_PORT", 0))  # 0 = ปิด ใช้ Google โดยตรง
+TILE_PROXY_HOST = str(st.secrets.get("TILE_PROXY_HOST", "127.0.0.1"))
+TILE_PROXY_URL = str(st.secrets.get("TILE_PROXY_URL", f"http://localhost:{TILE_PROXY_PORT}")).rstrip("/")
+TILE_CACHE_DIR = st.secrets.get("TILE_CACHE_DIR", os.path.join(BASE_DIR, "portal_tile_cache"))
+TILE_PROXY_ZOOMS = (15, 16, 17, 18)  # แผนที่ซูมได้สุด 18
+TILE_PROXY_PAD = 0.0015  # ขอบรอบอาคาร (องศา)
+TILE_TIMEOUT = (5, 20)
+
+def tile_xy(lat, lon, z):
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return x, y
+
+def campus_bounds(pad=TILE_PROXY_PAD):
+    # [[ใต้, ตะวันตก], [เหนือ, ตะวันออก]] ของอาคารใน COORD_MAP (+ขอบ pad องศา)
+    lats = [v['lat'] for v in COORD_MAP.values()]; lons = [v['lon'] for v in COORD_MAP.values()]
+    return [[min(lats) - pad, min(lons) - pad], [max(lats) + pad, max(lons) + pad]]
+
+def campus_tiles(zooms=TILE_PROXY_ZOOMS, pad=TILE_PROXY_PAD):
+    # tile ทั้งหมดที่ครอบพื้นที่ campus_bounds
+    (s, w), (n, e) = campus_bounds(pad)
+    out = []
+    for z in zooms:
+        x0, y0 = tile_xy(n, w, z)
+        x1, y1 = tile_xy(s, e, z)
+        out += [(z, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+    return out
+
+class TileCache:
+    def __init__(self, root, upstream=SATELLITE_TILE_URL):
+        self.root, self.upstream = root, upstream
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, z, x, y):
+        return os.path.join(self.root, str(z), str(x), f"{y}.jpg")
+
+    def get(self, z, x, y):
+        path = self._path(z, x, y)
+        if os.path.exists(path):
+            with open(path, "rb") as f: return f.read()
+        r = get_http_session().get(self.upstream.format(x=x, y=y, z=z), timeout=TILE_TIMEOUT)
+        r.raise_for_status()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f: f.write(r.content)
+        os.replace(tmp, path)
+        return r.content
+
+    def seed(self, tiles, workers=4):
+        # โหลด tile ที่ยังไม่มีในดิสก์ล่วงหน้า คืน (จำนวนที่โหลดใหม่, จำนวนที่ล้มเหลว)
+        todo = [t for t in tiles if not os.path.exists(self._path(*t))]
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for fut in as_completed([pool.submit(self.get, *t) for t in todo]):
+                if fut.exception() is not None: failed += 1
+        return len(todo) - failed, failed
+
+class _TileHandler(http.server.BaseHTTPRequestHandler):
+    TILE_RE = re.compile(r"^/tiles/(\d+)/(\d+)/(\d+)(?:\.jpg)?$")
+
+    def do_GET(self):
+        m = self.TILE_RE.match(self.path.split("?")[0])
+        tile = tuple(map(int, m.groups())) if m else None
+        if tile not in self.server.allowed:
+            self.send_error(404); return
+        try:
+            data = self.server.tile_cache.get(*tile)
+        except Exception:
+            self.send_error(502); return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "public, max-age=2592000")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args): pass
+
+@st.cache_resource
+def start_tile_proxy():
+    # เปิดครั้งเดียวต่อโปรเซส คืน URL ฐานของพร็อกซี (None = ปิดอยู่ หรือเปิดพอร์ตไม่ได้)
+    if not TILE_PROXY_PORT: return None
+    cache = TileCache(TILE_CACHE_DIR)
+    try:
+        server = http.server.ThreadingHTTPServer((TILE_PROXY_HOST, TILE_PROXY_PORT), _TileHandler)
+    except OSError:
+        return None
+    tiles = campus_tiles()
+    server.tile_cache, server.allowed, server.daemon_threads = cache, frozenset(tiles), True
+    threading.Thread(target=server.serve_forever, daemon=True, name="tile-proxy").start()
+    threading.Thread(target=cache.seed, args=(tiles,), daemon=True, name="tile-seed").start()
+    return TILE_PROXY_URL
+
+def satellite_tiles_url():
+    base = start_tile_proxy()
+    return f"{base}/tiles/{{z}}/{{x}}/{{y}}.jpg" if base else SATELLITE_TILE_URL
+
 # Helpers
 def get_thai_date_full(date_input):
     """แปลงวันที่จาก '29/12/2025' หรือ datetime object ให้เป็น '29 ธันวาคม พ.ศ. 2568'"""
@@ -350,32 +596,6 @@ def get_thai_date_full(date_input):
         return date_input # หากแปลงไม่ได้ให้คืนค่าเดิม
 def get_now_th(): return datetime.now(pytz.timezone('Asia/Bangkok'))
 def clean_val(val): return str(val).strip() if not pd.isna(val) else ""
-def process_image(img_file):
-    if not img_file: return ""
-    try:
-        # 1. เปิดรูปภาพ
-        img = Image.open(img_file)
-        
-        # 🚩 2. แก้ปัญหารูปหมุน (EXIF Orientation) 
-        # คำสั่งนี้จะเช็คว่ารูปถ่ายมาแนวไหน แล้วหมุนพิกเซลให้ถูกต้องตามแนวนั้นจริงๆ
-        img = ImageOps.exif_transpose(img)
-        
-        # 3. แปลงเป็น RGB (เพื่อความปลอดภัยในการเซฟเป็น JPEG)
-        img = img.convert('RGB')
-        
-        # 4. ปรับขนาดรูป (Thumbnail)
-        img.thumbnail((1600, 1600))
-        
-        buf = io.BytesIO()
-        
-        # 5. บันทึกรูปภาพ
-        img.save(buf, format="JPEG", quality=85, optimize=True)
-        
-        return base64.b64encode(buf.getvalue()).decode()
-    except Exception as e:
-        print(f"Error processing image: {e}")
-        return ""
-
 def calculate_pagination(key, total_items, limit=5):
     if key not in st.session_state: st.session_state[key] = 1
     total_pages = math.ceil(total_items / limit) or 1
@@ -383,39 +603,106 @@ def calculate_pagination(key, total_items, limit=5):
     start_idx = (st.session_state[key] - 1) * limit
     end_idx = start_idx + limit
     return start_idx, end_idx, st.session_state[key], total_pages
-def upload_to_drive(file_obj, filename):
-        file_content = file_obj.getvalue()
-        base64_str = base64.b64encode(file_content).decode('utf-8')
-        payload = {"folder_id": DRIVE_FOLDER_ID, "filename": filename, "file": base64_str, "mimeType": file_obj.type}
-        try:
-            res = requests.post(GAS_APP_URL, json=payload).json()
-            return res.get("link") if res.get("status") == "success" else None
-        except: return None
 # --- ย้ายกลุ่มฟังก์ชันนี้มาชิดซ้ายสุดของไฟล์ (ไม่ต้องมีช่องว่างข้างหน้า) ---
 
-def upload_to_drive(file_obj, filename):
-    file_content = file_obj.getvalue()
-    base64_str = base64.b64encode(file_content).decode('utf-8')
-    payload = {"folder_id": DRIVE_FOLDER_ID, "filename": filename, "file": base64_str, "mimeType": file_obj.type}
+# --- การอัปโหลดไป Drive: ใช้ Session ร่วม (เก็บ connection ไว้ใช้ซ้ำ) + Thread pool จำกัดจำนวน ---
+UPLOAD_WORKERS = int(st.secrets.get("UPLOAD_WORKERS", 4))
+UPLOAD_TIMEOUT = (10, 120)  # (เชื่อมต่อ, รอคำตอบ) วินาที
+UPLOAD_STREAMING = str(st.secrets.get("UPLOAD_STREAMING", "false")).lower() == "true"
+UPLOAD_CHUNK = 3 * 64 * 1024  # หาร 3 ลงตัว base64 แต่ละก้อนจึงต่อกันได้โดยไม่มี padding กลางทาง
+
+@st.cache_resource
+def get_http_session():
+    sess = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_WORKERS * 2)
+    sess.mount("https://", adapter); sess.mount("http://", adapter)
+    return sess
+
+@st.cache_resource
+def get_upload_pool():
+    return ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="drive-upload")
+
+# --- แปลงรูปก่อนอัปโหลด (full / md / sm) ใน process pool ไม่กินเวลา CPU ของหน้าเว็บ ---
+IMAGE_WORKERS = int(st.secrets.get("IMAGE_WORKERS", 2))
+
+@st.cache_resource
+def get_image_pool():
+    # ใช้ spawn ไม่ fork โปรเซสของ Streamlit ที่มีหลายเธรดอยู่แล้ว
+    return ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+_POOL_RESET_LOCK = threading.Lock()
+
+def pool_submit(get_pool, fn, *args):
+    # worker ใน process pool ตาย (เช่น โดน OOM kill) -> pool ใช้ต่อไม่ได้ทั้งก้อน (BrokenProcessPool)
+    # ล้าง cache_resource แล้วสร้าง pool ใหม่ (ล้างเฉพาะถ้ายังเป็น pool ที่เสียตัวเดิม หลายเธรดเจอพร้อมกันไม่สร้างซ้ำ)
+    pool = get_pool()
     try:
-        res = requests.post(GAS_APP_URL, json=payload).json()
-        return res.get("link") if res.get("status") == "success" else None
-    except:
-        return None
-
-def upload_multiple_images(file_objs, base_filename):
-    if not file_objs:
-        return ""
-    links = []
-    # วนลูปอัปโหลดทีละรูป
-    for i, file_obj in enumerate(file_objs):
-        # ตั้งชื่อไฟล์ไม่ให้ซ้ำกัน
-        filename = f"{base_filename}_Evid_{i+1}.jpg"
-        link = upload_to_drive(file_obj, filename)
-        if link:
-            links.append(link)
-    # รวมลิงก์ทั้งหมดคั่นด้วยคอมม่า (,)
-    return ",".join(links)
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        with _POOL_RESET_LOCK:
+            if get_pool() is pool:
+                get_pool.clear()
+                pool.shutdown(wait=False)
+        return get_pool().submit(fn, *args)
+
+def image_variant(full, thumbs, size="md"):
+    # thumbs = "ลิงก์ md|ลิงก์ sm" ของรูปเดียวกัน ("-" หรือว่าง = ไม่มีรูปย่อ ใช้รูปเต็มแทน)
+    parts = str(thumbs or "").strip().split("|")
+    if size == "full" or len(parts) != 2: return full
+    return parts[0 if size == "md" else 1].strip() or full
+
+def evidence_links(row, size="full"):
+    # รูปพยานหลักฐานของคดี: Evidence_Image (รูปเต็ม) กับ Evidence_Thumbs (รูปย่อ) เรียงตรงกันทีละรูป
+    fulls = [p.strip() for p in clean_val(row.get('Evidence_Image')).split(',') if p.strip() and p.strip() not in ["0", "None", "nan"]]
+    thumbs = [p.strip() for p in clean_val(row.get('Evidence_Thumbs')).split(',') if p.strip()]
+    if size == "full" or len(thumbs) != len(fulls): return fulls
+    return [image_variant(f, t, size) for f, t in zip(fulls, thumbs)]
+
+def _read_full(src, size):
+    buf = b""
+    while len(buf) < size:
+        chunk = src.read(size - len(buf))
+        if not chunk: break
+        buf += chunk
+    return buf
+
+def _stream_upload_body(src, filename, mime):
+    # สร้าง JSON ทีละก้อน (chunked transfer) ไม่ต้องถือ base64 ทั้งไฟล์ไว้ในหน่วยความจำ
+    head = json.dumps({"folder_id": DRIVE_FOLDER_ID, "filename": filename, "mimeType": mime}, ensure_ascii=False)
+    yield (head[:-1] + ', "file": "').encode("utf-8")
+    while True:
+        chunk = _read_full(src, UPLOAD_CHUNK)
+        if not chunk: break
+        yield base64.b64encode(chunk)
+    yield b'"}'
+
+def upload_bytes_to_drive(data, filename, mime):
+    # แบบแจ้ง Error ออกมา (คิวเขียนข้อมูลต้องรู้ว่าล้มเหลวเพื่อลองใหม่) รับได้ทั้ง bytes และไฟล์
+    sess = get_http_session()
+    if UPLOAD_STREAMING:
+        src = io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+        if hasattr(src, "seek"): src.seek(0)
+        res = sess.post(GAS_APP_URL, data=_stream_upload_body(src, filename, mime),
+                        headers={"Content-Type": "application/json"}, timeout=UPLOAD_TIMEOUT)
+    else:
+        raw = data if isinstance(data, (bytes, bytearray)) else data.getvalue()
+        payload = {"folder_id": DRIVE_FOLDER_ID, "filename": filename, "file": base64.b64encode(raw).decode('utf-8'), "mimeType": mime}
+        res = sess.post(GAS_APP_URL, json=payload, timeout=UPLOAD_TIMEOUT)
+    res = res.json()
+    if res.get("status") != "success" or not res.get("link"):
+        raise Exception(res.get("message") or f"อัปโหลด {filename} ไม่สำเร็จ")
+    return res["link"]
+
+def upload_files_parallel(items):
+    # items = [(data, filename, mime)] -> [(link, error)] เรียงตามลำดับเดิม ไฟล์ที่ล้มเหลวไม่กระทบไฟล์อื่น
+    if not items: return []
+    futs = {get_upload_pool().submit(upload_bytes_to_drive, d, fn, m): i for i, (d, fn, m) in enumerate(items)}
+    results = [(None, None)] * len(items)
+    for fut in as_completed(futs):
+        i = futs[fut]
+        try: results[i] = (fut.result(), None)
+        except Exception as e: results[i] = (None, str(e))
+    return results
 
 def get_img_link(url):
     if not url or url == "nan":
@@ -457,13 +744,1551 @@ def safe_decode_image(img_str):
         return base64.b64decode(img_str)
     except:
         return None
+
+# --- รูปสำหรับพิมพ์: ดาวน์โหลดพร้อมกัน ย่อให้พอดีกรอบ แล้วฝังเป็น data URI ก่อนจัดหน้า PDF ---
+PRINT_IMAGE_TIMEOUT = (5, 20)
+PRINT_IMAGE_WORKERS = 6
+
+def fetch_url_bytes(url):
+    res = get_http_session().get(url, timeout=PRINT_IMAGE_TIMEOUT)
+    res.raise_for_status()
+    return res.content
+
+class ImageCache:
+    # รูปที่ดาวน์โหลดแล้วใช้ร่วมกันทุกผู้ใช้ (LRU ตามขนาดรวม) + จำข้อผิดพลาดไว้สั้นๆ ไม่ให้รอ timeout ซ้ำทุกรีรัน
+    def __init__(self, max_bytes=64 * 1024 * 1024, error_ttl=60):
+        self.max_bytes, self.error_ttl = max_bytes, error_ttl
+        self._items = OrderedDict(); self._errors = {}; self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            if url in self._items:
+                self._items.move_to_end(url)
+                return self._items[url]
+            err = self._errors.get(url)
+            if err and err[1] > time.time(): raise Exception(err[0])
+        try:
+            data = fetch_url_bytes(url)
+        except Exception as e:
+            with self._lock: self._errors[url] = (str(e), time.time() + self.error_ttl)
+            raise
+        with self._lock:
+            self._errors.pop(url, None)
+            if url not in self._items:
+                self._items[url] = data; self._size += len(data)
+            while self._size > self.max_bytes and len(self._items) > 1:
+                _, old = self._items.popitem(last=False); self._size -= len(old)
+        return data
+
+    def get_many(self, urls):
+        # ดาวน์โหลดพร้อมกัน -> {url: (bytes, None) หรือ (None, เหตุผลที่ล้มเหลว)}
+        def _get(url):
+            try: return self.get(url), None
+            except Exception as e: return None, str(e)
+        urls = list(dict.fromkeys(u for u in urls if u))
+        if not urls: return {}
+        with ThreadPoolExecutor(max_workers=min(PRINT_IMAGE_WORKERS, len(urls))) as pool:
+            return dict(zip(urls, pool.map(_get, urls)))
+
+@st.cache_resource
+def get_image_cache():
+    return ImageCache()
+
+def load_print_image(src, box):
+    # src = ลิงก์ Drive / http / base64 (ข้อมูลเก่า), box = (กว้าง, สูง) ในเอกสาร -> JPEG ขนาด 2 เท่าของกรอบ
+    src = str(src).strip(); w, h = box[0] * 2, box[1] * 2
+    match = re.search(r'/d/([a-zA-Z0-9_-]+)|id=([a-zA-Z0-9_-]+)', src) if "drive.google.com" in src else None
+    if match:
+        file_id = match.group(1) or match.group(2)
+        # ขอรูปย่อจาก Drive ตามขนาดที่ใช้จริง (ไม่ต้องโหลดไฟล์เต็ม) ถ้าไม่ได้ค่อยโหลดไฟล์ตรง
+        try: raw = get_image_cache().get(f"https://drive.google.com/thumbnail?id={file_id}&sz=s{max(w, h)}")
+        except Exception: raw = get_image_cache().get(f"https://drive.google.com/uc?export=view&id={file_id}")
+    elif src.startswith("http"):
+        raw = get_image_cache().get(src)
+    else:
+        raw = safe_decode_image(src.split(",", 1)[1] if src.startswith("data:") else src)
+        if not raw: raise ValueError("ข้อมูลรูปไม่ถูกต้อง")
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(raw))).convert('RGB')
+    img.thumbnail((w, h))
+    buf = io.BytesIO(); img.save(buf, format="JPEG", quality=80, optimize=True)
+    return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode()
+
+def prefetch_print_images(items):
+    # items = [(src, box)] -> [data URI หรือ None ถ้าโหลดไม่สำเร็จ] เรียงตามเดิม
+    def _load(item):
+        try: return load_print_image(*item)
+        except Exception as e:
+            print(f"Print image error ({str(item[0])[:60]}): {e}")
+            return None
+    if not items: return []
+    with ThreadPoolExecutor(max_workers=min(PRINT_IMAGE_WORKERS, len(items))) as pool:
+        return list(pool.map(_load, items))
+# ==========================================
+# 1.5 DATA STORAGE (Google Sheets / SQLite)
+# ==========================================
+# ทุกโมดูลอ่าน/เขียนข้อมูลผ่าน get_storage() เท่านั้น
+# - "gsheets" (ค่าเริ่มต้น): ใช้ Google Sheets เหมือนเดิม
+# - "sqlite": ฐานข้อมูลในเครื่อง (มี Index) ใช้รันแบบออฟไลน์/ทดสอบโหลด
+#   ตั้งค่าใน secrets: STORAGE_BACKEND = "sqlite" และ SQLITE_PATH (ไม่บังคับ)
+GSHEET_SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+GSHEET_CLIENT_MAX_AGE = 50 * 60  # Token ของ Service Account มีอายุ 1 ชม. -> สร้าง Client ใหม่ก่อนหมดอายุ
+
+def _gsheet_creds_dict(source):
+    if source == "textkey":
+        key_str = st.secrets["textkey"]["json_content"]
+        key_str = key_str.strip()
+        if key_str.startswith("'") and key_str.endswith("'"): key_str = key_str[1:-1]
+        if key_str.startswith('"') and key_str.endswith('"'): key_str = key_str[1:-1]
+        try: return json.loads(key_str, strict=False)
+        except: return json.loads(key_str.replace('\n', '\\n'), strict=False)
+    return dict(st.secrets["connections"]["gsheets"])
+
+# ✅ Client + Worksheet ที่ Authorize แล้ว ใช้ร่วมกันทุก Session ในโปรเซส (ไม่ Auth ใหม่ทุกครั้งที่กดบันทึก)
+@st.cache_resource
+def _gsheet_handles():
+    return {"lock": threading.Lock(), "clients": {}}
+
+def reset_gsheet_handles():
+    h = _gsheet_handles()
+    with h["lock"]: h["clients"].clear()
+
+def get_gsheet_worksheet(source, book_ref, sheet_name=None):
+    h = _gsheet_handles()
+    with h["lock"]:
+        ent = h["clients"].get(source)
+        if ent is None or time.time() - ent["born"] > GSHEET_CLIENT_MAX_AGE:
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(_gsheet_creds_dict(source), GSHEET_SCOPE)
+            ent = {"client": gspread.authorize(creds), "born": time.time(), "books": {}, "sheets": {}}
+            h["clients"][source] = ent
+        key = (book_ref, sheet_name)
+        if key not in ent["sheets"]:
+            if book_ref not in ent["books"]:
+                c = ent["client"]
+                ent["books"][book_ref] = c.open_by_url(book_ref) if book_ref.startswith("http") else c.open(book_ref)
+            book = ent["books"][book_ref]
+            ent["sheets"][key] = book.worksheet(sheet_name) if sheet_name else book.sheet1
+        return ent["sheets"][key]
+
+def gsheet_retry(fn):
+    # Token ถูกเพิกถอน/หมดอายุก่อนกำหนด (401) -> ล้าง Client แล้วลองใหม่ 1 ครั้ง
+    try: return fn()
+    except gspread.exceptions.APIError as e:
+        if getattr(e.response, "status_code", None) != 401: raise
+        reset_gsheet_handles()
+        return fn()
+
+def connect_gsheet_universal():
+    if "textkey" in st.secrets and "json_content" in st.secrets["textkey"]:
+        try: return get_gsheet_worksheet("textkey", SHEET_NAME_TRAFFIC)
+        except: pass
+
+    if "connections" in st.secrets and "gsheets" in st.secrets["connections"]:
+        return get_gsheet_worksheet("gsheets", SHEET_NAME_TRAFFIC)
+        
+    raise Exception("ไม่สามารถอ่าน Credentials ได้")
+
+def open_investigation_worksheet(sheet_name):
+    # ชีตคดีใช้ Service Account และไฟล์เดียวกับ st.connection("gsheets")
+    book_ref = str(st.secrets["connections"]["gsheets"].get("spreadsheet", ""))
+    return get_gsheet_worksheet("gsheets", book_ref, sheet_name)
+
+class PortalStorage(abc.ABC):
+    """อินเทอร์เฟซกลางของข้อมูลคดี (Investigation_<ปี>) และทะเบียนรถ (Motorcycle_DB)"""
+
+    # --- ข้อมูลคดี: คืนค่าเป็น DataFrame (แถวแรกของชีตคือหัวตาราง) ---
+    @abc.abstractmethod
+    def read_cases(self, sheet_name, ttl=10): ...
+    @abc.abstractmethod
+    def write_cases(self, sheet_name, df): ...
+    # เขียนเฉพาะช่องที่เปลี่ยนของคดี Report_ID เดียว ({ชื่อคอลัมน์: ค่าใหม่})
+    @abc.abstractmethod
+    def patch_case(self, sheet_name, report_id, changes): ...
+    # สำหรับ War Room: คืน (แถวใหม่หลัง after_row เฉพาะคอลัมน์ที่ขอ, Series สถานะของทุกแถว) index = เลขแถวในชีต
+    @abc.abstractmethod
+    def read_cases_since(self, sheet_name, after_row, columns): ...
+    @abc.abstractmethod
+    def read_case_rows(self, sheet_name, row_nos, columns): ...
+    @abc.abstractmethod
+    def read_case_cells(self, sheet_name, report_id, columns): ...  # {คอลัมน์: ค่า} ของคดี Report_ID เดียว
+    @abc.abstractmethod
+    def list_case_sheets(self): ...  # ชื่อชีตคดีทั้งหมด (ทุกปีการศึกษา)
+
+    # --- ทะเบียนรถ: คืนค่าเป็น list ของแถว (รวมหัวตาราง) เหมือน get_all_values() ---
+    @abc.abstractmethod
+    def read_vehicles(self): ...
+    @abc.abstractmethod
+    def find_vehicle_row(self, std_id): ...
+    @abc.abstractmethod
+    def read_vehicle_column(self, col_no): ...  # ค่าทั้งคอลัมน์ (รวมหัวตาราง), col_no เริ่มที่ 1
+    # std_id: ถ้าระบุ จะตรวจว่าแถวนั้นยังเป็นของนักเรียนคนนี้ก่อนเขียน (ไม่ตรง -> หาแถวใหม่)
+    @abc.abstractmethod
+    def update_vehicles(self, a1_range, values, std_id=None): ...
+    @abc.abstractmethod
+    def patch_vehicle(self, row_no, changes, std_id=None): ...  # แก้ตามชื่อหัวตาราง เพิ่มคอลัมน์ถ้ายังไม่มี
+    @abc.abstractmethod
+    def replace_vehicles(self, values): ...
+
+def norm_report_id(val):
+    return re.sub(r'\.0$', '', str(val).strip())
+
+def col_letter(n):
+    return gspread.utils.rowcol_to_a1(1, n)[:-1]
+
+def move_a1_row(a1_range, row_no):
+    # ช่วงแถวเดียว เช่น "M5:N5" -> "M9:N9"
+    return re.sub(r'([A-Za-z]+)\d+', lambda m: f"{m.group(1)}{row_no}", a1_range)
+
+class SheetsStorage(PortalStorage):
+    def __init__(self):
+        self._case_headers = {}
+        # ดัชนี รหัสนักเรียน (คอลัมน์ C) -> เลขแถวในชีต สร้างใหม่ทุกครั้งที่ read_vehicles()
+        self._vehicle_rows = {}
+        self._vehicle_lock = threading.Lock()
+
+    def _conn(self):
+        return st.connection("gsheets", type=GSheetsConnection)
+
+    def read_cases(self, sheet_name, ttl=10):
+        return self._conn().read(worksheet=sheet_name, ttl=ttl)
+
+    def write_cases(self, sheet_name, df):
+        self._conn().update(worksheet=sheet_name, data=df)
+
+    def patch_case(self, sheet_name, report_id, changes):
+        if not changes: return
+        gsheet_retry(lambda: self._patch_case(sheet_name, report_id, changes))
+
+    def _batch_get_columns(self, ws, sheet_name, make_ranges):
+        # อ่านหัวตาราง + ช่วงที่ต้องการในคำขอเดียว ถ้าหัวตารางในชีตเปลี่ยน (แทรก/ย้ายคอลัมน์) จะคำนวณช่วงใหม่
+        header = self._case_headers.get(sheet_name) or ws.row_values(1)
+        res = ws.batch_get(['1:1'] + make_ranges(header))
+        fresh = list(res[0][0]) if res[0] else []
+        if fresh != header:
+            header = fresh
+            res = [res[0]] + (ws.batch_get(make_ranges(header)) if make_ranges(header) else [])
+        self._case_headers[sheet_name] = header
+        return header, res[1:]
+
+    @staticmethod
+    def _col_range(header, col, start_row):
+        c = col_letter(header.index(col) + 1)
+        return f"{c}{start_row}:{c}"
+
+    def _find_case_row(self, ws, sheet_name, report_id):
+        header, (id_rng,) = self._batch_get_columns(ws, sheet_name, lambda h: [self._col_range(h, 'Report_ID', 2)])
+        ids = [norm_report_id(r[0]) if r else "" for r in id_rng]
+        target = norm_report_id(report_id)
+        if target not in ids:
+            raise ValueError(f"ไม่พบเลขที่รับแจ้ง {target} ในชีต {sheet_name}")
+        return header, ids.index(target) + 2
+
+    def _patch_case(self, sheet_name, report_id, changes):
+        ws = open_investigation_worksheet(sheet_name)
+        header, row_no = self._find_case_row(ws, sheet_name, report_id)
+        # แก้สำเนาของหัวตาราง -> แคชหัวตารางเปลี่ยนเมื่อเขียนคอลัมน์ใหม่ลงชีตสำเร็จแล้วเท่านั้น
+        header = list(header)
+
+        data = []
+        for col, val in changes.items():
+            if col not in header:
+                header.append(col)
+                data.append({'range': gspread.utils.rowcol_to_a1(1, len(header)), 'values': [[col]]})
+            data.append({'range': gspread.utils.rowcol_to_a1(row_no, header.index(col) + 1), 'values': [[val]]})
+        if len(header) > ws.col_count: ws.add_cols(len(header) - ws.col_count)
+        ws.batch_update(data, value_input_option='RAW')
+        self._case_headers[sheet_name] = header
+
+    def read_cases_since(self, sheet_name, after_row, columns):
+        return gsheet_retry(lambda: self._read_cases_since(sheet_name, after_row, columns))
+
+    def _read_cases_since(self, sheet_name, after_row, columns):
+        ws = open_investigation_worksheet(sheet_name)
+        def make_ranges(h):
+            cols = [c for c in columns if c in h]
+            return [self._col_range(h, c, after_row + 1) for c in cols] + [self._col_range(h, 'Status', 2)]
+        header, res = self._batch_get_columns(ws, sheet_name, make_ranges)
+        cols = [c for c in columns if c in header]
+        *col_vals, status_rng = res
+        # แต่ละคอลัมน์ถูกตัดช่องว่างท้ายต่างกัน -> เติมให้ยาวเท่ากัน
+        n = max([len(v) for v in col_vals] + [0])
+        data = {c: [(v[i][0] if i < len(v) and v[i] else "") for i in range(n)] for c, v in zip(cols, col_vals)}
+        tail = pd.DataFrame(data, columns=list(columns), index=range(after_row + 1, after_row + 1 + n))
+        status = pd.Series([r[0] if r else "" for r in status_rng], index=range(2, 2 + len(status_rng)), dtype=object)
+        return tail, status
+
+    def read_case_rows(self, sheet_name, row_nos, columns):
+        return gsheet_retry(lambda: self._read_case_rows(sheet_name, row_nos, columns))
+
+    def _read_case_rows(self, sheet_name, row_nos, columns):
+        ws = open_investigation_worksheet(sheet_name)
+        def make_ranges(h):
+            return [f"{col_letter(h.index(c) + 1)}{r}" for r in row_nos for c in columns if c in h]
+        header, res = self._batch_get_columns(ws, sheet_name, make_ranges)
+        cols = [c for c in columns if c in header]
+        cells = iter(res)
+        rows = [[(lambda v: v[0][0] if v and v[0] else "")(next(cells)) for _ in cols] for _ in row_nos]
+        return pd.DataFrame(rows, columns=cols, index=list(row_nos)).reindex(columns=list(columns), fill_value="")
+
+    def read_case_cells(self, sheet_name, report_id, columns):
+        def _read():
+            _, row_no = self._find_case_row(open_investigation_worksheet(sheet_name), sheet_name, report_id)
+            return self._read_case_rows(sheet_name, [row_no], columns).iloc[0].to_dict()
+        return gsheet_retry(_read)
+
+    def list_case_sheets(self):
+        def _list():
+            book_ref = str(st.secrets["connections"]["gsheets"].get("spreadsheet", ""))
+            return [ws.title for ws in get_gsheet_worksheet("gsheets", book_ref).spreadsheet.worksheets()]
+        return [s for s in gsheet_retry(_list) if s.startswith("Investigation_")]
+
+    def read_vehicles(self):
+        vals = gsheet_retry(lambda: connect_gsheet_universal().get_all_values())
+        rows = {}
+        for row_no, r in enumerate(vals[1:], start=2):
+            if len(r) > 2 and str(r[2]).strip(): rows.setdefault(str(r[2]).strip(), row_no)
+        with self._vehicle_lock:
+            self._vehicle_rows = rows
+        return vals
+
+    def _vehicle_row(self, key):
+        # อ่านดัชนีใต้ล็อกเดียวกับที่ read_vehicles() สลับดัชนีใหม่ (คิวเขียนกับหน้าเว็บเรียกคนละเธรด)
+        with self._vehicle_lock:
+            return self._vehicle_rows.get(key)
+
+    def find_vehicle_row(self, std_id):
+        # ใช้ดัชนีในหน่วยความจำแทน sheet.find (ไม่ต้องสแกนทั้งชีต และไม่ชนกับคอลัมน์อื่น)
+        key = str(std_id).strip()
+        row_no = self._vehicle_row(key)
+        if row_no is None:
+            self.read_vehicles()
+            row_no = self._vehicle_row(key)
+        return row_no
+
+    def read_vehicle_column(self, col_no):
+        return gsheet_retry(lambda: connect_gsheet_universal().col_values(col_no))
+
+    def _checked_vehicle_row(self, row_no, std_id, cell):
+        # ดัชนี/เลขแถวในคิวอาจเก่า (มีคนแทรกหรือลบแถวในชีตเอง) -> cell คือค่าคอลัมน์ C ที่อ่านมาก่อนเขียน ไม่ตรงให้สร้างดัชนีใหม่
+        key = str(std_id).strip()
+        if cell and cell[0] and str(cell[0][0]).strip() == key: return row_no
+        self.read_vehicles()
+        new_row = self._vehicle_row(key)
+        if not new_row: raise LookupError(f"ไม่พบรหัสนักเรียน {key} ในชีตทะเบียนรถ")
+        return new_row
+
+    def update_vehicles(self, a1_range, values, std_id=None):
+        def _update():
+            ws = connect_gsheet_universal(); rng = a1_range
+            if std_id is not None:
+                row_no = gspread.utils.a1_to_rowcol(rng.split(':')[0])[0]
+                rng = move_a1_row(rng, self._checked_vehicle_row(row_no, std_id, ws.batch_get([f"C{row_no}"])[0]))
+            ws.update(rng, values)
+        gsheet_retry(_update)
+
+    def patch_vehicle(self, row_no, changes, std_id=None):
+        def _patch():
+            ws = connect_gsheet_universal()
+            # หัวตาราง + คอลัมน์ C ของแถวเป้าหมายอ่านใน batch เดียว
+            head, cell = ws.batch_get(['1:1', f"C{row_no}"])
+            header = list(head[0]) if head else []; data = []
+            row = self._checked_vehicle_row(row_no, std_id, cell) if std_id is not None else row_no
+            for col, val in changes.items():
+                if col not in header:
+                    header.append(col)
+                    data.append({'range': gspread.utils.rowcol_to_a1(1, len(header)), 'values': [[col]]})
+                data.append({'range': gspread.utils.rowcol_to_a1(row, header.index(col) + 1), 'values': [[val]]})
+            if len(header) > ws.col_count: ws.add_cols(len(header) - ws.col_count)
+            ws.batch_update(data, value_input_option='RAW')
+        gsheet_retry(_patch)
+
+    def replace_vehicles(self, values):
+        def _replace():
+            sheet = connect_gsheet_universal()
+            sheet.clear()
+            sheet.update('A1', values)
+        gsheet_retry(_replace)
+        self.read_vehicles()
+
+class SQLiteStorage(PortalStorage):
+    # row_no ใช้เลขแถวเดียวกับใน Google Sheets (แถว 1 = หัวตาราง) เพื่อให้ช่วง A1 ใช้ร่วมกันได้
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS case_sheets (sheet TEXT PRIMARY KEY, columns TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS cases (
+        sheet TEXT NOT NULL, row_no INTEGER NOT NULL, report_id TEXT, status TEXT,
+        location TEXT, incident_type TEXT, data TEXT NOT NULL, PRIMARY KEY (sheet, row_no));
+    CREATE INDEX IF NOT EXISTS idx_cases_report ON cases (sheet, report_id);
+    CREATE INDEX IF NOT EXISTS idx_cases_status ON cases (sheet, status);
+    CREATE TABLE IF NOT EXISTS vehicles (row_no INTEGER PRIMARY KEY, std_id TEXT, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS idx_vehicles_std ON vehicles (std_id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(self.SCHEMA)
+
+    @staticmethod
+    def _plain(val):
+        # แปลงค่าจาก DataFrame (numpy / NaN / Timestamp) ให้เก็บเป็น JSON ได้
+        if val is None or (not isinstance(val, (list, dict)) and pd.isna(val)): return None
+        if hasattr(val, 'item'): return val.item()
+        if isinstance(val, (str, int, float, bool)): return val
+        return str(val)
+
+    @staticmethod
+    def _index_fields(cols, rec):
+        get = lambda c: str(rec[cols.index(c)]) if c in cols and cols.index(c) < len(rec) and rec[cols.index(c)] is not None else ""
+        return norm_report_id(get('Report_ID')), get('Status').strip(), get('Location'), get('Incident_Type')
+
+    def read_cases(self, sheet_name, ttl=10):
+        with self._lock:
+            head = self._db.execute("SELECT columns FROM case_sheets WHERE sheet = ?", (sheet_name,)).fetchone()
+            if not head: return pd.DataFrame()
+            rows = self._db.execute("SELECT data FROM cases WHERE sheet = ? ORDER BY row_no", (sheet_name,)).fetchall()
+        cols = json.loads(head[0])
+        recs = [json.loads(r[0]) for r in rows]
+        return pd.DataFrame([rec + [None] * (len(cols) - len(rec)) for rec in recs], columns=cols)
+
+    def write_cases(self, sheet_name, df):
+        cols = [str(c) for c in df.columns]
+        records = []
+        for i, vals in enumerate(df.itertuples(index=False, name=None)):
+            rec = [self._plain(v) for v in vals]
+            records.append((sheet_name, i + 2, *self._index_fields(cols, rec), json.dumps(rec, ensure_ascii=False)))
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO case_sheets (sheet, columns) VALUES (?, ?)", (sheet_name, json.dumps(cols, ensure_ascii=False)))
+            self._db.execute("DELETE FROM cases WHERE sheet = ?", (sheet_name,))
+            self._db.executemany("INSERT INTO cases VALUES (?, ?, ?, ?, ?, ?, ?)", records)
+
+    def patch_case(self, sheet_name, report_id, changes):
+        if not changes: return
+        with self._lock, self._db:
+            head = self._db.execute("SELECT columns FROM case_sheets WHERE sheet = ?", (sheet_name,)).fetchone()
+            hit = self._db.execute("SELECT row_no, data FROM cases WHERE sheet = ? AND report_id = ? ORDER BY row_no LIMIT 1",
+                                   (sheet_name, norm_report_id(report_id))).fetchone()
+            if not head or not hit:
+                raise ValueError(f"ไม่พบเลขที่รับแจ้ง {norm_report_id(report_id)} ในชีต {sheet_name}")
+            cols, rec = json.loads(head[0]), json.loads(hit[1])
+            for col, val in changes.items():
+                if col not in cols: cols.append(col)
+                if len(rec) < len(cols): rec += [None] * (len(cols) - len(rec))
+                rec[cols.index(col)] = self._plain(val)
+            self._db.execute("UPDATE case_sheets SET columns = ? WHERE sheet = ?", (json.dumps(cols, ensure_ascii=False), sheet_name))
+            self._db.execute("UPDATE cases SET report_id = ?, status = ?, location = ?, incident_type = ?, data = ? WHERE sheet = ? AND row_no = ?",
+                             (*self._index_fields(cols, rec), json.dumps(rec, ensure_ascii=False), sheet_name, hit[0]))
+
+    def _case_frame(self, sheet_name, rows, columns):
+        head = self._db.execute("SELECT columns FROM case_sheets WHERE sheet = ?", (sheet_name,)).fetchone()
+        cols = json.loads(head[0]) if head else []
+        pick = lambda rec, c: rec[cols.index(c)] if c in cols and cols.index(c) < len(rec) and rec[cols.index(c)] is not None else ""
+        recs = [(r[0], json.loads(r[1])) for r in rows]
+        return pd.DataFrame([[pick(rec, c) for c in columns] for _, rec in recs], columns=list(columns), index=[r for r, _ in recs])
+
+    def read_cases_since(self, sheet_name, after_row, columns):
+        with self._lock:
+            rows = self._db.execute("SELECT row_no, data FROM cases WHERE sheet = ? AND row_no > ? ORDER BY row_no", (sheet_name, after_row)).fetchall()
+            tail = self._case_frame(sheet_name, rows, columns)
+            stat = self._db.execute("SELECT row_no, status FROM cases WHERE sheet = ? ORDER BY row_no", (sheet_name,)).fetchall()
+        return tail, pd.Series([r[1] or "" for r in stat], index=[r[0] for r in stat], dtype=object)
+
+    def read_case_rows(self, sheet_name, row_nos, columns):
+        marks = ",".join("?" * len(row_nos))
+        with self._lock:
+            rows = self._db.execute(f"SELECT row_no, data FROM cases WHERE sheet = ? AND row_no IN ({marks}) ORDER BY row_no", (sheet_name, *row_nos)).fetchall()
+            return self._case_frame(sheet_name, rows, columns)
+
+    def read_case_cells(self, sheet_name, report_id, columns):
+        with self._lock:
+            rows = self._db.execute("SELECT row_no, data FROM cases WHERE sheet = ? AND report_id = ? ORDER BY row_no LIMIT 1",
+                                    (sheet_name, norm_report_id(report_id))).fetchall()
+            if not rows: raise ValueError(f"ไม่พบเลขที่รับแจ้ง {norm_report_id(report_id)} ในชีต {sheet_name}")
+            return self._case_frame(sheet_name, rows, columns).iloc[0].to_dict()
+
+    def list_case_sheets(self):
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT sheet FROM case_sheets WHERE sheet LIKE 'Investigation_%' ORDER BY sheet").fetchall()]
+
+    def is_empty(self):
+        with self._lock:
+            return not any(self._db.execute(f"SELECT 1 FROM {t} LIMIT 1").fetchone() for t in ("case_sheets", "vehicles"))
+
+    def import_from(self, source):
+        # คัดลอกทะเบียนรถ + ชีตคดีทุกปีจาก backend อื่น (เช่น Google Sheets) ทับข้อมูลในเครื่อง คืน (จำนวนแถวทะเบียนรถ, จำนวนชีตคดี)
+        vehicles = source.read_vehicles()
+        if vehicles: self.replace_vehicles(vehicles)
+        sheets = source.list_case_sheets()
+        for name in sheets:
+            self.write_cases(name, pd.DataFrame(source.read_cases(name, ttl=0)))
+        return len(vehicles), len(sheets)
+
+    def read_vehicles(self):
+        with self._lock:
+            rows = self._db.execute("SELECT data FROM vehicles ORDER BY row_no").fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def find_vehicle_row(self, std_id):
+        with self._lock:
+            hit = self._db.execute("SELECT row_no FROM vehicles WHERE std_id = ? AND row_no > 1 ORDER BY row_no LIMIT 1", (str(std_id),)).fetchone()
+        return hit[0] if hit else None
+
+    def read_vehicle_column(self, col_no):
+        return [r[col_no - 1] if len(r) >= col_no else "" for r in self.read_vehicles()]
+
+    def _checked_vehicle_row(self, row_no, std_id):
+        with self._lock:
+            hit = self._db.execute("SELECT std_id FROM vehicles WHERE row_no = ?", (row_no,)).fetchone()
+        if hit and hit[0] == str(std_id).strip(): return row_no
+        new_row = self.find_vehicle_row(str(std_id).strip())
+        if not new_row: raise LookupError(f"ไม่พบรหัสนักเรียน {std_id} ในทะเบียนรถ")
+        return new_row
+
+    def update_vehicles(self, a1_range, values, std_id=None):
+        if std_id is not None:
+            a1_range = move_a1_row(a1_range, self._checked_vehicle_row(gspread.utils.a1_to_rowcol(a1_range.split(':')[0])[0], std_id))
+        r0, c0 = gspread.utils.a1_to_rowcol(a1_range.split(':')[0])
+        with self._lock, self._db:
+            for r_off, new_vals in enumerate(values):
+                row_no = r0 + r_off
+                hit = self._db.execute("SELECT data FROM vehicles WHERE row_no = ?", (row_no,)).fetchone()
+                data = json.loads(hit[0]) if hit else []
+                need = c0 - 1 + len(new_vals)
+                if len(data) < need: data += [""] * (need - len(data))
+                data[c0 - 1:need] = [str(v) for v in new_vals]
+                self._db.execute("INSERT OR REPLACE INTO vehicles VALUES (?, ?, ?)",
+                                 (row_no, str(data[2]).strip() if len(data) > 2 else "", json.dumps(data, ensure_ascii=False)))
+
+    def patch_vehicle(self, row_no, changes, std_id=None):
+        if std_id is not None: row_no = self._checked_vehicle_row(row_no, std_id)
+        with self._lock:
+            hit = self._db.execute("SELECT data FROM vehicles WHERE row_no = 1").fetchone()
+        header = json.loads(hit[0]) if hit else []
+        for col, val in changes.items():
+            if col not in header:
+                header.append(col)
+                self.update_vehicles(f"{col_letter(len(header))}1", [[col]])
+            self.update_vehicles(f"{col_letter(header.index(col) + 1)}{row_no}", [[val]])
+
+    def replace_vehicles(self, values):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM vehicles")
+            self._db.executemany("INSERT INTO vehicles VALUES (?, ?, ?)", [
+                (i + 1, str(row[2]).strip() if len(row) > 2 else "", json.dumps([str(v) for v in row], ensure_ascii=False))
+                for i, row in enumerate(values)])
+
+@st.cache_resource
+def get_storage():
+    backend = str(st.secrets.get("STORAGE_BACKEND", os.environ.get("PORTAL_STORAGE", "gsheets"))).lower()
+    if backend == "sqlite":
+        storage = SQLiteStorage(st.secrets.get("SQLITE_PATH", os.path.join(BASE_DIR, "portal_data.db")))
+        # เปิดครั้งแรก (ฐานข้อมูลยังว่าง) -> ดึงข้อมูลตั้งต้นจาก Google Sheets ถ้ามี Credentials (ปิดได้ด้วย SQLITE_SEED_FROM_SHEETS = false)
+        seed = str(st.secrets.get("SQLITE_SEED_FROM_SHEETS", True)).lower() not in ("0", "false", "no")
+        if seed and storage.is_empty() and "connections" in st.secrets and "gsheets" in st.secrets["connections"]:
+            try:
+                n_rows, n_sheets = storage.import_from(SheetsStorage())
+                print(f"SQLite seeded from Google Sheets: ทะเบียนรถ {n_rows} แถว, ชีตคดี {n_sheets} ชีต")
+            except Exception as e:
+                print(f"SQLite seed error: {e}")
+        return storage
+    return SheetsStorage()
+
+# ==========================================
+# 1.6 WRITE-BEHIND QUEUE (คิวเขียนข้อมูล + อัปโหลดรูป แบบลองใหม่อัตโนมัติ)
+# ==========================================
+# ทุกการเขียนลงชีต/อัปโหลด Drive จากฟอร์มจะถูกบันทึกลงไฟล์ SQLite ก่อน (ไม่หายแม้แอปรีสตาร์ต)
+# แล้ว Thread เบื้องหลังค่อยส่งจริง ถ้าล้มเหลวจะลองใหม่แบบหน่วงเวลาเพิ่มขึ้นเรื่อยๆ (Exponential Backoff)
+# ค่าในงานอ้างอิงผลของงานอื่นได้ เช่น {"$result": key} = ลิงก์จากงานอัปโหลด key นั้น
+#                              {"$join": [...]}     = ต่อค่าที่ไม่ว่างด้วยคอมม่า
+#                              {"$cell": คอลัมน์}    = ค่าปัจจุบันของช่องนั้นในแถวคดี อ่านตอนส่งจริง (ไม่ใช่ตอนกดบันทึก)
+#                                  "fill": คอลัมน์รูป = ช่องว่าง -> "-" หนึ่งตัวต่อรูปในคอลัมน์นั้น (รูปย่อของรูปเก่า)
+WRITE_QUEUE_MAX_ATTEMPTS = 12
+WRITE_QUEUE_MAX_DELAY = 300  # หน่วงสูงสุด 5 นาทีต่อครั้ง
+WRITE_STATUS_TEXT = {"pending": "⏳ รอส่ง", "done": "✅ บันทึกแล้ว", "failed": "❌ ส่งไม่สำเร็จ"}
+
+def op_key(*parts):
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False, default=str).encode()).hexdigest()
+
+class WriteQueue:
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, kind TEXT NOT NULL,
+        target TEXT, payload TEXT NOT NULL, deps TEXT NOT NULL DEFAULT '[]', blob BLOB, label TEXT,
+        status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, next_at REAL NOT NULL DEFAULT 0,
+        result TEXT, error TEXT, created_at REAL NOT NULL, done_at REAL);
+    CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, id);
+    """
+
+    def __init__(self, path, storage):
+        self.storage = storage
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(self.SCHEMA)
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, name="write-queue", daemon=True).start()
+
+    # --- ฝั่ง UI ---
+    def enqueue(self, kind, payload, key, target=None, deps=(), blob=None, label=""):
+        # key ซ้ำ (เช่น กดบันทึกซ้ำ / รีรันหน้า) จะไม่ถูกเพิ่มงานซ้ำ
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO outbox (key, kind, target, payload, deps, blob, label, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, kind, target, json.dumps(payload, ensure_ascii=False), json.dumps(list(deps)), blob, label, time.time()))
+        self._wake.set()
+        return key
+
+    def status(self, keys):
+        if not keys: return {}
+        marks = ",".join("?" * len(keys))
+        with self._lock:
+            rows = self._db.execute(f"SELECT key, status, error, attempts FROM outbox WHERE key IN ({marks})", list(keys)).fetchall()
+        return {k: {"status": s, "error": e, "attempts": a} for k, s, e, a in rows}
+
+    def pending(self, target_prefix):
+        # งานที่ยังรอส่งของเป้าหมายกลุ่มหนึ่ง (เช่น "vehicle:" = ทุกแถวทะเบียนรถ) -> [(key, label)] ใช้กับ wait_for_writes
+        with self._lock:
+            rows = self._db.execute("SELECT key, label FROM outbox WHERE status = 'pending' AND target LIKE ? ORDER BY id",
+                                    (target_prefix + "%",)).fetchall()
+        return [(k, label or k) for k, label in rows]
+
+    def _open_ops(self, kind, recent=60):
+        # งานที่ยังไม่ส่ง + งานที่เพิ่งส่งเสร็จ (แคชการอ่านชีตอาจยังไม่เห็นค่าใหม่)
+        with self._lock:
+            return self._db.execute(
+                "SELECT payload, status FROM outbox WHERE kind = ? AND (status = 'pending' OR (status = 'done' AND done_at > ?)) ORDER BY id",
+                (kind, time.time() - recent)).fetchall()
+
+    def overlay_cases(self, sheet_name, df):
+        # แสดงค่าที่รอส่งทับข้อมูลที่อ่านมา ให้ผู้ใช้เห็นผลทันทีหลังกดบันทึก
+        ops = [(json.loads(r[0]), r[1]) for r in self._open_ops("patch_case")]
+        ops = [(op, status) for op, status in ops if op["sheet"] == sheet_name]
+        if not ops or df.empty or 'Report_ID' not in df.columns: return df
+        df = df.copy()
+        ids = df['Report_ID'].map(norm_report_id)
+        for op, status in ops:
+            hit = ids == norm_report_id(op["report_id"])
+            cells = None
+            if self.cell_columns(op["changes"]):
+                # ต่อท้ายค่าในแถว: งานที่ส่งแล้วอาจอยู่ในข้อมูลที่อ่านมาแล้ว (ไม่ต่อซ้ำ) งานที่รอส่งต่อจากค่าที่แสดงอยู่
+                if status != "pending" or not hit.any(): continue
+                cells = df.loc[hit].iloc[0].to_dict()
+            for col, val in self.resolve(op["changes"], cells).items():
+                if col not in df.columns: df[col] = ""
+                df[col] = df[col].astype(object)
+                df.loc[hit, col] = val
+        return df
+
+    def overlay_vehicles(self, vals):
+        ops = [json.loads(r[0]) for r in self._open_ops("vehicle_range")]
+        for op in ops:
+            r0, c0 = gspread.utils.a1_to_rowcol(op["range"].split(':')[0])
+            for r_off, new_vals in enumerate(self.resolve(op["values"])):
+                i = r0 - 1 + r_off
+                if i >= len(vals): continue
+                row = list(vals[i])
+                if len(row) < c0 - 1 + len(new_vals): row += [""] * (c0 - 1 + len(new_vals) - len(row))
+                row[c0 - 1:c0 - 1 + len(new_vals)] = [str(v) for v in new_vals]
+                vals[i] = row[:max(len(vals[0]), len(vals[i]))]
+        return vals
+
+    def resolve(self, val, cells=None):
+        # cells = ค่าปัจจุบันของแถว (ตอนส่งจริง) ไม่มี -> "$cell" ใช้ "default" (ค่าตอนกดบันทึก) เช่นตอนแสดงผลทับ
+        if isinstance(val, dict) and "$result" in val:
+            with self._lock:
+                hit = self._db.execute("SELECT status, result FROM outbox WHERE key = ?", (val["$result"],)).fetchone()
+            if not hit or hit[0] != "done": return self.resolve(val.get("default", ""), cells)
+            res = json.loads(hit[1])
+            # งาน image_upload คืนลิงก์หลายขนาด เลือกด้วย "field"
+            return res.get(val["field"], "") if "field" in val and isinstance(res, dict) else res
+        if isinstance(val, dict) and "$cell" in val:
+            if cells is None: return self.resolve(val.get("default", ""), cells)
+            cur = clean_val(cells.get(val["$cell"]))
+            if not cur and "fill" in val:
+                cur = ",".join("-" for p in clean_val(cells.get(val["fill"])).split(",") if p.strip() and p.strip() not in ["0", "None", "nan"])
+            return cur
+        if isinstance(val, dict) and "$join" in val:
+            parts = [str(self.resolve(p, cells)).strip() for p in val["$join"]]
+            return ",".join(p for p in parts if p and p.lower() != "nan")
+        if isinstance(val, dict): return {k: self.resolve(v, cells) for k, v in val.items()}
+        if isinstance(val, list): return [self.resolve(v, cells) for v in val]
+        return val
+
+    @staticmethod
+    def cell_columns(val):
+        # คอลัมน์ที่ "$cell" ต้องอ่านจากแถวจริงก่อนส่ง
+        if isinstance(val, dict) and "$cell" in val: return {val["$cell"]} | ({val["fill"]} if "fill" in val else set())
+        if isinstance(val, dict): return set().union(*map(WriteQueue.cell_columns, val.values()))
+        if isinstance(val, list): return set().union(*map(WriteQueue.cell_columns, val))
+        return set()
+
+    # --- ฝั่ง Worker ---
+    def _ready_ops(self):
+        # คืนงานที่พร้อมส่งทั้งหมด (ตามลำดับ) + เวลาที่ต้องรอถ้ายังไม่มีงานพร้อม
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, key, kind, target, payload, deps, blob, attempts, next_at FROM outbox WHERE status = 'pending' ORDER BY id").fetchall()
+            blocked, wait, ready = set(), 5, []
+            for row in rows:
+                op_id, key, kind, target, payload, deps, blob, attempts, next_at = row
+                # งานเป้าหมายเดียวกัน (แถวเดียวกัน) ต้องส่งตามลำดับ
+                if target and target in blocked: continue
+                if target: blocked.add(target)
+                deps = json.loads(deps)
+                if deps:
+                    marks = ",".join("?" * len(deps))
+                    waiting = self._db.execute(f"SELECT COUNT(*) FROM outbox WHERE key IN ({marks}) AND status = 'pending'", deps).fetchone()[0]
+                    if waiting: continue
+                if next_at <= time.time(): ready.append(row)
+                else: wait = min(wait, next_at - time.time())
+        return ready, (0 if ready else wait)
+
+    def _apply(self, kind, payload, blob):
+        cells = None
+        if kind == "patch_case" and self.cell_columns(payload["changes"]):
+            # อ่านค่าปัจจุบันของแถวก่อน (Worker ส่งทีละงาน -> ไม่มีงานอื่นแทรกระหว่างอ่านกับเขียน)
+            cells = self.storage.read_case_cells(payload["sheet"], payload["report_id"], sorted(self.cell_columns(payload["changes"])))
+        payload = self.resolve(payload, cells)
+        if kind == "patch_case":
+            self.storage.patch_case(payload["sheet"], payload["report_id"], payload["changes"])
+            # ไฟล์ข้ามปี (1.9) ไม่โหลดปีเก่าใหม่เอง -> แก้ตาม (ผิดพลาดตรงนี้ไม่ทำให้งานที่ส่งสำเร็จแล้วต้องส่งซ้ำ)
+            try: get_case_year_store().apply_patch(payload["sheet"], payload["report_id"], payload["changes"])
+            except Exception as e: print(f"Case cache patch error ({payload['sheet']}): {e}")
+        elif kind == "vehicle_range":
+            self.storage.update_vehicles(payload["range"], payload["values"], std_id=payload.get("std_id"))
+        elif kind == "vehicle_patch":
+            self.storage.patch_vehicle(payload["row"], payload["changes"], std_id=payload.get("std_id"))
+        else:
+            raise ValueError(f"ไม่รู้จักงานประเภท {kind}")
+        return None
+
+    def _finish(self, op, result=None, error=None):
+        op_id, key, kind, target, payload, deps, blob, attempts, next_at = op
+        if error is None:
+            with self._lock, self._db:
+                self._db.execute("UPDATE outbox SET status = 'done', result = ?, error = NULL, blob = NULL, done_at = ? WHERE id = ?",
+                                 (json.dumps(result, ensure_ascii=False), time.time(), op_id))
+                self._db.execute("DELETE FROM outbox WHERE status = 'done' AND done_at < ?", (time.time() - 7 * 86400,))
+            return
+        attempts += 1
+        delay = min(WRITE_QUEUE_MAX_DELAY, 2 ** attempts) + random.uniform(0, 1)
+        status = "failed" if attempts >= WRITE_QUEUE_MAX_ATTEMPTS else "pending"
+        print(f"Write queue error ({kind} {key[:8]}, ครั้งที่ {attempts}): {error}")
+        with self._lock, self._db:
+            self._db.execute("UPDATE outbox SET status = ?, attempts = ?, next_at = ?, error = ? WHERE id = ?",
+                             (status, attempts, time.time() + delay, str(error), op_id))
+
+    def _upload_batch(self, ops):
+        # image_upload: แปลงเป็น full/md/sm ใน process pool ก่อน แล้วอัปโหลดทุกไฟล์ของทุกงานพร้อมกัน
+        futs = {op[0]: pool_submit(get_image_pool, image_pipeline.make_variants, op[6]) for op in ops}
+        items, owners = [], []
+        for op in ops:
+            payload = json.loads(op[4])
+            base = payload["filename"].rsplit(".", 1)[0]
+            try:
+                try:
+                    variants = futs[op[0]].result()
+                except BrokenProcessPool:
+                    # worker ตายระหว่างแปลง (งานอื่นใน pool ล้มไปด้วย) -> แปลงใหม่ใน pool ใหม่หนึ่งครั้ง
+                    variants = pool_submit(get_image_pool, image_pipeline.make_variants, op[6]).result()
+                variants = {v: (data, f"{base}.jpg" if v == "full" else f"{base}_{v}.jpg", "image/jpeg") for v, data in variants.items()}
+            except Exception as e:
+                # เปิดรูปไม่ได้ (เช่น HEIC) -> ส่งไฟล์ต้นฉบับไปแทน ไม่มีรูปย่อ
+                print(f"Image pipeline error ({payload['filename']}): {e}")
+                variants = {"full": (op[6], payload["filename"], payload["mime"])}
+            for v, item in variants.items():
+                items.append(item); owners.append((op[0], v))
+        links = {}
+        for (op_id, v), res in zip(owners, upload_files_parallel(items)):
+            links.setdefault(op_id, {})[v] = res
+        for op in ops:
+            got = links[op[0]]
+            if got["full"][1]:
+                self._finish(op, error=got["full"][1])
+            else:
+                # รูปย่ออัปโหลดไม่สำเร็จใช้รูปเต็มแทน (ไม่ต้องส่งซ้ำทั้งชุด)
+                full = got["full"][0]
+                md, sm = [(got.get(v) or (None,))[0] or full for v in ("md", "sm")]
+                self._finish(op, {"full": full, "md": md, "sm": sm, "thumbs": f"{md}|{sm}" if "md" in got else "-"})
+
+    def _run(self):
+        while True:
+            try:
+                ready, wait = self._ready_ops()
+                if not ready:
+                    self._wake.wait(wait)
+                    self._wake.clear()
+                    continue
+                # รูปที่พร้อมส่งทั้งหมดอัปโหลดพร้อมกัน (ไม่มีลำดับระหว่างกัน) งานเขียนชีตทำทีละงาน
+                uploads = [op for op in ready if op[2] == "image_upload"][:UPLOAD_WORKERS]
+                if uploads:
+                    self._upload_batch(uploads)
+                    continue
+                op = ready[0]
+                try:
+                    self._finish(op, self._apply(op[2], json.loads(op[4]), op[6]))
+                except Exception as e:
+                    self._finish(op, error=e)
+            except Exception as e:
+                # ข้อผิดพลาดนอกงาน (เช่น outbox ล็อก/ดิสก์เต็ม) ต้องไม่ทำให้ Worker หยุดถาวร -> log แล้วพักก่อนวนใหม่
+                print(f"Write queue worker error: {type(e).__name__}: {e}")
+                time.sleep(5)
+
+@st.cache_resource
+def get_write_queue():
+    return WriteQueue(st.secrets.get("OUTBOX_PATH", os.path.join(BASE_DIR, "portal_outbox.db")), get_storage())
+
+def track_write(scope, key, label):
+    # จำงานที่ผู้ใช้คนนี้ส่งไว้ เพื่อแสดงสถานะในหน้าจอ
+    ops = st.session_state.setdefault("write_ops", {}).setdefault(scope, [])
+    if key not in [k for k, _ in ops]: ops.append((key, label))
+    del ops[:-10]
+
+def wait_for_writes(ops, timeout=30):
+    # แสดงความคืบหน้ารายไฟล์ระหว่างคิวอัปโหลด (ถ้าเกินเวลา ระบบยังส่งต่อเบื้องหลัง ออกจากหน้าได้)
+    if not ops: return {}
+    bar = st.progress(0.0); box = st.empty(); deadline = time.time() + timeout
+    while True:
+        stats = get_write_queue().status([k for k, _ in ops])
+        n_done = sum(1 for k, _ in ops if stats.get(k, {}).get("status") in ("done", "failed"))
+        bar.progress(n_done / len(ops), text=f"📤 อัปโหลดแล้ว {n_done}/{len(ops)} ไฟล์")
+        box.caption("  \n".join(f"{WRITE_STATUS_TEXT.get(stats.get(k, {}).get('status', 'pending'))} · {label}" for k, label in ops))
+        if n_done == len(ops) or time.time() > deadline: return stats
+        time.sleep(0.3)
+
+def render_write_status(scope):
+    ops = st.session_state.get("write_ops", {}).get(scope)
+    if not ops: return
+    stats = get_write_queue().status([k for k, _ in ops])
+    n_wait = sum(1 for k, _ in ops if stats.get(k, {}).get("status") == "pending")
+    with st.expander(f"📤 สถานะการบันทึก ({n_wait} รายการรอส่ง)", expanded=n_wait > 0):
+        for k, label in ops:
+            info = stats.get(k, {"status": "pending", "error": None, "attempts": 0})
+            line = f"{WRITE_STATUS_TEXT.get(info['status'], info['status'])} · {label}"
+            if info["error"] and info["status"] != "done": line += f" (ลองแล้ว {info['attempts']} ครั้ง: {info['error']})"
+            st.caption(line)
+        if n_wait and st.button("🔄 ตรวจสอบสถานะ", key=f"write_status_{scope}"): st.rerun()
+
+# ==========================================
+# 1.7 BACKGROUND DOCUMENT RENDERING (สร้าง PDF นอกเธรดหน้าเว็บ + แคชผลตามเนื้อหา)
+# ==========================================
+class RenderJobs:
+    # key เดียวกัน (เนื้อหาเดิม) ใช้ผลเดิมได้ทันที เก็บไว้ล่าสุด max_items งาน
+    def __init__(self, workers=2, max_items=64):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf-render")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_items = max_items
+
+    def get(self, key):
+        with self._lock:
+            fut = self._jobs.get(key)
+            if fut is not None: self._jobs.move_to_end(key)
+            return fut
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            fut = self._jobs.get(key)
+            # งานที่เคยล้มเหลวให้สร้างใหม่ได้
+            if fut is None or (fut.done() and fut.exception() is not None):
+                fut = self._jobs[key] = self._pool.submit(fn, *args)
+            self._jobs.move_to_end(key)
+            while len(self._jobs) > self.max_items: self._jobs.popitem(last=False)
+            return fut
+
+@st.cache_resource
+def get_render_jobs():
+    return RenderJobs()
+
+def wait_for_job(fut, label):
+    # ไม่รู้เวลาที่เหลือจริง แถบจะค่อยๆ เข้าใกล้ 95% จนกว่างานเสร็จ
+    if fut.done(): return
+    bar = st.progress(0.0, text=label); t0 = time.time()
+    while not fut.done():
+        el = time.time() - t0
+        bar.progress(min(0.95, el / (el + 3)), text=f"{label} ({el:.0f} วินาที)")
+        time.sleep(0.2)
+    bar.empty()
+
+# --- ส่งออก PDF ทีละมากๆ: เตรียมข้อมูล (โหลดรูป) ในเธรด -> จัดหน้าใน process pool -> เขียนลงไฟล์ชั่วคราวทันที ---
+BULK_EXPORT_WORKERS = int(st.secrets.get("BULK_EXPORT_WORKERS", max(1, min(4, os.cpu_count() or 1))))
+BULK_EXPORT_DIR = os.path.join(tempfile.gettempdir(), "portal_exports")
+# PdfWriter ถือทุกหน้าไว้ในหน่วยความจำตอนรวมไฟล์ ใหญ่กว่านี้ส่งเป็น ZIP แทน
+BULK_MERGE_MAX_MB = int(st.secrets.get("BULK_MERGE_MAX_MB", 100))
+
+@st.cache_resource
+def get_pdf_process_pool():
+    return ProcessPoolExecutor(max_workers=BULK_EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def safe_filename(name):
+    return re.sub(r'[\\/:*?"<>|\s]+', '_', str(name)).strip('_') or "document"
+
+def bulk_export_pdfs(jobs, fmt="zip", on_progress=None):
+    # jobs = [(ชื่อไฟล์, prepare)] โดย prepare() -> (ฟังก์ชันเรนเดอร์ใน pdf_documents, args)
+    # ถือผลไว้ในหน่วยความจำไม่เกิน 2 เท่าของจำนวน worker คืน (path ไฟล์ผลลัพธ์, เอกสารที่ล้มเหลว, คำเตือน)
+    os.makedirs(BULK_EXPORT_DIR, exist_ok=True)
+    for old in glob.glob(os.path.join(BULK_EXPORT_DIR, "*")):
+        if os.path.getmtime(old) < time.time() - 86400: shutil.rmtree(old, ignore_errors=True) if os.path.isdir(old) else os.remove(old)
+    window = BULK_EXPORT_WORKERS * 2
+    fd, out_path = tempfile.mkstemp(suffix=".zip" if fmt == "zip" else ".pdf", dir=BULK_EXPORT_DIR); os.close(fd)
+    parts_dir = tempfile.mkdtemp(dir=BULK_EXPORT_DIR) if fmt == "pdf" else None
+    errors, warnings, parts, done = [], [], [], 0
+
+    def run(job):
+        fn, args = job[1]()
+        try:
+            return pool_submit(get_pdf_process_pool, fn, *args).result()
+        except BrokenProcessPool:
+            # worker ตายกลางงาน (งานที่ค้างใน pool ล้มพร้อมกัน) -> ส่งใหม่ใน pool ใหม่หนึ่งครั้ง
+            return pool_submit(get_pdf_process_pool, fn, *args).result()
+
+    zf = zipfile.ZipFile(out_path, "w", zipfile.ZIP_DEFLATED) if fmt == "zip" else None
+    try:
+        def consume(name, fut):
+            nonlocal done
+            try:
+                res = fut.result()
+                data, warns = res if isinstance(res, tuple) else (res, [])
+                warnings.extend(f"{name}: {w}" for w in warns)
+                if zf is not None: zf.writestr(name, data)
+                else:
+                    part = os.path.join(parts_dir, f"{len(parts):05d}.pdf")
+                    with open(part, "wb") as f: f.write(data)
+                    parts.append((name, part))
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+            done += 1
+            if on_progress: on_progress(done, len(jobs), name)
+
+        with ThreadPoolExecutor(max_workers=window) as io_pool:
+            inflight = deque()
+            for job in jobs:
+                inflight.append((job[0], io_pool.submit(run, job)))
+                if len(inflight) >= window: consume(*inflight.popleft())
+            while inflight: consume(*inflight.popleft())
+    finally:
+        if zf is not None: zf.close()
+
+    if parts_dir:
+        if sum(os.path.getsize(p) for _, p in parts) > BULK_MERGE_MAX_MB * 1024 * 1024:
+            # ใหญ่เกินรวมในหน่วยความจำ -> ZIP (zipfile อ่านจากดิสก์ทีละก้อน ไม่ถือทั้งไฟล์)
+            os.remove(out_path); out_path = out_path[:-len(".pdf")] + ".zip"
+            with zipfile.ZipFile(out_path, "w", zipfile.ZIP_DEFLATED) as zf:
+                for name, part in parts: zf.write(part, name)
+            warnings.append(f"เอกสารรวมใหญ่เกิน {BULK_MERGE_MAX_MB} MB จึงส่งออกเป็น ZIP แยกไฟล์แทน")
+        else:
+            # รวมเป็นไฟล์เดียวตามลำดับเดิม
+            writer = PdfWriter()
+            for _, part in parts: writer.append(part)
+            with open(out_path, "wb") as f: writer.write(f)
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    return out_path, errors, warnings
+
+def render_bulk_export(key, label, make_jobs, file_name):
+    # แผงส่งออก PDF ใช้ร่วมกันทั้งงานสอบสวนและงานจราจร (make_jobs เรียกเมื่อกดเริ่มเท่านั้น)
+    formats = ["ZIP (แยกไฟล์)"] + ([f"PDF รวมไฟล์เดียว (ไม่เกิน {BULK_MERGE_MAX_MB} MB)"] if PdfWriter else [])
+    c_fmt, c_go = st.columns([2, 1])
+    fmt = c_fmt.radio("รูปแบบไฟล์", formats, horizontal=True, key=f"{key}_fmt")
+    if c_go.button(f"🖨️ {label}", key=f"{key}_go", use_container_width=True):
+        old = st.session_state.pop(f"{key}_result", None)
+        if old and os.path.exists(old[0]): os.remove(old[0])
+        jobs = make_jobs(); ext = "zip" if fmt.startswith("ZIP") else "pdf"
+        bar = st.progress(0.0, text=f"🖨️ กำลังเตรียม {len(jobs)} เอกสาร...")
+        t0 = time.time()
+        path, errors, warnings = bulk_export_pdfs(jobs, ext, lambda n, total, name: bar.progress(n / total, text=f"🖨️ {n}/{total} · {name}"))
+        bar.empty()
+        # ไฟล์รวมที่ใหญ่เกินจะได้ ZIP กลับมา ใช้นามสกุลจากไฟล์จริง
+        st.session_state[f"{key}_result"] = (path, errors, warnings, f"{file_name}{os.path.splitext(path)[1]}", len(jobs), time.time() - t0)
+    res = st.session_state.get(f"{key}_result")
+    if res and os.path.exists(res[0]):
+        path, errors, warnings, fname, n, secs = res
+        st.success(f"✅ ส่งออก {n - len(errors)} / {n} เอกสาร ใน {secs:.0f} วินาที")
+        with open(path, "rb") as f:
+            st.download_button(f"📥 ดาวน์โหลด {fname}", f, file_name=fname, mime="application/zip" if fname.endswith(".zip") else "application/pdf", use_container_width=True, key=f"{key}_dl")
+        if errors or warnings:
+            with st.expander(f"⚠️ ล้มเหลว {len(errors)} เอกสาร / คำเตือน {len(warnings)} รายการ"):
+                for e in errors: st.caption(f"❌ {e}")
+                for w in warnings: st.caption(f"⚠️ {w}")
+
+# ==========================================
+# 1.8 SEARCH INDEXES (สร้างครั้งเดียวต่อเวอร์ชันข้อมูล ใช้ร่วมทุกผู้ใช้)
+# ==========================================
+THAI_TONE_MARKS = "\u0e48\u0e49\u0e4a\u0e4b"
+_ZERO_WIDTH = dict.fromkeys(map(ord, "\u200b\u200c\u200d\u2060\ufeff"), None)
+_THAI_MARKS_RE = re.compile("[\u0e31\u0e34-\u0e3a\u0e47-\u0e4e]{2,}")
+
+def _mark_rank(ch):
+    # ลำดับมาตรฐานของเครื่องหมายที่ซ้อนกัน: สระบน/ล่าง -> ไม้ไต่คู้ -> วรรณยุกต์ -> การันต์ และอื่นๆ
+    if ch in "\u0e31\u0e34\u0e35\u0e36\u0e37\u0e38\u0e39\u0e3a": return 0
+    if ch == "\u0e47": return 1
+    if ch in THAI_TONE_MARKS: return 2
+    return 3
+
+def normalize_search_text(text, strip_tones=False):
+    # ข้อความสำหรับค้นหา: ตัวเล็ก, ตัดอักขระล่องหน, สระอำพิมพ์แยก (ํา) -> ำ, เรียงวรรณยุกต์/สระซ้อนให้เหมือนกัน
+    s = unicodedata.normalize("NFKC", str(text)).translate(_ZERO_WIDTH).lower()
+    s = re.sub("\u0e4d([\u0e48-\u0e4b]?)\u0e32", "\\1\u0e33", s)
+    if strip_tones: s = re.sub(f"[{THAI_TONE_MARKS}\u0e4c]", "", s)
+    s = _THAI_MARKS_RE.sub(lambda m: "".join(sorted(dict.fromkeys(m.group()), key=_mark_rank)), s)
+    return re.sub(r"\s+", " ", s).strip()
+
+def parse_search_query(query, aliases):
+    # 'ผู้แจ้ง:สมชาย สถานที่:"โรง อาหาร" ทะเลาะ' -> [('Reporter', 'สมชาย'), ('Location', 'โรง อาหาร'), (None, 'ทะเลาะ')]
+    terms = []
+    for m in re.finditer(r'(?:([^\s:"]+):)?(?:"([^"]*)"|(\S+))', str(query)):
+        field, value = m.group(1), m.group(2) if m.group(2) is not None else m.group(3)
+        if field and field.lower() not in aliases: field, value = None, f"{field}:{value}"
+        terms.append((aliases[field.lower()] if field else None, value))
+    return terms
+
+CASE_SEARCH_FIELDS = ['Report_ID', 'Reporter', 'Victim', 'Accused', 'Witness', 'Details', 'Location', 'Incident_Type', 'Statement']
+CASE_SEARCH_ALIASES = {
+    "id": "Report_ID", "เลข": "Report_ID", "เลขที่": "Report_ID", "reporter": "Reporter", "ผู้แจ้ง": "Reporter",
+    "victim": "Victim", "ผู้เสียหาย": "Victim", "accused": "Accused", "ผู้ถูกกล่าวหา": "Accused", "witness": "Witness", "พยาน": "Witness",
+    "details": "Details", "รายละเอียด": "Details", "location": "Location", "สถานที่": "Location",
+    "type": "Incident_Type", "ประเภท": "Incident_Type", "statement": "Statement", "ผลสอบ": "Statement",
+}
+
+class CaseSearchIndex:
+    # เก็บข้อความที่ normalize แล้วของช่องที่มีความหมายเท่านั้น (ไม่สแกนรูป base64 / ทุกคอลัมน์ทุกครั้ง)
+    def __init__(self, df):
+        self.index = df.index
+        self.fields = {c: (df[c].astype(str).map(normalize_search_text) if c in df.columns else pd.Series("", index=df.index))
+                       for c in CASE_SEARCH_FIELDS}
+        self.all = pd.Series(["\x1f".join(vals) for vals in zip(*self.fields.values())], index=df.index, dtype=object)
+
+    def search(self, query):
+        # ทุกคำต้องพบ (AND) คำที่ระบุช่องค้นเฉพาะช่องนั้น คืน boolean Series ตาม index ของข้อมูล
+        mask = pd.Series(True, index=self.index)
+        for field, term in parse_search_query(query, CASE_SEARCH_ALIASES):
+            term = normalize_search_text(term)
+            if term: mask &= (self.fields[field] if field else self.all).str.contains(term, regex=False)
+        return mask
+
+@st.cache_resource
+def _search_index_registry():
+    return {"lock": threading.Lock(), "items": OrderedDict()}
+
+def cached_search_index(key, version, build, max_items=8):
+    # ดัชนีของข้อมูลเวอร์ชันเดิมใช้ซ้ำได้ทันที (เก็บล่าสุด max_items ชุด)
+    reg = _search_index_registry()
+    with reg["lock"]:
+        hit = reg["items"].get((key, version))
+        if hit is not None:
+            reg["items"].move_to_end((key, version))
+            return hit
+    idx = build()
+    with reg["lock"]:
+        reg["items"][(key, version)] = idx
+        while len(reg["items"]) > max_items: reg["items"].popitem(last=False)
+    return idx
+
+def frame_version(df, cols):
+    # เวอร์ชันข้อมูล = hash ของคอลัมน์ที่ใช้ (เปลี่ยนเมื่อเนื้อหาเปลี่ยน)
+    cols = [c for c in cols if c in df.columns]
+    return (len(df), int(pd.util.hash_pandas_object(df[cols].astype(str), index=True).sum())) if cols else (len(df), 0)
+
+def frame_version_cached(df, cols):
+    # สำหรับตารางที่ถูกแทนที่ทั้งก้อนเมื่อโหลดใหม่ (ไม่แก้ในที่) เช่น df_tra: object เดิม = เวอร์ชันเดิม ไม่ต้อง hash ซ้ำทุก rerun
+    reg = _search_index_registry()
+    key = (id(df), tuple(cols))
+    with reg["lock"]:
+        memo = reg.setdefault("versions", {})
+        hit = memo.get(key)
+        if hit is not None and hit[0]() is df: return hit[1]
+    version = frame_version(df, cols)
+    with reg["lock"]:
+        if len(memo) > 32:
+            for k in [k for k, (ref, _) in memo.items() if ref() is None]: memo.pop(k)
+        memo[key] = (weakref.ref(df), version)
+    return version
+
+def get_case_search_index(sheet_name, df):
+    return cached_search_index(f"case:{sheet_name}", frame_version(df, CASE_SEARCH_FIELDS), lambda: CaseSearchIndex(df))
+
+# --- ทะเบียนรถ: ดัชนี n-gram ของชื่อ / รหัส / ทะเบียน (ทนพิมพ์ผิด + จัดอันดับความตรง) ---
+NAME_TITLES_RE = re.compile(r"^(นางสาว|นาย|นาง|เด็กชาย|เด็กหญิง|ด\.ช\.|ด\.ญ\.|น\.ส\.)")
+PLATE_CORE_RE = re.compile(r"\d?[ก-ฮ]{1,3}\d{1,4}")
+
+def name_key(name):
+    # ตัดคำนำหน้า / วรรณยุกต์ / ช่องว่าง -> พิมพ์วรรณยุกต์ผิดหรือเว้นวรรคต่างกันก็ยังตรงกัน
+    return NAME_TITLES_RE.sub("", normalize_search_text(name, strip_tones=True)).replace(" ", "")
+
+def plate_key(plate):
+    # "1กข 1234 ขอนแก่น" / "1กข-1234" -> "1กข1234" (ตัดเว้นวรรค เครื่องหมาย และชื่อจังหวัดท้ายทะเบียน)
+    s = re.sub(r"[\s\-\.]", "", normalize_search_text(plate))
+    m = PLATE_CORE_RE.match(s)
+    return m.group() if m else s
+
+def ngrams(s, n=3):
+    return {s[i:i + n] for i in range(len(s) - n + 1)} if len(s) >= n else ({s} if s else set())
+
+def posting_grams(s):
+    # 3-gram (คำค้นยาว/ใกล้เคียง) + 2-gram (คำค้น 2 ตัว) + "^ตัวแรก" (คำค้นตัวเดียว = ขึ้นต้นด้วย)
+    return ngrams(s) | ngrams(s, 2) | ({"^" + s[0]} if s else set())
+
+def partial_ratio(q, target):
+    # ความคล้ายของคำค้นกับช่วงที่ตรงที่สุดในข้อความ (คำค้นสั้นกว่าชื่อเต็ม)
+    if len(q) >= len(target): return difflib.SequenceMatcher(None, q, target).ratio()
+    return max(difflib.SequenceMatcher(None, q, target[i:i + len(q)]).ratio() for i in range(len(target) - len(q) + 1))
+
+class VehicleSearchIndex:
+    # ใช้ร่วมทุกผู้ใช้ คีย์ของแต่ละคน = รหัสนักเรียน#ลำดับที่ซ้ำ อัปเดตเฉพาะแถวที่เปลี่ยนเมื่อโหลดข้อมูลใหม่
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.raw, self.keys, self.rows = {}, {}, {}
+        self.grams = defaultdict(set)  # (ชนิด, gram) -> คีย์ ; ชนิด 0 = ชื่อ, 1 = รหัส, 2 = ทะเบียน
+        self._df = None
+
+    def _refresh(self, df):
+        if df is self._df: return 0, 0  # ตารางเดิม (ยังไม่ได้โหลดใหม่) ไม่ต้องเทียบทุกแถว
+        rows, seen, changed = {}, Counter(), []
+        for pos, raw in enumerate(zip(df.iloc[:, 1].astype(str), df.iloc[:, 2].astype(str).str.strip(), df.iloc[:, 6].astype(str))):
+            seen[raw[1]] += 1; ent = f"{raw[1]}#{seen[raw[1]]}"
+            rows[ent] = pos
+            if self.raw.get(ent) != raw: changed.append((ent, raw))
+        removed = [ent for ent in self.raw if ent not in rows]
+        for ent in removed + [ent for ent, _ in changed]:
+            for kind in (0, 1, 2):
+                for g in posting_grams(self.keys.get(ent, ("", "", ""))[kind]):
+                    post = self.grams.get((kind, g))
+                    if post is None: continue
+                    post.discard(ent)
+                    if not post: del self.grams[(kind, g)]  # ไม่ให้ดัชนีโตขึ้นเรื่อยๆ ด้วยชุดว่าง
+            self.raw.pop(ent, None); self.keys.pop(ent, None)
+        for ent, raw in changed:
+            self.raw[ent] = raw
+            self.keys[ent] = keys = (name_key(raw[0]), raw[1].lower(), plate_key(raw[2]))
+            for kind in (0, 1, 2):
+                for g in posting_grams(keys[kind]): self.grams[(kind, g)].add(ent)
+        self.rows, self._df = rows, df
+        return len(changed), len(removed)
+
+    def refresh(self, df):
+        with self._lock: return self._refresh(df)
+
+    def _candidates(self, kind, key):
+        # คีย์ที่อาจมี key อยู่ข้างใน: ทุก gram ของคำค้นต้องอยู่ในคีย์นั้น (ตรวจซ้ำตอนให้คะแนน)
+        if len(key) < 3: return self.grams.get((kind, key if len(key) == 2 else "^" + key), set())
+        posts = sorted((self.grams.get((kind, g), set()) for g in ngrams(key)), key=len)
+        return posts[0].intersection(*posts[1:])
+
+    def search(self, df, q, min_sim=0.75):
+        # คืน [(ตำแหน่งแถวใน df, คะแนน)] เรียงจากตรงที่สุด: รหัสตรง > ทะเบียนตรง > ขึ้นต้น/มีคำค้น > ใกล้เคียง (พิมพ์ผิด)
+        nq, iq, pq = name_key(q), str(q).strip().lower(), plate_key(q)
+        scores = {}
+        def bump(ent, s):
+            if s > scores.get(ent, 0): scores[ent] = s
+        with self._lock:
+            self._refresh(df)
+            # ให้คะแนนเฉพาะคีย์ที่ดึงมาจากดัชนี ไม่วนทุกคน
+            for ent in self._candidates(1, iq) if iq else ():
+                ik = self.keys[ent][1]
+                if ik == iq: bump(ent, 100)
+                elif ik.startswith(iq): bump(ent, 90)
+            for ent in self._candidates(2, pq) if pq else ():
+                pk = self.keys[ent][2]
+                if pk == pq: bump(ent, 95)
+                elif len(pq) >= 2 and pq in pk: bump(ent, 80)
+            for ent in self._candidates(0, nq) if nq else ():
+                nk = self.keys[ent][0]
+                if nk.startswith(nq): bump(ent, 75)
+                elif nq in nk: bump(ent, 70)
+            for kind, key in ((0, nq), (2, pq)):
+                # ทะเบียนต้องมีตัวอักษรไทยด้วย ไม่งั้นเลขรหัสล้วนจะไปคล้ายตัวเลขท้ายทะเบียนทุกคัน
+                if len(key) < 3 or (kind == 2 and not re.search(r"[ก-ฮ]", key)): continue
+                grams = ngrams(key)
+                counts = Counter(ent for g in grams for ent in self.grams.get((kind, g), ()))
+                for ent, c in counts.items():
+                    if ent in scores or c / len(grams) < 0.3: continue
+                    sim = partial_ratio(key, self.keys[ent][kind])
+                    if sim >= min_sim: bump(ent, round(40 + 25 * sim))
+            rows = self.rows
+        return sorted(((rows[e], s) for e, s in scores.items()), key=lambda x: (-x[1], x[0]))
+
+@st.cache_resource
+def get_vehicle_index():
+    return VehicleSearchIndex()
+
+# --- ทะเบียนรถ: facet (ระดับชั้น / ยี่ห้อ / เอกสารขาด) + bitmap ของแถว คำนวณครั้งเดียวต่อเวอร์ชันข้อมูล ---
+TRA_RISKS = {"❌ ไม่มีใบขับขี่": 7, "❌ ภาษีขาด": 8, "❌ ไม่สวมหมวก": 9}  # ตัวเลือก -> คอลัมน์ที่ตรวจ
+
+class TrafficFacets:
+    def __init__(self, df):
+        self.n = len(df)
+        self.bitmaps, self.counts = {}, {}
+        self.lv = df.iloc[:, 3].astype(str).str.split('/').str[0].str.strip()
+        for name, col in (("lv", self.lv), ("br", df.iloc[:, 4].astype(str).str.strip())):
+            codes, uniques = pd.factorize(col, sort=True)
+            for i, v in enumerate(uniques):
+                self.bitmaps[(name, v)] = codes == i
+            self.counts[name] = {v: int(np.count_nonzero(self.bitmaps[(name, v)])) for v in uniques}
+        self.counts["risk"] = {}
+        for label, idx in TRA_RISKS.items():
+            bm = df.iloc[:, idx].astype(str).str.contains("ไม่มี|ขาด").to_numpy() if df.shape[1] > idx else np.zeros(self.n, bool)
+            self.bitmaps[("risk", label)] = bm
+            self.counts["risk"][label] = int(np.count_nonzero(bm))
+
+    def values(self, name):
+        return list(self.counts[name])
+
+    def label(self, name, v):
+        # "ม.4 (132)"
+        return f"{v} ({self.counts[name][v]:,})" if v in self.counts.get(name, {}) else v
+
+    def select(self, **facets):
+        # AND ของ bitmap ตามตัวกรองที่เลือก (ค่า None / "ทั้งหมด" = ไม่กรอง)
+        mask = np.ones(self.n, bool)
+        for name, v in facets.items():
+            if v in (None, "ทั้งหมด"): continue
+            bm = self.bitmaps.get((name, v))
+            if bm is None: return np.zeros(self.n, bool)
+            mask &= bm
+        return mask
+
+def get_traffic_facets(df):
+    return cached_search_index("tra:facets", frame_version_cached(df, [df.columns[i] for i in (3, 4, 7, 8, 9) if i < df.shape[1]]), lambda: TrafficFacets(df), max_items=4)
+
+# --- ทะเบียนรถ: สรุปแดชบอร์ด (groupby แบบ vectorized บนคอลัมน์ boolean) แคชตามเวอร์ชันข้อมูล ---
+TRA_DASH_BREAKDOWNS = {"ระดับชั้น/กลุ่ม": "LV", "ห้องเรียน": "Room", "ยี่ห้อรถ": "Brand"}
+TRA_DASH_FORMATS = {
+    'คะแนนเฉลี่ย': '{:.2f}', 'ใบขับขี่ (%)': '{:.1f}%', 'ภาษีปกติ (%)': '{:.1f}%', 'สวมหมวก (%)': '{:.1f}%',
+    'จำนวนรถ': '{:,.0f}', 'ใบขับขี่ (คน)': '{:,.0f}', 'ภาษีปกติ (คัน)': '{:,.0f}', 'สวมหมวก (คน)': '{:,.0f}'
+}
+
+def build_traffic_dashboard(df):
+    col = lambda name: df[name] if name in df.columns else pd.Series("", index=df.index)
+    room = col('C3').astype(str).str.strip()
+    base = pd.DataFrame({
+        'Score': pd.to_numeric(col('C13'), errors='coerce').fillna(100),
+        'LV': room.str.split('/').str[0], 'Room': room, 'Brand': col('C4').astype(str).str.strip(),
+        'lic': col('C7').eq("✅ มี"), 'tax': col('C8').astype(str).str.contains("ปกติ|✅"), 'hel': col('C9').eq("✅ มี"),
+    })
+    n = len(base)
+    pct = lambda x: (x / n * 100) if n > 0 else 0
+    out = {"total": n, "avg": base['Score'].mean() if n else 0, "at_risk": int((base['Score'] < 60).sum()),
+           "lic": int(base['lic'].sum()), "tax": int(base['tax'].sum()), "hel": int(base['hel'].sum()), "tables": {}}
+    out.update(lic_p=pct(out["lic"]), tax_p=pct(out["tax"]), hel_p=pct(out["hel"]))
+    for label, key in TRA_DASH_BREAKDOWNS.items():
+        g = base.groupby(key, sort=False).agg(n=('Score', 'size'), score=('Score', 'mean'), lic=('lic', 'sum'), tax=('tax', 'sum'), hel=('hel', 'sum'))
+        table = pd.DataFrame({
+            label: g.index, 'จำนวนรถ': g['n'], 'คะแนนเฉลี่ย': g['score'],
+            'ใบขับขี่ (คน)': g['lic'], 'ใบขับขี่ (%)': g['lic'] / g['n'] * 100,
+            'ภาษีปกติ (คัน)': g['tax'], 'ภาษีปกติ (%)': g['tax'] / g['n'] * 100,
+            'สวมหมวก (คน)': g['hel'], 'สวมหมวก (%)': g['hel'] / g['n'] * 100,
+        }).sort_values(['จำนวนรถ', label], ascending=[False, True])
+        for c, fmt in TRA_DASH_FORMATS.items(): table[c] = table[c].map(fmt.format)
+        out["tables"][label] = table.reset_index(drop=True)
+    return out
+
+def get_traffic_dashboard(df):
+    return cached_search_index("tra:dash", frame_version_cached(df, ['C3', 'C4', 'C7', 'C8', 'C9', 'C13']), lambda: build_traffic_dashboard(df), max_items=4)
+
+# --- สถิติคดี: ตัวนับสะสมต่อปีการศึกษา (สถานะ / สถานที่ / ประเภท / ชั่วโมง / วัน) อัปเดตเฉพาะแถวที่เพิ่มหรือเปลี่ยน ---
+# ใช้ร่วมกัน: การ์ดสรุปหน้าสอบสวน, แท็บสถิติรวม, แผนที่จุดเสี่ยง
+# แยกตัวนับตามแหล่งข้อมูล: "live" = ตารางที่อ่านจากชีต (หน้าสอบสวน), "year_cache" = ไฟล์รายปี 1.9 (แผนที่)
+# สองแหล่งของปีเดียวกันอาจไม่ตรงกันชั่วขณะ ถ้าใช้ตัวนับร่วมกันจะสลับกันล้าง/นับใหม่ทุกครั้งที่เปิดอีกหน้า
+INCIDENT_AGG_COLUMNS = {"status": "Status", "location": "Location", "type": "Incident_Type"}
+THAI_WEEKDAYS = ["จันทร์", "อังคาร", "พุธ", "พฤหัสบดี", "ศุกร์", "เสาร์", "อาทิตย์"]
+
+def incident_parts(df):
+    col = lambda name: df[name].fillna("").astype(str) if name in df.columns else pd.Series("", index=df.index)
+    raw = col('Timestamp').str.strip()
+    ts = pd.to_datetime(raw.str[:16], format="%d/%m/%Y %H:%M", errors="coerce")  # รูปแบบที่บันทึกจากระบบ (เร็ว)
+    odd = ts.isna() & raw.ne("")
+    if odd.any(): ts[odd] = pd.to_datetime(raw[odd], format="mixed", dayfirst=True, errors="coerce")
+    parts = pd.DataFrame({k: col(c) for k, c in INCIDENT_AGG_COLUMNS.items()}, index=df.index)
+    parts["hour"] = ts.dt.hour.astype("Int64").astype(object).where(ts.notna(), None)
+    parts["day"] = ts.dt.dayofweek.astype("Int64").astype(object).where(ts.notna(), None)
+    return parts
+
+class IncidentAggregates:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows = {}  # Report_ID#ลำดับ -> (hash ของแถว, ค่าที่นับ)
+        self.counts = {k: Counter() for k in list(INCIDENT_AGG_COLUMNS) + ["hour", "day"]}
+        self.version = None
+
+    def _add(self, parts, sign):
+        for field, v in zip(self.counts, parts):
+            if v is None or v == "": continue
+            c = self.counts[field]
+            c[v] += sign
+            if c[v] <= 0: del c[v]
+
+    def update(self, df):
+        # คืนสำเนาตัวนับของตาราง df (แถวที่ hash ไม่เปลี่ยนไม่ต้องคำนวณใหม่)
+        cols = [c for c in ['Report_ID', 'Timestamp'] + list(INCIDENT_AGG_COLUMNS.values()) if c in df.columns]
+        # ค่าว่าง/NaN และเลข Report_ID แบบ "12.0" ให้คีย์/hash เดียวกัน (ชนิดข้อมูลของตารางไม่ทำให้ต้องนับใหม่)
+        view = df[cols].fillna("").astype(str)
+        rid = view['Report_ID'].str.replace(r'\.0$', '', regex=True).str.strip() if 'Report_ID' in cols else pd.Series(df.index.astype(str), index=df.index)
+        keys = (rid + "#" + rid.groupby(rid).cumcount().astype(str)).tolist()
+        hashes = pd.util.hash_pandas_object(view.drop(columns=['Report_ID'], errors='ignore'), index=False).tolist()
+        version = (len(df), sum(hashes))
+        with self._lock:
+            if version != self.version:
+                live = set(keys)
+                for k in [k for k in self.rows if k not in live]:
+                    self._add(self.rows.pop(k)[1], -1)
+                changed = [i for i, (k, h) in enumerate(zip(keys, hashes)) if self.rows.get(k, (None,))[0] != h]
+                if changed:
+                    for i, parts in zip(changed, incident_parts(df.iloc[changed]).itertuples(index=False)):
+                        old = self.rows.get(keys[i])
+                        if old: self._add(old[1], -1)
+                        self._add(parts, 1)
+                        self.rows[keys[i]] = (hashes[i], tuple(parts))
+                self.version = version
+            return {k: Counter(c) for k, c in self.counts.items()}
+
+def get_incident_aggregates(source, sheet_name, df):
+    reg = _incident_aggregate_registry()
+    with reg["lock"]:
+        agg = reg["items"].setdefault((source, sheet_name), IncidentAggregates())
+    return agg.update(df)
+
+@st.cache_resource
+def _incident_aggregate_registry():
+    return {"lock": threading.Lock(), "items": {}}
+
+def top_count(counter, default="-"):
+    # ค่าที่พบบ่อยสุด (เสมอกันเลือกตามลำดับอักษร เหมือน Series.mode()[0])
+    return min(counter.items(), key=lambda kv: (-kv[1], kv[0]))[0] if counter else default
+
+def count_series(counter, index=None):
+    # Counter -> Series สำหรับ st.bar_chart (index = ลำดับแกนคงที่ เช่น ชั่วโมง/วัน)
+    if index is None: return pd.Series(counter, dtype="int64").sort_values(ascending=False)
+    return pd.Series([counter.get(k, 0) for k in index], index=index, dtype="int64")
+
+# ==========================================
+# 1.9 MULTI-YEAR CASE CACHE (ไฟล์คอลัมน์ต่อปีการศึกษา สำหรับวิเคราะห์ข้ามปี)
+# ==========================================
+# ชีต Investigation_<ปี> แต่ละปีถูกเก็บเป็นไฟล์ Parquet ในเครื่อง (ชนิดข้อมูลคงที่ อ่านเร็ว)
+# ปีเก่าไม่เปลี่ยนแล้ว -> โหลดครั้งเดียว ปีปัจจุบันโหลดใหม่เมื่อไฟล์เก่ากว่า CASE_CACHE_CURRENT_TTL
+# การแก้คดีผ่านคิว (ทุกปี) แก้แถวในไฟล์ตามทันทีที่ส่งสำเร็จ -> apply_patch
+CASE_CACHE_DIR = st.secrets.get("CASE_CACHE_DIR", os.path.join(BASE_DIR, "portal_case_cache"))
+CASE_CACHE_CURRENT_TTL = 600
+CASE_CACHE_WORKERS = 4
+CASE_SHEET_RE = re.compile(r"^Investigation_(\d{4})$")
+
+def case_sheet_year(sheet_name):
+    m = CASE_SHEET_RE.match(str(sheet_name))
+    return int(m.group(1)) if m else None
+
+def typed_case_frame(df, year):
+    # ทุกคอลัมน์เป็นข้อความ ยกเว้นพิกัด + เพิ่มเวลาที่แปลงแล้วและปีการศึกษา (ใช้กรอง/จัดกลุ่มข้ามปีได้ทันที)
+    df = df.fillna("").astype(str) if not df.empty else pd.DataFrame(columns=['Report_ID'])
+    if 'Report_ID' in df.columns: df['Report_ID'] = df['Report_ID'].str.replace(r'\.0$', '', regex=True).str.strip()
+    for c in ('lat', 'lon'):
+        if c in df.columns: df[c] = pd.to_numeric(df[c], errors='coerce')
+    raw = df['Timestamp'].str.strip() if 'Timestamp' in df.columns else pd.Series("", index=df.index)
+    ts = pd.to_datetime(raw.str[:16], format="%d/%m/%Y %H:%M", errors="coerce")
+    odd = ts.isna() & raw.ne("")
+    if odd.any(): ts[odd] = pd.to_datetime(raw[odd], format="mixed", dayfirst=True, errors="coerce")
+    df['Event_Time'] = ts
+    df['Academic_Year'] = pd.Series(year, index=df.index, dtype="int16")
+    return df
+
+class CaseYearStore:
+    def __init__(self, storage, root):
+        self.storage, self.root = storage, root
+        self._lock = threading.Lock()
+        self._sheets = (0, [])        # (เวลาที่ค้น, รายชื่อชีต)
+        self._frames = OrderedDict()  # ชื่อชีต -> (mtime ไฟล์, DataFrame)
+        self._errors = {}             # ชื่อชีต -> ข้อความผิดพลาดล่าสุด (แก้จากหลาย Thread ใช้ _lock)
+        self._write_lock = threading.Lock()  # เขียนไฟล์ Parquet ทีละงาน (_fetch / apply_patch)
+        self._patches = Counter()     # ชื่อชีต -> จำนวนครั้งที่แก้ไฟล์ (ตรวจว่า _fetch อ่านข้อมูลก่อนการแก้หรือไม่)
+        self._dirty = set()           # ชีตที่ไฟล์อาจไม่ตรงกับชีตจริง -> โหลดใหม่ครั้งถัดไป
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, sheet_name):
+        return os.path.join(self.root, f"{sheet_name}.parquet")
+
+    def version(self, sheet_names):
+        # เวอร์ชันข้อมูล = เวลาแก้ไขไฟล์ของแต่ละปี (ยังไม่มีไฟล์ = 0)
+        return tuple(os.path.getmtime(p) if os.path.exists(p) else 0 for p in map(self._path, sheet_names))
+
+    def sheets(self, max_age=600):
+        with self._lock:
+            born, names = self._sheets
+        if time.time() - born < max_age and names: return names
+        try:
+            names = sorted((s for s in self.storage.list_case_sheets() if case_sheet_year(s)), key=case_sheet_year)
+        except Exception:
+            # ค้นรายชื่อไม่ได้ -> ใช้ไฟล์ที่เคยเก็บไว้ + ปีปัจจุบัน
+            names = sorted({f[:-8] for f in os.listdir(self.root) if f.endswith(".parquet")} | {get_target_sheet_name()}, key=case_sheet_year)
+        with self._lock: self._sheets = (time.time(), names)
+        return names
+
+    def errors(self):
+        with self._lock: return dict(self._errors)
+
+    def _stale(self, sheet_name, force):
+        path = self._path(sheet_name)
+        if not os.path.exists(path): return True
+        with self._lock:
+            if sheet_name in self._dirty: return True
+        if sheet_name != get_target_sheet_name(): return False
+        return force or time.time() - os.path.getmtime(path) > CASE_CACHE_CURRENT_TTL
+
+    def _write(self, sheet_name, df):
+        tmp = self._path(sheet_name) + f".{threading.get_ident()}.tmp"
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, self._path(sheet_name))
+
+    def _fetch(self, sheet_name):
+        with self._write_lock: seq = self._patches[sheet_name]
+        df = typed_case_frame(pd.DataFrame(self.storage.read_cases(sheet_name, ttl=0)), case_sheet_year(sheet_name))
+        with self._write_lock:
+            self._write(sheet_name, df)
+            with self._lock:
+                # มีการแก้ระหว่างอ่านชีต -> ข้อมูลที่อ่านอาจไม่มีการแก้นั้น ให้โหลดใหม่อีกรอบ
+                if self._patches[sheet_name] == seq: self._dirty.discard(sheet_name)
+                else: self._dirty.add(sheet_name)
+
+    def apply_patch(self, sheet_name, report_id, changes):
+        # เรียกหลัง patch_case สำเร็จ: แก้แถวในไฟล์ของปีนั้น (mtime เปลี่ยน = version() ใหม่ แคชที่ผูกกับปีนั้นโหลดใหม่)
+        # แก้ไม่ได้ (ไม่พบแถว / คอลัมน์ใหม่ / คอลัมน์ที่แปลงชนิด) -> ให้โหลดปีนั้นจากชีตใหม่แทน
+        if case_sheet_year(sheet_name) is None: return
+        with self._write_lock:
+            self._patches[sheet_name] += 1
+            path = self._path(sheet_name)
+            if not os.path.exists(path): return
+            try:
+                df = pd.read_parquet(path)
+                hit = df['Report_ID'] == norm_report_id(report_id) if 'Report_ID' in df.columns else None
+                if hit is None or not hit.any() or any(c not in df.columns or c in ('lat', 'lon', 'Timestamp') for c in changes):
+                    raise LookupError("patch ต้องโหลดใหม่ทั้งปี")
+                for col, val in changes.items(): df.loc[hit, col] = str(val)
+                self._write(sheet_name, df)
+            except Exception:
+                with self._lock: self._dirty.add(sheet_name)
+
+    def _read(self, sheet_name):
+        path = self._path(sheet_name)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            hit = self._frames.get(sheet_name)
+            if hit and hit[0] == mtime: return hit[1]
+        df = pd.read_parquet(path)
+        with self._lock:
+            self._frames[sheet_name] = (mtime, df)
+        return df
+
+    def load(self, sheet_names=None, force=False):
+        # คืน DataFrame รวมหลายปี (เรียงตามปี) ดึงจากแหล่งข้อมูลเฉพาะปีที่ยังไม่มีไฟล์ / ปีปัจจุบันที่เก่าแล้ว พร้อมกันหลาย Thread
+        names = list(sheet_names) if sheet_names is not None else self.sheets()
+        todo = [s for s in names if self._stale(s, force)]
+        if todo:
+            with ThreadPoolExecutor(max_workers=min(CASE_CACHE_WORKERS, len(todo))) as pool:
+                futs = {pool.submit(self._fetch, s): s for s in todo}
+                for fut in as_completed(futs):
+                    try:
+                        fut.result()
+                        with self._lock: self._errors.pop(futs[fut], None)
+                    except Exception as e:
+                        with self._lock: self._errors[futs[fut]] = str(e)  # ใช้ไฟล์เดิมถ้ามี
+        ready = [s for s in names if os.path.exists(self._path(s))]
+        if not ready: return typed_case_frame(pd.DataFrame(), 0).iloc[0:0]
+        with ThreadPoolExecutor(max_workers=min(CASE_CACHE_WORKERS, len(ready))) as pool:
+            frames = list(pool.map(self._read, ready))
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+@st.cache_resource
+def get_case_year_store():
+    return CaseYearStore(get_storage(), CASE_CACHE_DIR)
+
+# ==========================================
+# 1.10 SCOPED CACHE (แคชแยก namespace + เวอร์ชันข้อมูล + ส่งค่าเก่าระหว่างโหลดใหม่เบื้องหลัง)
+# ==========================================
+# - ค่าที่หมดอายุ/เวอร์ชันเปลี่ยน: ส่งค่าเดิมให้ทันที แล้วโหลดใหม่เบื้องหลัง (stale-while-revalidate) ไม่มีใครต้องรอโหลดเย็น
+# - โหลดไม่สำเร็จ: จำความผิดพลาดไว้แค่ fail_ttl วินาที (ถ้ามีค่าดีเดิมก็ใช้ค่าเดิมต่อ)
+# - invalidate(ns): ทำให้เฉพาะ namespace นั้นเก่า แทน st.cache_data.clear() ที่ล้างทุกฟังก์ชันของทุกผู้ใช้
+class ScopedCache:
+    def __init__(self, workers=2):
+        self._lock = threading.Lock()
+        self._spaces = {}    # ns -> {"gen": เลขรุ่น, "items": {key: entry}}
+        self._loading = {}   # (ns, key) -> Future ของการโหลดที่กำลังทำ (โหลดซ้อนกันแค่ครั้งเดียว)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cache-refresh")
+
+    def _space(self, ns):
+        return self._spaces.setdefault(ns, {"gen": 0, "items": {}})
+
+    def _load(self, ns, key, loader, version):
+        try:
+            value, error = loader(), None
+        except Exception as e:
+            value, error = None, e
+        with self._lock:
+            space = self._space(ns)
+            old = space["items"].get(key)
+            if error is None:
+                space["items"][key] = {"value": value, "error": None, "born": time.time(), "version": version, "gen": space["gen"]}
+            elif old is not None and old["error"] is None:
+                old["failed_at"], old["last_error"] = time.time(), error  # ใช้ค่าดีเดิมต่อ ลองใหม่หลัง fail_ttl
+            else:
+                space["items"][key] = {"value": None, "error": error, "born": time.time(), "version": version, "gen": space["gen"]}
+            self._loading.pop((ns, key), None)
+        if error is not None: raise error
+        return value
+
+    def _start(self, ns, key, loader, version, background):
+        fut = self._loading.get((ns, key))
+        if fut is None:
+            if background:
+                fut = self._pool.submit(self._load, ns, key, loader, version)
+            else:
+                fut = Future(); fut.set_running_or_notify_cancel()
+            self._loading[(ns, key)] = fut
+            return fut, not background
+        return fut, False
+
+    def get(self, ns, key, loader, ttl=600, version=None, fail_ttl=30):
+        with self._lock:
+            space = self._space(ns)
+            ent = space["items"].get(key)
+            now = time.time()
+            if ent is not None and ent["error"] is None:
+                fresh = now - ent["born"] < ttl and ent["version"] == version and ent["gen"] == space["gen"]
+                retry_wait = now - ent.get("failed_at", 0) < fail_ttl and ent["version"] == version
+                if not fresh and not retry_wait: self._start(ns, key, loader, version, background=True)
+                return ent["value"]
+            if ent is not None and now - ent["born"] < fail_ttl and ent["version"] == version:
+                raise ent["error"]
+            fut, mine = self._start(ns, key, loader, version, background=False)
+        if not mine: return fut.result()  # มีคนกำลังโหลดคีย์นี้อยู่ -> รอผลเดียวกัน
+        try:
+            value = self._load(ns, key, loader, version)
+            fut.set_result(value)
+            return value
+        except Exception as e:
+            fut.set_exception(e)
+            raise
+
+    def refresh(self, ns, key, loader, version=None):
+        # ผู้ที่กดรีเฟรชรอค่าใหม่เอง ผู้ใช้อื่นยังเห็นค่าเดิมจนกว่าจะโหลดเสร็จ
+        return self._load(ns, key, loader, version)
+
+    def invalidate(self, ns):
+        with self._lock: self._space(ns)["gen"] += 1
+
+@st.cache_resource
+def get_scoped_cache():
+    return ScopedCache()
+
 # ==========================================
 # 2. MODULE: INVESTIGATION (เริ่มส่วนสอบสวนต่อด้านล่าง)
 # ==========================================
 # ==========================================
 # 2. MODULE: INVESTIGATION
 # ==========================================
-def create_pdf_inv(row):
+def case_pdf_key(row, printed_by):
+    # เนื้อหาทั้งแถว (รวม Audit_Log) + ผู้พิมพ์ เปลี่ยนเมื่อไหร่ได้ PDF ใหม่
+    return op_key("case_pdf", {c: clean_val(v) for c, v in row.items()}, printed_by)
+
+def case_pdf_context(row, printed_by="System"):
+    # เตรียมข้อมูลของใบสรุปคดี (งาน I/O: วันที่, โหลดรูป) ส่วนจัดหน้า PDF อยู่ใน pdf_documents.render_case_pdf
     rid = str(row.get('Report_ID', '')); date_str = get_thai_date_full(str(row.get('Timestamp', '')))
     audit_log = str(row.get('Audit_Log', '')); latest_date = "-"
     if audit_log:
@@ -475,122 +2300,29 @@ def create_pdf_inv(row):
                 latest_date = get_thai_date_full(raw_log_date)
         except: pass
     now = get_now_th()
-    p_name = st.session_state.user_info.get('name', 'System')
+    p_name = printed_by
     p_time = f"{get_thai_date_full(now)} เวลา {now.strftime('%H:%M:%S')} น."
-    qr = qrcode.make(rid); qi = io.BytesIO(); qr.save(qi, format="PNG"); qr_b64 = base64.b64encode(qi.getvalue()).decode()
     
-    img_html = ""
-    
-    # --- ฟังก์ชันภายในช่วยแปลงลิงก์ Drive เป็น Direct Link สำหรับ PDF ---
-    def get_pdf_src(val):
-        val = str(val).strip()
-        if "drive.google.com" in val:
-            file_id = ""
-            if "/file/d/" in val: file_id = val.split("/file/d/")[1].split("/")[0]
-            elif "id=" in val: file_id = val.split("id=")[1].split("&")[0]
-            return f"https://drive.google.com/uc?export=view&id={file_id}"
-        elif val.startswith("http"):
-            return val
-        else:
-            # จัดการ Base64 พร้อมซ่อม Padding
-            missing_padding = len(val) % 4
-            if missing_padding: val += '=' * (4 - missing_padding)
-            return f"data:image/jpeg;base64,{val}"
-
-    # ✅ จัดการส่วนพยานหลักฐาน (Evidence_Image)
-    raw_evidence = clean_val(row.get('Evidence_Image'))
-    if raw_evidence and raw_evidence not in ["0", "None", ""]:
-        img_html += "<div style='text-align:center; margin-top:10px;'><b>พยานหลักฐาน</b><br>"
-        if "," in raw_evidence:
-            for link in raw_evidence.split(','):
-                src = get_pdf_src(link.strip())
-                img_html += f"<img src='{src}' style='max-width:240px; max-height:180px; object-fit:contain; border:1px solid #ccc; margin: 5px;'>"
-        else:
-            src = get_pdf_src(raw_evidence)
-            img_html += f"<img src='{src}' style='max-width:380px; max-height:220px; object-fit:contain; border:1px solid #ccc;'>"
-        img_html += "</div>"
-
-    # ✅ จัดการส่วนภาพประกอบเหตุการณ์ (Image_Data)
+    # ✅ รูปพยานหลักฐาน (Evidence_Image) + ภาพประกอบเหตุการณ์ (Image_Data)
+    # โหลดทุกรูปพร้อมกันก่อนจัดหน้า ย่อให้พอดีกรอบที่พิมพ์จริง แล้วฝังในเอกสารเลย (WeasyPrint ไม่ต้องดึงเอง)
+    evidence = evidence_links(row, "md")
+    ev_box = (240, 180) if len(evidence) > 1 else (380, 220)
     image_data = clean_val(row.get('Image_Data'))
-    if image_data and image_data not in ["0", "None", ""]:
-        src = get_pdf_src(image_data)
-        img_html += f"""
-        <div style='text-align:center; margin-top:10px;'>
-            <b>ภาพประกอบเหตุการณ์</b><br>
-            <img src='{src}' style='max-width:380px; max-height:220px; object-fit:contain; border:1px solid #ccc;'>
-        </div>"""
-
-    logo_html = f'<img class="logo" src="data:image/png;base64,{LOGO_BASE64}">' if LOGO_BASE64 else ""
-    html_content = f"""
-    <html><head><style>@font-face {{ font-family: 'THSarabunNew'; src: url('file://{FONT_FILE}'); }}
-    @page {{ size: A4; margin: 2cm; @bottom-right {{ content: "ผู้พิมพ์: {p_name} | เวลา: {p_time} | หน้า " counter(page); font-family: 'THSarabunNew'; font-size: 12pt; }} }}
-    body {{ font-family: 'THSarabunNew'; font-size: 16pt; line-height: 1.3; }}
-    .header {{ text-align: center; position: relative; min-height: 80px; }} .logo {{ position: absolute; top: 0; left: 0; width: 60px; }}
-    .qr {{ position: absolute; top: 0; right: 0; width: 60px; }} .box {{ border: 1px solid #000; background-color: #f9f9f9; padding: 10px; min-height: 50px; white-space: pre-wrap; }}
-    .sig-table {{ width: 100%; margin-top: 30px; text-align: center; border-collapse: collapse; }} .sig-table td {{ padding-bottom: 25px; vertical-align: top; }}
-    </style></head><body><div class="header">{logo_html}<div style="font-size: 22pt; font-weight: bold;">สถานีตำรวจภูธรโรงเรียนโพนทองพัฒนาวิทยา</div>
-    <div style="font-size: 18pt;">ใบสรุปรายงานเหตุการณ์และผลการดำเนินการสอบสวน</div><img class="qr" src="data:image/png;base64,{qr_b64}"></div><hr>
-    <table style="width:100%;"><tr><td width="60%"><b>เลขที่รับแจ้ง:</b> {rid}</td><td width="40%" style="text-align:right;"><b>วันที่แจ้ง:</b> {date_str}<br><b>วันที่บันทึกผล:</b> {latest_date}</td></tr></table>
-    <p><b>ผู้แจ้ง:</b> {row.get('Reporter','-')} | <b>ประเภทเหตุ:</b> {row.get('Incident_Type','-')} | <b>สถานที่:</b> {row.get('Location','-')}</p>
-    <div style="margin-top:10px;"><b>รายละเอียดเหตุการณ์:</b></div><div class="box">{row.get('Details','-')}</div>
-    <div><b>ผลการดำเนินการสอบสวน:</b></div><div class="box">{row.get('Statement','-')}</div>{img_html}
-    <table class="sig-table"><tr><td width="50%">ลงชื่อ..........................................................<br>( {row.get('Victim','')} )<br>ผู้เสียหาย</td><td width="50%">ลงชื่อ..........................................................<br>( {row.get('Accused','')} )<br>ผู้ถูกกล่าวหา</td></tr>
-    <tr><td>ลงชื่อ..........................................................<br>( {row.get('Student_Police_Investigator','')} )<br>ตำรวจนักเรียนผู้สอบสวน</td><td>ลงชื่อ..........................................................<br>( {row.get('Witness','')} )<br>พยาน</td></tr>
-    <tr><td colspan="2"><br>ลงชื่อ..........................................................<br>( {row.get('Teacher_Investigator','')} )<br>ครูผู้สอบสวน</td></tr></table></body></html>"""
-    return HTML(string=html_content, base_url=BASE_DIR).write_pdf(font_config=FontConfiguration())
-# แก้ไขบรรทัดแรกของฟังก์ชัน ให้รับค่า appointment_info เพิ่ม
-def create_summon_pdf(row, appointment_info):
-    rid = str(row.get('Report_ID', ''))
-    accused_name = str(row.get('Accused', ''))
-    incident_type = str(row.get('Incident_Type', '-'))
-    
-    # 🚩 แปลงวันที่เกิดเหตุเป็นเดือนเต็ม
-    raw_incident_date = str(row.get('Timestamp', '-'))
-    incident_date_th = get_thai_date_full(raw_incident_date)
-    
-    incident_details = str(row.get('Details', '-'))
-    teacher = str(row.get('Teacher_Investigator', '..........................................'))
-    student_police = str(row.get('Student_Police_Investigator', '..........................................'))
-    
-    # 🚩 แปลงวันที่ออกหมาย (วันนี้) เป็นเดือนเต็ม
-    today_th = get_thai_date_full(get_now_th())
-
-    html_content = f"""
-    <html><head><style>
-        @font-face {{ font-family: 'THSarabunNew'; src: url('file://{FONT_FILE}'); }}
-        @page {{ size: A4; margin: 2.5cm; }}
-        body {{ font-family: 'THSarabunNew'; font-size: 16pt; line-height: 1.5; }}
-        .header {{ text-align: center; font-weight: bold; font-size: 20pt; margin-bottom: 20px; }}
-        .garuda {{ text-align: center; margin-bottom: 10px; }}
-        .garuda img {{ width: 60px; }}
-        .signature-section {{ margin-top: 50px; float: right; width: 300px; text-align: center; }}
-    </style></head><body>
-        <div class="garuda"><img src="https://upload.wikimedia.org/wikipedia/commons/thumb/c/c5/Garuda_Emblem_of_Thailand.svg/1200px-Garuda_Emblem_of_Thailand.svg.png"></div>
-        <div class="header">หนังสือเรียกสอบถาม (ส่วนงานตำรวจนักเรียน)</div>
-        <div style="text-align: right;">สถานีตำรวจภูธรโรงเรียนโพนทองพัฒนาวิทยา</div>
-        <div style="text-align: right;">วันที่ {today_th}</div>
-        
-        <p><b>เรื่อง:</b> ขอเชิญพบเพื่อสอบถามเหตุการณ์</p>
-        <p><b>เรียน:</b> {accused_name} (ผู้เกี่ยวข้อง)</p>
-        
-        <div style="text-align: justify;">
-            <p>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;ด้วยทางงานป้องกันและปราบปราม(สถานีตำรวจนักเรียน) ได้รับแจ้งเหตุ <b>{incident_type}</b> ซึ่งเกิดขึ้นเมื่อวันที่ <b>{incident_date_th}</b> ตามเลขแจ้งเหตุที่ <b>{rid}</b></p>
-            
-            <p>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;อาศัยอำนาจหน้าที่ตามระเบียบโรงเรียน จึงขอให้ท่านมาพบคุณครู
-            <span style="color: blue; text-decoration: underline;"><b>ในวันที่ {appointment_info}</b></span> 
-            ณ ห้องปกครอง  เพื่อดำเนินการสอบถามข้อเท็จจริงในกรณี: <i>{incident_details[:100]}...</i> ให้เกิดความเป็นธรรมแก่ทุกฝ่าย</p>
-        </div>
+    has_image_data = bool(image_data and image_data not in ["0", "None", ""])
+    uris = prefetch_print_images([(l, ev_box) for l in evidence] + ([(image_data, (380, 220))] if has_image_data else []))
 
-        <p style="margin-top: 20px;">จึงเรียนเชิญมาพบตำรวจนักเรียนตามกำหนดเวลา</p>
+    return {"row": dict(row), "rid": rid, "date_str": date_str, "latest_date": latest_date, "p_name": p_name, "p_time": p_time,
+            "evidence": uris[:len(evidence)], "ev_box": ev_box, "has_image_data": has_image_data,
+            "image_data": uris[-1] if has_image_data else None, "logo_b64": LOGO_BASE64}
+
+def create_pdf_inv(row, printed_by="System"):
+    return pdf_documents.render_case_pdf(case_pdf_context(row, printed_by))
+def create_summon_pdf(row, appointment_info):
+    # 🚩 วันที่เกิดเหตุ / วันที่ออกหมาย (วันนี้) เป็นเดือนเต็ม -> จัดหน้าด้วยแม่แบบใน pdf_documents.py
+    return pdf_documents.render_summon_pdf({
+        "row": dict(row), "appointment": appointment_info,
+        "incident_date": get_thai_date_full(str(row.get('Timestamp', '-'))), "today": get_thai_date_full(get_now_th())})
 
-        <div class="signature-section">
-            <p>ลงชื่อ..........................................................<br>({teacher})<br>ครูผู้สอบสวน/ครูผู้ออกหมายนัด</p>
-            <br><br>
-            <p>ลงชื่อ..........................................................<br>({student_police})<br>ตำรวจนักเรียนเจ้าของคดี</p>
-        </div>
-    </body></html>"""
-    
-    return HTML(string=html_content, base_url=BASE_DIR).write_pdf(font_config=FontConfiguration())    
 def investigation_module():
     user = st.session_state.user_info
     
@@ -645,11 +2377,11 @@ def investigation_module():
     target_sheet = f"Investigation_{sel_year}"
     # ---------------------------------------------------------------------
 
-    conn = st.connection("gsheets", type=GSheetsConnection)
-    # ... (ส่วนถัดไปเหมือนเดิม conn.read ...)
+    storage = get_storage()
     try:
         # อ่านข้อมูลจากชีตตามปีที่เลือก (ใช้ ttl=10 เพื่อความลื่นไหล)
-        df_raw = conn.read(worksheet=target_sheet, ttl=10)
+        df_raw = storage.read_cases(target_sheet, ttl=10)
+        df_raw = get_write_queue().overlay_cases(target_sheet, df_raw)
         
         # --- [Logic เดิม: การจัดการข้อมูล] ---
         df_display = df_raw.copy().fillna("")
@@ -666,11 +2398,12 @@ def investigation_module():
             
         df_display['Report_ID'] = df_display['Report_ID'].astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
 # --- [ส่วนที่เพิ่ม: การ์ดสถิติสรุปภาพรวม (Metric Cards)] ---
-        # 1. คำนวณตัวเลข
+        # 1. คำนวณตัวเลข (ตัวนับสะสมของปีนี้ อัปเดตเฉพาะแถวที่เปลี่ยน)
+        inc_stats = get_incident_aggregates("live", target_sheet, df_display)
         total_cases = len(df_display)
-        pending = len(df_display[df_display['Status'] == "รอดำเนินการ"])
-        process = len(df_display[df_display['Status'] == "อยู่ระหว่างการดำเนินการ"])
-        finished = len(df_display[df_display['Status'] == "ดำเนินการเรียบร้อย"])
+        pending = inc_stats["status"]["รอดำเนินการ"]
+        process = inc_stats["status"]["อยู่ระหว่างการดำเนินการ"]
+        finished = inc_stats["status"]["ดำเนินการเรียบร้อย"]
 
         # 2. แสดงผล 4 คอลัมน์
         m1, m2, m3, m4 = st.columns(4)
@@ -717,15 +2450,25 @@ def investigation_module():
         if st.session_state.view_mode == "list":
             # 1. ส่วนค้นหา
             c_search, c_btn_search, c_btn_clear = st.columns([3, 1, 1])
-            search_q = c_search.text_input("🔍 ค้นหาคดี", placeholder="เลขเคส, ชื่อ, หรือเหตุการณ์...", key="search_query_main", label_visibility="collapsed")
+            search_q = c_search.text_input("🔍 ค้นหาคดี", placeholder="เลขเคส, ชื่อ, หรือเหตุการณ์... (ระบุช่องได้ เช่น ผู้แจ้ง:สมชาย สถานที่:โรงอาหาร)", key="search_query_main", label_visibility="collapsed")
             c_btn_search.button("ค้นหา", use_container_width=True)
             if c_btn_clear.button("❌ ล้าง", use_container_width=True): 
                 st.rerun()
 
             filtered = df_display.copy()
             if search_q: 
-                filtered = filtered[filtered.apply(lambda r: r.astype(str).str.contains(search_q, case=False).any(), axis=1)]
+                # ค้นผ่านดัชนี (สร้างครั้งเดียวต่อเวอร์ชันข้อมูล) ระบุช่องได้ เช่น ผู้แจ้ง:สมชาย สถานที่:โรงอาหาร
+                filtered = filtered[get_case_search_index(target_sheet, df_display).search(search_q)]
             
+            if user.get('role') in ["admin", "super_admin"]:
+                with st.expander("🖨️ ส่งออก PDF สำนวนคดีทีละหลายเรื่อง"):
+                    scope = st.radio("ขอบเขต", [f"ผลการค้นหาปัจจุบัน ({len(filtered)} เรื่อง)", f"ทั้งปีการศึกษา {sel_year} ({len(df_display)} เรื่อง)"], horizontal=True, key="inv_export_scope")
+                    export_df = filtered if scope.startswith("ผลการค้นหา") else df_display
+                    render_bulk_export("inv_export", f"ส่งออก {len(export_df)} เรื่อง", lambda: [
+                        (f"{i+1:04d}_Report_{safe_filename(r['Report_ID'])}.pdf",
+                         lambda r=r: (pdf_documents.render_case_pdf, (case_pdf_context(r, user.get('name', 'System')),)))
+                        for i, (_, r) in enumerate(export_df.iterrows())], f"Investigation_{sel_year}")
+
             df_active = filtered[filtered['Status'].isin(["รอดำเนินการ", "อยู่ระหว่างการดำเนินการ"])][::-1]
             df_archive = filtered[filtered['Status'].isin(["ดำเนินการเรียบร้อย", "ยกเลิก"])][::-1]
 
@@ -789,10 +2532,34 @@ def investigation_module():
                 if tc > 0:
                     m1, m2, m3 = st.columns(3)
                     m1.metric("แจ้งเหตุทั้งหมด", f"{tc} ครั้ง")
-                    m2.metric("สถานที่บ่อยสุด", df_display['Location'].mode()[0] if not df_display.empty else "-")
-                    m3.metric("เหตุที่เกิดบ่อยสุด", df_display['Incident_Type'].mode()[0] if not df_display.empty else "-")
+                    m2.metric("สถานที่บ่อยสุด", top_count(inc_stats["location"]))
+                    m3.metric("เหตุที่เกิดบ่อยสุด", top_count(inc_stats["type"]))
                     st.divider()
-                    st.bar_chart(df_display['Incident_Type'].value_counts())
+                    st.bar_chart(count_series(inc_stats["type"]))
+                    h1, h2 = st.columns(2)
+                    h1.caption("🕒 ช่วงเวลาที่เกิดเหตุ (ชั่วโมง)")
+                    h1.bar_chart(count_series(inc_stats["hour"], range(24)))
+                    h2.caption("📅 วันในสัปดาห์")
+                    h2.bar_chart(count_series(inc_stats["day"], range(7)).set_axis(THAI_WEEKDAYS))
+
+                # --- เปรียบเทียบข้ามปี: อ่านจากไฟล์แคชรายปีในเครื่อง (ดึงชีตเฉพาะปีที่ยังไม่เคยโหลด) ---
+                if st.toggle("📈 เปรียบเทียบข้ามปีการศึกษา", key="inv_multi_year"):
+                    multi = get_case_year_store().load()
+                    if multi.empty:
+                        st.caption("ยังไม่มีข้อมูลปีการศึกษาอื่น")
+                    else:
+                        y1, y2 = st.columns(2)
+                        locs = sorted(x for x in multi['Location'].unique() if x) if 'Location' in multi.columns else []
+                        sel_loc = y1.selectbox("สถานที่", ["ทั้งหมด"] + locs, key="inv_trend_loc")
+                        types = sorted(x for x in multi['Incident_Type'].unique() if x) if 'Incident_Type' in multi.columns else []
+                        sel_types = y2.multiselect("ประเภทเหตุ", types, key="inv_trend_types")
+                        trend = multi if sel_loc == "ทั้งหมด" else multi[multi['Location'] == sel_loc]
+                        if sel_types: trend = trend[trend['Incident_Type'].isin(sel_types)]
+                        pivot = trend.groupby(['Academic_Year', 'Incident_Type']).size().unstack(fill_value=0) if not trend.empty else pd.DataFrame()
+                        if pivot.empty: st.caption("ไม่พบเหตุการณ์ตามเงื่อนไข")
+                        else: st.bar_chart(pivot.set_axis(pivot.index.astype(str)))
+                        for s, err in get_case_year_store().errors().items():
+                            st.caption(f"⚠️ โหลด {s} ไม่สำเร็จ (ใช้ข้อมูลล่าสุดที่มี): {err}")
         # ==========================================
         # 🚩 หลังจากนี้คือบล็อก Detail เดิมของคุณครู (ไม่ต้องแก้)
         # ========================================= 
@@ -857,53 +2624,72 @@ def investigation_module():
                     ev_imgs = st.file_uploader("📸 แนบรูปหลักฐานเพิ่ม (เลือกได้หลายรูป)", type=['jpg','png','jpeg'], accept_multiple_files=True, disabled=is_lock)
                     
                     if st.form_submit_button("💾 บันทึกข้อมูล") and not is_lock:
-                        # 1. อัปเดตข้อมูลตัวอักษรลง DataFrame
-                        df_raw.at[idx_raw, 'Victim'] = v_vic
-                        df_raw.at[idx_raw, 'Accused'] = v_acc
-                        df_raw.at[idx_raw, 'Witness'] = v_wit
-                        df_raw.at[idx_raw, 'Teacher_Investigator'] = v_tea
-                        df_raw.at[idx_raw, 'Student_Police_Investigator'] = v_stu
-                        df_raw.at[idx_raw, 'Statement'] = v_stmt
-                        df_raw.at[idx_raw, 'Status'] = v_sta
-
-                        # 2. ✅ ส่วนจัดการรูปภาพพยานหลักฐาน (หลายรูป)
+                        # 1. เก็บค่าที่แก้ไขของแถวนี้ (ไม่แตะ DataFrame ทั้งปี)
+                        updates = {
+                            'Victim': v_vic, 'Accused': v_acc, 'Witness': v_wit,
+                            'Teacher_Investigator': v_tea, 'Student_Police_Investigator': v_stu,
+                            'Statement': v_stmt, 'Status': v_sta
+                        }
+
+                        # 2. ✅ ส่วนจัดการรูปภาพพยานหลักฐาน (หลายรูป) -> เข้าคิวอัปโหลด ไม่ต้องรอเน็ต
+                        wq = get_write_queue(); up_keys = []; up_ops = []
                         if ev_imgs:
-                            with st.spinner("⏳ กำลังอัปโหลดพยานหลักฐานหลายรายการ..."):
-                                # เรียกฟังก์ชันอัปโหลดหลายรูป (จะได้ลิงก์คั่นด้วยคอมม่า)
-                                new_evidence_links = upload_multiple_images(ev_imgs, f"Report_{sid}")
-                                
-                                # ตรวจสอบค่าเดิมในช่อง Evidence_Image
-                                old_val = clean_val(row['Evidence_Image'])
-                                
-                                if old_val and old_val != "nan":
-                                    # ถ้ามีรูปเก่า ให้ "ต่อท้าย" ด้วยรูปใหม่
-                                    df_raw.at[idx_raw, 'Evidence_Image'] = f"{old_val},{new_evidence_links}"
-                                else:
-                                    # ถ้าไม่มีรูปเก่า ให้ใส่รูปใหม่ลงไปเลย
-                                    df_raw.at[idx_raw, 'Evidence_Image'] = new_evidence_links
+                            for i, f in enumerate(ev_imgs):
+                                data = f.getvalue()
+                                k = wq.enqueue("image_upload", {"filename": f"Report_{sid}_Evid_{i+1}.jpg", "mime": f.type},
+                                               key=op_key("upload", sid, f.name, hashlib.sha1(data).hexdigest()), blob=data, label=f"📸 {f.name}")
+                                track_write(f"inv:{sid}", k, f"อัปโหลดรูป {f.name}")
+                                up_keys.append(k); up_ops.append((k, f.name))
+                            # ถ้ามีรูปเก่า ให้ "ต่อท้าย" ด้วยรูปใหม่ (ลิงก์ที่อัปโหลดไม่สำเร็จจะถูกข้าม)
+                            # (เขียนแยกเป็นงานที่สองหลังอัปโหลดเสร็จ ไม่ให้สถานะ/คำให้การต้องรอรูป)
+                            # ค่าเดิมอ่านจากแถวจริงตอนส่ง ("$cell") กดบันทึกซ้ำระหว่างรูปชุดแรกยังอัปโหลดอยู่ ลิงก์ชุดแรกก็ไม่หาย
+                            old_thumbs = clean_val(row.get('Evidence_Thumbs')) or ",".join(["-"] * len(evidence_links(row)))
+                            evidence = {
+                                'Evidence_Image': {"$join": [{"$cell": 'Evidence_Image', "default": clean_val(row['Evidence_Image'])}] + [{"$result": k, "field": "full"} for k in up_keys]},
+                                # รูปย่อ (md|sm) เรียงตรงกับรูปเต็ม รูปเก่าที่ไม่มีรูปย่อใส่ "-" ไว้
+                                'Evidence_Thumbs': {"$join": [{"$cell": 'Evidence_Thumbs', "fill": 'Evidence_Image', "default": old_thumbs}] + [{"$result": k, "field": "thumbs"} for k in up_keys]}}
                         st.session_state.reset_count = st.session_state.get('reset_count', 0) + 1
 
                         # 3. บันทึกประวัติ (Audit Log)
-                        df_raw.at[idx_raw, 'Audit_Log'] = f"{clean_val(row['Audit_Log'])}\n[{get_now_th().strftime('%d/%m/%Y %H:%M')}] แก้ไขโดย {user['name']}"
+                        updates['Audit_Log'] = f"{clean_val(row['Audit_Log'])}\n[{get_now_th().strftime('%d/%m/%Y %H:%M')}] แก้ไขโดย {user['name']}"
                         
-                        # 4. ส่งข้อมูลทั้งหมดกลับไปที่ Google Sheets
-                        conn.update(worksheet=target_sheet, data=df_raw.fillna(""))
-                        st.success("💾 บันทึกข้อมูลและพยานหลักฐานสำเร็จ!")
+                        # 4. ส่งเฉพาะช่องที่เปลี่ยนจริงกลับไปที่ Google Sheets (แถวเดียว ยิงครั้งเดียว) ผ่านคิว
+                        changes = {c: val for c, val in updates.items() if clean_val(row.get(c)) != val}
+                        payload = {"sheet": target_sheet, "report_id": sid, "changes": changes}
+                        k = wq.enqueue("patch_case", payload, key=op_key("patch_case", payload), target=f"case:{target_sheet}:{sid}")
+                        track_write(f"inv:{sid}", k, f"บันทึกคดี {sid} ({get_now_th().strftime('%H:%M')})")
+                        if up_keys:
+                            # ลิงก์รูปรออัปโหลดเสร็จ (target แยก เพื่อไม่ให้การแก้ข้อความครั้งถัดไปต้องต่อคิวหลังรูป)
+                            payload = {"sheet": target_sheet, "report_id": sid, "changes": evidence}
+                            k = wq.enqueue("patch_case", payload, key=op_key("patch_case", payload), target=f"case:{target_sheet}:{sid}:evidence", deps=up_keys)
+                            track_write(f"inv:{sid}", k, f"แนบรูปหลักฐานคดี {sid}")
+                        # รอดูความคืบหน้าสักครู่ (อัปโหลดพร้อมกันทุกรูป) รูปที่ล้มเหลวไม่ทำให้รูปอื่นหาย
+                        wait_for_writes(up_ops)
+                        st.success("💾 รับข้อมูลแล้ว ระบบกำลังบันทึกและอัปโหลดพยานหลักฐานเบื้องหลัง")
                         time.sleep(1)
                         st.rerun()
 
+                render_write_status(f"inv:{sid}")
+
                 # --- [ส่วนที่ 3: ประวัติและดาวน์โหลด PDF] ---
                 if clean_val(row['Audit_Log']):
                     with st.expander("📜 ประวัติการบันทึก (Audit Log)"): st.code(row['Audit_Log'])
 
                 st.divider()
 
-                # --- [ ส่วนเดิม: ปุ่มดาวน์โหลดสำนวนคดี ] ---
-                try:
-                    pdf_data = create_pdf_inv(row)
-                    st.download_button(label="📥 ดาวน์โหลด PDF (สำนวนคดี)", data=pdf_data, file_name=f"Report_{sid}.pdf", mime="application/pdf", use_container_width=True, type="primary")
-                except Exception as pdf_e:
-                    st.error(f"❌ PDF ขัดข้อง: {pdf_e}")
+                # --- [ ส่วนเดิม: ปุ่มดาวน์โหลดสำนวนคดี ] สร้างเมื่อกดขอเท่านั้น (เนื้อหาเดิมใช้ไฟล์เดิมทันที) ---
+                jobs = get_render_jobs(); printed_by = user.get('name', 'System')
+                pdf_key = case_pdf_key(row, printed_by); pdf_job = jobs.get(pdf_key)
+                if pdf_job is None and st.button("🧾 เตรียม PDF (สำนวนคดี)", use_container_width=True):
+                    pdf_job = jobs.submit(pdf_key, create_pdf_inv, row.to_dict(), printed_by)
+                if pdf_job is not None:
+                    wait_for_job(pdf_job, "⏳ กำลังสร้าง PDF สำนวนคดี...")
+                    try:
+                        st.download_button(label="📥 ดาวน์โหลด PDF (สำนวนคดี)", data=pdf_job.result(), file_name=f"Report_{sid}.pdf", mime="application/pdf", use_container_width=True, type="primary")
+                    except Exception as pdf_e:
+                        st.error(f"❌ PDF ขัดข้อง: {pdf_e}")
+                        if st.button("🔁 ลองสร้าง PDF อีกครั้ง", use_container_width=True):
+                            jobs.submit(pdf_key, create_pdf_inv, row.to_dict(), printed_by); st.rerun()
 
                 # ==========================================
                 # ⚖️ [ระบบออกหมายเรียก - ปุ่มโชว์ตลอดเวลา]
@@ -954,6 +2740,45 @@ def investigation_module():
     except Exception as e:
         st.error(f"❌ Error ในการดึงข้อมูล: {e}")
 
+# --- เลื่อนชั้นเรียน: ตรวจตามลำดับเดิม (ม.1 ก่อน ... ม.6) แถวไหนเข้าเงื่อนไขแรกก็ใช้กฎนั้น ---
+PROMOTION_RULES = [
+    ("ม.1", "ม.2"), ("ม.2", "ม.3"), ("ม.3", None),
+    ("ม.4", "ม.5"), ("ม.5", "ม.6"), ("ม.6", None),
+]
+GRADUATED_LABEL = "จบการศึกษา 🎓"
+
+def promote_class_levels(levels):
+    levels = levels.fillna("").astype(str)
+    result = levels.copy()
+    # ไล่กฎจากท้ายขึ้นหน้า ให้กฎที่อยู่ก่อนเขียนทับ = "เงื่อนไขแรกที่ตรงชนะ"
+    for old, new in reversed(PROMOTION_RULES):
+        hit = levels.str.contains(old, regex=False)
+        result = result.mask(hit, levels.str.replace(old, new, regex=False) if new else GRADUATED_LABEL)
+    return result
+
+def promotion_summary(levels):
+    levels = levels.fillna("").astype(str)
+    moved = pd.DataFrame({
+        'จากระดับชั้น': levels.str.split('/').str[0],
+        'เป็นระดับชั้น': promote_class_levels(levels).str.split('/').str[0],
+    })
+    moved = moved[moved['จากระดับชั้น'] != moved['เป็นระดับชั้น']]
+    return moved.value_counts().rename('จำนวน (คน)').reset_index().sort_values('จากระดับชั้น', ignore_index=True)
+
+def traffic_pdf_images(img_url1, img_url2, face_url=None):
+    # โหลดรูปหลัง / ข้าง / หน้าเจ้าของพร้อมกันจากแคชรูปกลาง -> รูปแบบที่ render_traffic_pdf รับ
+    got = get_image_cache().get_many([img_url1, img_url2, face_url])
+    return [got.get(u, (None, "โหลดไม่สำเร็จ")) if u else None for u in (img_url1, img_url2, face_url)]
+
+def create_pdf_tra(vals, img_url1, img_url2, face_url=None, printed_by="ระบบอัตโนมัติ"):
+    # คืน (ไฟล์ PDF, เหตุผลของรูปที่ใส่ไม่ได้) ตัววาดอยู่ใน pdf_documents.py
+    pdf, errors = pdf_documents.render_traffic_pdf(list(vals), traffic_pdf_images(img_url1, img_url2, face_url), printed_by)
+    return io.BytesIO(pdf), errors
+
+def traffic_pdf_key(vals, printed_by):
+    # ทั้งแถว (คะแนน/บันทึกการหักแต้ม/รูป) + ผู้พิมพ์ -> คะแนนเปลี่ยนได้ PDF ใหม่ นอกนั้นใช้ไฟล์เดิม
+    return op_key("traffic_pdf", [clean_val(x) for x in vals], printed_by)
+
 # ==========================================
 # 3. MODULE: TRAFFIC (ต้นฉบับ 100% - บังคับค้นหา)
 # ==========================================
@@ -994,82 +2819,23 @@ def traffic_module():
             st.rerun()
     st.markdown("---")
 
-    def connect_gsheet_universal():
-        if "textkey" in st.secrets and "json_content" in st.secrets["textkey"]:
-            try:
-                key_str = st.secrets["textkey"]["json_content"]
-                key_str = key_str.strip()
-                if key_str.startswith("'") and key_str.endswith("'"): key_str = key_str[1:-1]
-                if key_str.startswith('"') and key_str.endswith('"'): key_str = key_str[1:-1]
-                try: creds_dict = json.loads(key_str, strict=False)
-                except: creds_dict = json.loads(key_str.replace('\n', '\\n'), strict=False)
-                scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-                creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-                return gspread.authorize(creds).open(SHEET_NAME_TRAFFIC).sheet1
-            except: pass
-
-        if "connections" in st.secrets and "gsheets" in st.secrets["connections"]:
-            creds_dict = dict(st.secrets["connections"]["gsheets"])
-            scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-            return gspread.authorize(creds).open(SHEET_NAME_TRAFFIC).sheet1
-            
-        raise Exception("ไม่สามารถอ่าน Credentials ได้")
-
     def load_tra_data():
         try:
-            sheet = connect_gsheet_universal()
-            vals = sheet.get_all_values()
+            vals = get_write_queue().overlay_vehicles(get_storage().read_vehicles())
             if len(vals) > 1:
                 st.session_state.df_tra = pd.DataFrame(vals[1:], columns=[f"C{i}" for i, h in enumerate(vals[0])])
+                st.session_state.tra_header = vals[0]
+                get_vehicle_index().refresh(st.session_state.df_tra)  # อัปเดตดัชนีค้นหาเฉพาะแถวที่เปลี่ยน
                 return True
         except: return False
 
 
-    def create_pdf_tra(vals, img_url1, img_url2, face_url=None, printed_by="ระบบอัตโนมัติ"):
-        buffer = io.BytesIO(); c = canvas.Canvas(buffer, pagesize=A4); width, height = A4
-        if os.path.exists(FONT_FILE):
-            pdfmetrics.registerFont(TTFont('Thai', FONT_FILE))
-            pdfmetrics.registerFont(TTFont('ThaiBold', FONT_BOLD if os.path.exists(FONT_BOLD) else FONT_FILE))
-            fn, fb = 'Thai', 'ThaiBold'
-        else: fn, fb = 'Helvetica', 'Helvetica-Bold'
-        logo = next((f for f in ["logo.png", "logo.jpg", "logo"] if os.path.exists(f)), None)
-        if logo: c.drawImage(logo, 50, height - 85, width=50, height=50, mask='auto')
-        c.setFont(fb, 22); c.drawCentredString(width/2, height - 50, "แบบทะเบียนประวัติรถจักรยานยนต์นักเรียน")
-        c.setFont(fn, 18); c.drawCentredString(width/2, height - 72, "โรงเรียนโพนทองพัฒนาวิทยา")
-        c.line(50, height - 85, width - 50, height - 85)
-        name, std_id, classroom, brand, color, plate = str(vals[1]), str(vals[2]), str(vals[3]), str(vals[4]), str(vals[5]), str(vals[6])
-        lic_s, tax_s, hel_s = str(vals[7]), str(vals[8]), str(vals[9])
-        raw_note = str(vals[12]).strip() if len(vals) > 12 else ""
-        note_text = raw_note if raw_note and raw_note.lower() != "nan" else "ไม่พบประวัติ"
-        score = str(vals[13]) if len(vals) > 13 and str(vals[13]).lower() != "nan" else "100"
-        c.setFont(fn, 16); c.drawString(60, height - 115, f"ชื่อ-นามสกุล: {name}"); c.drawString(300, height - 115, f"ยี่ห้อรถ: {brand}")
-        c.drawString(60, height - 135, f"รหัสนักเรียน: {std_id}"); c.drawString(300, height - 135, f"สีรถ: {color}")
-        c.drawString(60, height - 155, f"ระดับชั้น: {classroom}"); c.setFont(fb, 16); c.drawString(300, height - 155, f"ทะเบียน: {plate}")
-        c.setFont(fb, 18); color_val = (0.7, 0, 0) if int(score) < 80 else (0, 0.5, 0); c.setFillColorRGB(*color_val)
-        c.drawString(60, height - 185, f"คะแนนความประพฤติจราจรคงเหลือ: {score} คะแนน"); c.setFillColorRGB(0, 0, 0)
-        c.setFont(fn, 16); lm = "(/)" if "มี" in lic_s else "( )"; tm = "(/)" if "ปกติ" in tax_s or "✅" in tax_s else "( )"; hm = "(/)" if "มี" in hel_s else "( )"
-        c.drawString(60, height - 210, f"สถานะเอกสาร:  {lm} ใบขับขี่    {tm} ภาษี/พรบ.    {hm} หมวกกันน็อค")
-        def draw_img(url, x, y, w, h):
-            try:
-                if url:
-                    res = requests.get(url, timeout=5); img_data = ImageReader(io.BytesIO(res.content))
-                    c.drawImage(img_data, x, y, width=w, height=h, preserveAspectRatio=True, mask='auto'); c.rect(x, y, w, h)
-            except: pass
-        draw_img(img_url1, 70, height - 415, 180, 180); draw_img(img_url2, 300, height - 415, 180, 180)
-        note_y = height - 455; c.setFont(fb, 16); c.drawString(60, note_y, "ประวัติบันทึกการทำผิดวินัยจราจร:")
-        c.setFont(fn, 15); text_obj = c.beginText(70, note_y - 25); text_obj.setLeading(20)
-        for line in note_text.split('\n'):
-            for w_line in textwrap.wrap(line, width=75): text_obj.textLine(w_line)
-        c.drawText(text_obj)
-        sign_y = 180 
-        c.setFont(fn, 16); c.drawString(60, sign_y, "ลงชื่อ ......................................... เจ้าของรถ"); c.drawString(100, sign_y - 20, f"({name})")
-        if face_url: draw_img(face_url, 450, height - 200, 90, 110)
-        c.drawString(320, sign_y, "ลงชื่อ ......................................... ครูผู้ตรวจสอบ"); c.drawString(340, sign_y - 20, "(.........................................)")
-        c.setFont(fn, 10); c.setFillColorRGB(0.5, 0.5, 0.5)
-        print_time = (datetime.now() + timedelta(hours=7)).strftime('%d/%m/%Y %H:%M')
-        c.drawRightString(width - 30, 20, f"พิมพ์โดย: {printed_by} | เมื่อ: {print_time}")
-        c.save(); buffer.seek(0); return buffer
+    def vehicle_image(v, idx, size="md"):
+        # รูปหลัง (คอลัมน์ 10) / ข้าง (11) พร้อมรูปย่อจากคอลัมน์ Image_F_Thumbs / Image_S_Thumbs
+        col = {10: "Image_F_Thumbs", 11: "Image_S_Thumbs"}[idx]
+        header = st.session_state.get('tra_header') or []
+        t_idx = header.index(col) if col in header else None
+        return image_variant(v[idx], v[t_idx] if t_idx is not None and t_idx < len(v) else "", size)
 
     if st.session_state.df_tra is None:
         load_tra_data()
@@ -1102,6 +2868,7 @@ def traffic_module():
             
             c4.markdown(f"<div class='metric-card'><div class='metric-label'>หมวกกันน็อค</div><div class='metric-value'>{has_hel}</div><div style='color:#16a34a; font-size:1.1rem; font-weight:bold; margin-top:-5px;'>{p_hel}%</div></div>", unsafe_allow_html=True)
             st.write("") 
+        render_write_status("tra")
         # -------------------------------------------------------------------------
         c1, c2 = st.columns(2)
         if c1.button("🔄 ดึงข้อมูลล่าสุด"): 
@@ -1125,14 +2892,13 @@ def traffic_module():
 
         st.caption("▼ ตัวกรองข้อมูล (เลือกแล้วกด '⚡ กรองข้อมูล')")
         col_f1, col_f2, col_f3 = st.columns(3)
-        unique_lv, unique_br = [], []
-        if st.session_state.df_tra is not None:
-            unique_lv = sorted(list(set([str(x).split('/')[0] for x in st.session_state.df_tra.iloc[:, 3].unique()])))
-            unique_br = sorted(list(set(st.session_state.df_tra.iloc[:, 4].unique())))
+        # ✅ ค่าในตัวกรอง + จำนวน มาจาก facet ที่แคชไว้ตามเวอร์ชันข้อมูล (ไม่ต้องไล่คำนวณใหม่ทุก rerun)
+        facets = get_traffic_facets(st.session_state.df_tra) if st.session_state.df_tra is not None else None
+        fmt_for = lambda name: (lambda v: facets.label(name, v)) if facets else str
         
-        f_risk = col_f1.selectbox("🚨 กลุ่มปัญหา:", ["ทั้งหมด", "❌ ไม่มีใบขับขี่", "❌ ภาษีขาด", "❌ ไม่สวมหมวก"])
-        f_lv = col_f2.selectbox("📚 ระดับชั้น:", ["ทั้งหมด"] + unique_lv)
-        f_br = col_f3.selectbox("🏍️ ยี่ห้อรถ:", ["ทั้งหมด"] + unique_br)
+        f_risk = col_f1.selectbox("🚨 กลุ่มปัญหา:", ["ทั้งหมด"] + list(TRA_RISKS), format_func=fmt_for("risk"))
+        f_lv = col_f2.selectbox("📚 ระดับชั้น:", ["ทั้งหมด"] + (facets.values("lv") if facets else []), format_func=fmt_for("lv"))
+        f_br = col_f3.selectbox("🏍️ ยี่ห้อรถ:", ["ทั้งหมด"] + (facets.values("br") if facets else []), format_func=fmt_for("br"))
         do_filter = st.button("⚡ กรองข้อมูลตามเงื่อนไข", use_container_width=True)
 
         if do_search or do_filter:
@@ -1146,31 +2912,18 @@ def traffic_module():
             else:
                 if st.session_state.df_tra is None: load_tra_data()
                 if st.session_state.df_tra is not None:
-                    # ใช้ df_search เพื่อไม่ให้กระทบ df หลัก
-                    df = st.session_state.df_tra.copy()
+                    df = st.session_state.df_tra
+                    # ส่วนการกรอง: AND ของ bitmap (ระดับชั้น / ยี่ห้อ / เอกสารขาด)
+                    mask = get_traffic_facets(df).select(risk=f_risk, lv=f_lv, br=f_br)
                     
-                    # --- [แก้ไขใหม่] Logic ค้นหา Smart Search ---
+                    # --- [แก้ไขใหม่] Logic ค้นหา Smart Search ผ่านดัชนี n-gram ---
+                    # รหัส: ตรง/ขึ้นต้นด้วย, ทะเบียน: ไม่สนเว้นวรรค-จังหวัด, ชื่อ: ไม่สนคำนำหน้า-วรรณยุกต์ + ทนพิมพ์ผิด (เรียงตามความตรง)
                     if has_search_term:
-                        s_val = q.strip()
-                        # แปลงเป็น String และลบช่องว่างหัวท้ายออกก่อนค้นหา (แก้ปัญหาค้นไม่เจอ)
-                        col_name = df.iloc[:, 1].astype(str).str.strip()  # ชื่อ
-                        col_id = df.iloc[:, 2].astype(str).str.strip()    # รหัส
-                        col_plate = df.iloc[:, 6].astype(str).str.strip() # ทะเบียน
-
-                        mask = (
-                            col_name.str.contains(s_val, case=False) | # ชื่อ: ค้นหาบางส่วนได้
-                            col_id.str.startswith(s_val) |             # รหัส: ต้อง "ขึ้นต้นด้วย" (แก้ปัญหาเลข 1 ตัวเดียวเหมาหมด)
-                            col_plate.str.contains(s_val, case=False)  # ทะเบียน: ค้นหาบางส่วนได้
-                        )
-                        df = df[mask]
+                        hits = get_vehicle_index().search(df, q.strip())
+                        df = df.iloc[[pos for pos, _ in hits if mask[pos]]]
+                    else:
+                        df = df.iloc[np.flatnonzero(mask)]
                     # ----------------------------------------
-
-                    # ส่วนการกรอง (Logic เดิม)
-                    if f_risk != "ทั้งหมด": 
-                        idx = 7 if "ใบขับขี่" in f_risk else (8 if "ภาษี" in f_risk else 9)
-                        df = df[df.iloc[:, idx].astype(str).str.contains("ไม่มี|ขาด")]
-                    if f_lv != "ทั้งหมด": df = df[df.iloc[:, 3].astype(str).str.contains(f_lv)]
-                    if f_br != "ทั้งหมด": df = df[df.iloc[:, 4] == f_br]
                     
                     if df.empty:
                          st.warning("❌ ไม่พบข้อมูล")
@@ -1188,6 +2941,13 @@ def traffic_module():
             if target_df.empty: st.warning("❌ ไม่พบข้อมูล")
             else:
                 st.success(f"ค้นพบ {len(target_df)} รายการ")
+                if st.session_state.officer_role in ["admin", "super_admin"]:
+                    with st.expander(f"🖨️ ส่งออก PDF ทั้ง {len(target_df)} รายการ"):
+                        officer = st.session_state.officer_name
+                        render_bulk_export("tra_export", f"ส่งออก {len(target_df)} รายการ", lambda: [
+                            (f"{i+1:04d}_{safe_filename(v[6])}_{safe_filename(v[2])}.pdf",
+                             lambda v=v: (pdf_documents.render_traffic_pdf, (v, traffic_pdf_images(get_img_link(vehicle_image(v, 10, "md")), get_img_link(vehicle_image(v, 11, "md")), get_img_link(v[14]) if len(v) > 14 else ""), officer)))
+                            for i, v in enumerate(target_df.values.tolist())], "Motorcycle_Registry")
                 for i, row in target_df.iterrows():
                     v = row.tolist(); sc = int(v[13]) if len(v)>13 and str(v[13]).isdigit() else 100
                     sc_color = "#22c55e" if sc >= 80 else ("#eab308" if sc >= 50 else "#ef4444")
@@ -1208,12 +2968,26 @@ def traffic_module():
                         st.markdown(f"<span style='font-size:1.2rem;font-weight:bold;color:{sc_color};'>คะแนน: {sc}/100</span>", unsafe_allow_html=True)
                         c_img1, c_img2, c_img3 = st.columns(3)
                         c_img1.image(get_img_link(v[14]), caption="เจ้าของ")
-                        c_img2.image(get_img_link(v[10]), caption="หลัง")
-                        c_img3.image(get_img_link(v[11]), caption="ข้าง")
+                        c_img2.image(get_img_link(vehicle_image(v, 10, "md")), caption="หลัง")
+                        c_img3.image(get_img_link(vehicle_image(v, 11, "md")), caption="ข้าง")
                         
                         if st.session_state.officer_role in ["admin", "super_admin"]:
                             col_act1, col_act2 = st.columns(2)
-                            col_act1.download_button("📥 โหลด PDF", create_pdf_tra(v, get_img_link(v[10]), get_img_link(v[11]), get_img_link(v[14]), st.session_state.officer_name), f"{v[6]}.pdf", use_container_width=True)
+                            # สร้าง PDF เมื่อกดขอเท่านั้น (ไม่สร้างทุกแถวทุกครั้งที่รีรัน) คะแนนเดิมใช้ไฟล์เดิมทันที
+                            jobs = get_render_jobs(); pdf_key = traffic_pdf_key(v, st.session_state.officer_name); pdf_job = jobs.get(pdf_key)
+                            pdf_args = (v, get_img_link(vehicle_image(v, 10, "md")), get_img_link(vehicle_image(v, 11, "md")), get_img_link(v[14]), st.session_state.officer_name)
+                            if pdf_job is None and col_act1.button("🧾 เตรียม PDF", key=f"tra_pdf_{i}", use_container_width=True):
+                                pdf_job = jobs.submit(pdf_key, create_pdf_tra, *pdf_args)
+                            if pdf_job is not None:
+                                with col_act1: wait_for_job(pdf_job, "⏳ กำลังสร้าง PDF...")
+                                try:
+                                    pdf_tra, pdf_errors = pdf_job.result()
+                                    col_act1.download_button("📥 โหลด PDF", pdf_tra.getvalue(), f"{v[6]}.pdf", key=f"tra_dl_{i}", use_container_width=True)
+                                    if pdf_errors: col_act1.caption("⚠️ " + " | ".join(pdf_errors))
+                                except Exception as pdf_e:
+                                    col_act1.error(f"❌ PDF ขัดข้อง: {pdf_e}")
+                                    if col_act1.button("🔁 ลองอีกครั้ง", key=f"tra_pdf_retry_{i}", use_container_width=True):
+                                        jobs.submit(pdf_key, create_pdf_tra, *pdf_args); st.rerun()
                             if col_act2.button("✏️ แก้ไขข้อมูล", key=f"ed_{i}", use_container_width=True): st.session_state.edit_data = v; st.session_state.traffic_page = 'edit'; st.rerun()
                             with st.form(key=f"sc_form_{i}"):
                                 pts = st.number_input("แต้ม", 1, 50, 5); note = st.text_area("เหตุผล"); pwd = st.text_input("รหัสยืนยัน", type="password")
@@ -1221,13 +2995,16 @@ def traffic_module():
                                 deduct = c_sub1.form_submit_button("🔴 หักแต้ม", use_container_width=True)
                                 add = c_sub2.form_submit_button("🟢 เพิ่มแต้ม", use_container_width=True)
                                 if (deduct or add) and note and pwd == st.session_state.current_user_pwd:
-                                    sheet = connect_gsheet_universal(); cell = sheet.find(str(v[2]))
+                                    storage = get_storage(); row_no = storage.find_vehicle_row(v[2])
+                                    if not row_no: st.error(f"ไม่พบรหัสนักเรียน {v[2]} ในฐานข้อมูล"); st.stop()
                                     ns = max(0, sc-pts) if deduct else min(100, sc+pts)
                                     action = "หัก" if deduct else "เพิ่ม"
                                     tn = (datetime.now()+timedelta(hours=7)).strftime('%d/%m/%Y %H:%M')
                                     old_log = str(v[12]).strip() if str(v[12]).lower()!="nan" else ""
                                     new_log = f"{old_log}\n[{tn}] {action} {pts} คะแนน: {note} (โดย: {st.session_state.officer_name})"
-                                    sheet.update(f'M{cell.row}:N{cell.row}', [[new_log, str(ns)]])
+                                    payload = {"range": f'M{row_no}:N{row_no}', "values": [[new_log, str(ns)]], "std_id": str(v[2]).strip()}
+                                    k = get_write_queue().enqueue("vehicle_range", payload, key=op_key("vehicle_range", payload), target=f"vehicle:{row_no}")
+                                    track_write("tra", k, f"{action} {pts} คะแนน {v[1]} ({tn})")
                                     st.success("บันทึกแล้ว"); load_tra_data(); st.rerun()
                                 elif (deduct or add): st.error("รหัสผิดหรือข้อมูลไม่ครบ")
         else:
@@ -1247,30 +3024,39 @@ def traffic_module():
                 # ช่องกรอกรหัสยืนยัน (ดึงค่าจาก UPGRADE_PASSWORD ใน Secrets)
                 up_pwd = st.text_input("รหัสยืนยันการเลื่อนชั้น", type="password", key="prom_pwd_final")
                 
-                if st.button("ตกลงเลื่อนชั้นเรียนทั้งหมด", use_container_width=True, type="primary"):
+                # 1. ตรวจสอบก่อน (Dry Run) อ่านเฉพาะคอลัมน์ D ยังไม่เขียนอะไรลงชีต
+                if st.button("🔍 ตรวจสอบผลการเลื่อนชั้น (ยังไม่บันทึก)", use_container_width=True):
+                    try:
+                        # รอให้งานแก้ไขทะเบียนรถที่ค้างในคิวส่งก่อน (ช่วง B:J ทับคอลัมน์ D) แล้วจำค่าคอลัมน์ D ที่ใช้ตรวจไว้
+                        wait_for_writes(get_write_queue().pending("vehicle:"))
+                        col_d = get_storage().read_vehicle_column(4)[1:]
+                        st.session_state.promo_source = list(col_d)
+                        st.session_state.promo_preview = promotion_summary(pd.Series(col_d, dtype=str))
+                    except Exception as e:
+                        st.error(f"เกิดข้อผิดพลาด: {e}")
+
+                preview = st.session_state.get("promo_preview")
+                if preview is not None:
+                    st.dataframe(preview, use_container_width=True, hide_index=True)
+
+                # 2. ยืนยันจริง: เขียนกลับเฉพาะช่วง D2:D{n} ครั้งเดียว (ไม่ล้างชีต)
+                if st.button("ตกลงเลื่อนชั้นเรียนทั้งหมด", use_container_width=True, type="primary", disabled=preview is None):
                     if up_pwd == UPGRADE_PASSWORD:
                         try:
-                            s = connect_gsheet_universal()
-                            d = s.get_all_values()
-                            if len(d) > 1:
-                                h = d[0]
-                                r = d[1:]
-                                nr = []
-                                for row in r:
-                                    if len(row) > 3:
-                                        ol = str(row[3])
-                                        nl = ol
-                                        if "ม.1" in ol: nl=ol.replace("ม.1","ม.2")
-                                        elif "ม.2" in ol: nl=ol.replace("ม.2","ม.3")
-                                        elif "ม.3" in ol: nl="จบการศึกษา 🎓"
-                                        elif "ม.4" in ol: nl=ol.replace("ม.4","ม.5")
-                                        elif "ม.5" in ol: nl=ol.replace("ม.5","ม.6")
-                                        elif "ม.6" in ol: nl="จบการศึกษา 🎓"
-                                        row[3] = nl
-                                        nr.append(row)
-                                
-                                s.clear()
-                                s.update('A1', [h] + nr)
+                            storage, wq = get_storage(), get_write_queue()
+                            # งานในคิวที่ยังไม่ส่งจะเขียนคอลัมน์ D ทับผลเลื่อนชั้น -> รอให้ส่งหมดก่อน ยังค้างอยู่ = ไม่เขียน
+                            wait_for_writes(wq.pending("vehicle:"))
+                            col_d = storage.read_vehicle_column(4)[1:]
+                            old_lv = pd.Series(col_d, dtype=str)
+                            if wq.pending("vehicle:"):
+                                st.warning("⚠️ ยังมีรายการแก้ไขทะเบียนรถรอส่งอยู่ กรุณารอสักครู่แล้วกดอีกครั้ง")
+                            elif list(col_d) != st.session_state.get("promo_source"):
+                                st.session_state.promo_preview = None
+                                st.warning("⚠️ ข้อมูลในชีตเปลี่ยนไปหลังการตรวจสอบ กรุณากดตรวจสอบใหม่อีกครั้ง")
+                            elif len(old_lv) > 0:
+                                new_lv = promote_class_levels(old_lv)
+                                storage.update_vehicles(f"D2:D{len(new_lv) + 1}", [[x] for x in new_lv])
+                                st.session_state.promo_preview = None
                                 st.success("✅ ดำเนินการเลื่อนชั้นเรียบร้อยแล้ว!")
                                 time.sleep(2)
                                 load_tra_data()
@@ -1288,10 +3074,33 @@ def traffic_module():
             lc = st.radio("ใบขับขี่", ["✅ มี", "❌ ไม่มี"], index=0 if "มี" in v[7] else 1, horizontal=True); tx = st.radio("ภาษี", ["✅ ปกติ", "❌ ขาด"], index=0 if "ปกติ" in v[8] or "✅" in v[8] else 1, horizontal=True); hl = st.radio("หมวก", ["✅ มี", "❌ ไม่มี"], index=0 if "มี" in v[9] else 1, horizontal=True)
             nf = st.file_uploader("เปลี่ยนรูปหลัง"); ns = st.file_uploader("เปลี่ยนรูปข้าง")
             if st.form_submit_button("บันทึก", type="primary", use_container_width=True):
-                sheet = connect_gsheet_universal(); cell = sheet.find(str(v[2])); l1, l2 = v[10], v[11]
-                if nf: l1 = upload_to_drive(nf, f"{v[2]}_F_n.jpg")
-                if ns: l2 = upload_to_drive(ns, f"{v[2]}_S_n.jpg")
-                sheet.update(f'B{cell.row}:L{cell.row}', [[nm, v[2], cl, br, co, pl, lc, tx, hl, l1, l2]])
+                storage = get_storage(); row_no = storage.find_vehicle_row(v[2])
+                if not row_no: st.error(f"ไม่พบรหัสนักเรียน {v[2]} ในฐานข้อมูล"); st.stop()
+                # ข้อความ (B:J) ส่งทันที ไม่ต้องรอรูป
+                wq = get_write_queue(); std_id = str(v[2]).strip()
+                payload = {"range": f'B{row_no}:J{row_no}', "values": [[nm, v[2], cl, br, co, pl, lc, tx, hl]], "std_id": std_id}
+                k = wq.enqueue("vehicle_range", payload, key=op_key("vehicle_range", payload), target=f"vehicle:{row_no}")
+                track_write("tra", k, f"แก้ไขข้อมูล {nm}")
+                # รูปใหม่เข้าคิวอัปโหลด ลิงก์รูปเขียนเป็นงานแยก (target ของรูปเอง) หลังอัปโหลดเสร็จ
+                # ถ้าอัปโหลดไม่สำเร็จจะคงลิงก์รูปเดิมไว้ และการหัก/เพิ่มแต้มไม่ต้องต่อคิวหลังรูป
+                up_keys = []; up_ops = []; links = {}; thumbs = {}
+                for f, fname, col, old in ((nf, f"{v[2]}_F_n.jpg", "K", v[10]), (ns, f"{v[2]}_S_n.jpg", "L", v[11])):
+                    if not f: continue
+                    data = f.getvalue()
+                    k = wq.enqueue("image_upload", {"filename": fname, "mime": f.type}, key=op_key("upload", fname, hashlib.sha1(data).hexdigest()), blob=data)
+                    track_write("tra", k, f"อัปโหลดรูป {fname}")
+                    up_keys.append(k); up_ops.append((k, fname))
+                    side = "F" if col == "K" else "S"
+                    links[col] = {"$result": k, "field": "full", "default": old}
+                    thumbs[f"Image_{side}_Thumbs"] = {"$result": k, "field": "thumbs", "default": "-"}
+                if links:
+                    cols = sorted(links)
+                    payload = {"range": f'{cols[0]}{row_no}:{cols[-1]}{row_no}', "values": [[links[c] for c in cols]], "std_id": std_id}
+                    wq.enqueue("vehicle_range", payload, key=op_key("vehicle_range", payload), target=f"vehicle:{row_no}:images", deps=up_keys)
+                    # ลิงก์รูปย่อเก็บในคอลัมน์ตามชื่อหัวตาราง (เพิ่มคอลัมน์ให้อัตโนมัติถ้ายังไม่มี)
+                    payload = {"row": row_no, "changes": thumbs, "std_id": std_id}
+                    wq.enqueue("vehicle_patch", payload, key=op_key("vehicle_patch", payload), target=f"vehicle:{row_no}:images", deps=up_keys)
+                wait_for_writes(up_ops)
                 load_tra_data(); st.success("เสร็จสิ้น"); st.session_state.traffic_page = 'teacher'; st.rerun()
         if st.button("ยกเลิก", use_container_width=True): st.session_state.traffic_page = 'teacher'; st.rerun()
 
@@ -1300,21 +3109,11 @@ def traffic_module():
             st.session_state.traffic_page = 'teacher'; st.rerun()
             
         if st.session_state.df_tra is not None:
-            df = st.session_state.df_tra.copy()
-            # 1. เตรียมข้อมูลพื้นฐาน
-            df['Score'] = pd.to_numeric(df['C13'], errors='coerce').fillna(100)
-            df['LV'] = df['C3'].apply(lambda x: str(x).split('/')[0] if pd.notna(x) and '/' in str(x) else str(x))
-            
-            total_all = len(df)
-            avg_all = df['Score'].mean()
-            at_risk = len(df[df['Score'] < 60])
-            lic_total = (df['C7'] == "✅ มี").sum()
-            tax_total = (df['C8'].str.contains("ปกติ|✅", na=False)).sum()
-            hel_total = (df['C9'] == "✅ มี").sum()
-
-            lic_p = (lic_total / total_all * 100) if total_all > 0 else 0
-            tax_p = (tax_total / total_all * 100) if total_all > 0 else 0
-            hel_p = (hel_total / total_all * 100) if total_all > 0 else 0
+            # 1. สรุปทั้งหมดคำนวณครั้งเดียวต่อเวอร์ชันข้อมูล (เปิดซ้ำ/rerun ใช้ของเดิม)
+            dash = get_traffic_dashboard(st.session_state.df_tra)
+            total_all, avg_all, at_risk = dash["total"], dash["avg"], dash["at_risk"]
+            lic_total, tax_total, hel_total = dash["lic"], dash["tax"], dash["hel"]
+            lic_p, tax_p, hel_p = dash["lic_p"], dash["tax_p"], dash["hel_p"]
 
             st.markdown("<h2 style='text-align:center; color:#1E3A8A;'>📋 รายงานสรุปผลการดำเนินงานจราจร</h2>", unsafe_allow_html=True)
 
@@ -1356,36 +3155,10 @@ def traffic_module():
             </div>
             """, unsafe_allow_html=True)
 
-            # --- หมวดหมู่ที่ 2: ข้อมูลแยกระดับชั้น ---
+            # --- หมวดหมู่ที่ 2: ข้อมูลแยกระดับชั้น / ห้องเรียน / ยี่ห้อรถ ---
             st.markdown("#### 📚 ข้อมูลวิเคราะห์เชิงลึกรายระดับชั้น / กลุ่มบุคลากร")
-            
-            def calc_detailed(group):
-                n = len(group)
-                lic = (group['C7'] == "✅ มี").sum()
-                tax = (group['C8'].str.contains("ปกติ|✅", na=False)).sum()
-                hel = (group['C9'] == "✅ มี").sum()
-                return pd.Series({
-                    'จำนวนรถ': n,
-                    'คะแนนเฉลี่ย': group['Score'].mean(),
-                    'ใบขับขี่ (คน)': lic,
-                    'ใบขับขี่ (%)': (lic/n*100) if n>0 else 0,
-                    'ภาษีปกติ (คัน)': tax,
-                    'ภาษีปกติ (%)': (tax/n*100) if n>0 else 0,
-                    'สวมหมวก (คน)': hel,
-                    'สวมหมวก (%)': (hel/n*100) if n>0 else 0
-                })
-
-            summary_table = df.groupby('LV').apply(calc_detailed).reset_index()
-            summary_table = summary_table.rename(columns={'LV': 'ระดับชั้น/กลุ่ม'}).sort_values('จำนวนรถ', ascending=False)
-
-            format_rules = {
-                'คะแนนเฉลี่ย': '{:.2f}', 'ใบขับขี่ (%)': '{:.1f}%', 'ภาษีปกติ (%)': '{:.1f}%', 'สวมหมวก (%)': '{:.1f}%',
-                'จำนวนรถ': '{:,.0f}', 'ใบขับขี่ (คน)': '{:,.0f}', 'ภาษีปกติ (คัน)': '{:,.0f}', 'สวมหมวก (คน)': '{:,.0f}'
-            }
-            for col, fmt in format_rules.items():
-                summary_table[col] = summary_table[col].apply(lambda x: fmt.format(x))
-
-            st.dataframe(summary_table, use_container_width=True, hide_index=True)
+            breakdown = st.radio("แยกตาม:", list(TRA_DASH_BREAKDOWNS), horizontal=True, key="tra_dash_breakdown")
+            st.dataframe(dash["tables"][breakdown], use_container_width=True, hide_index=True)
             st.caption(f"อัปเดตล่าสุด: {get_now_th().strftime('%d/%m/%Y %H:%M')}")
 
             # แสดงผลตารางแบบ Interactive (มีแถบเลื่อนถ้าจอเล็ก)
@@ -1394,6 +3167,106 @@ def traffic_module():
             st.write("")
             st.info("💡 **หมายเหตุ:** ข้อมูลเปอร์เซ็นต์คำนวณจากจำนวนรถที่ลงทะเบียนในแต่ละระดับชั้นนั้นๆ")
             st.caption(f"ออกรายงาน ณ วันที่: {get_now_th().strftime('%d/%m/%Y %H:%M')}")
+# ==========================================
+# 🖥️ War Room: ติดตามชีตคดีแบบดึงเฉพาะส่วนต่าง
+# ==========================================
+WAR_ROOM_COLUMNS = ['Report_ID', 'Timestamp', 'Incident_Type', 'Location', 'Status', 'Student_Police_Investigator']
+WAR_ROOM_RESYNC_SECONDS = 600  # โหลดคอลัมน์เบาทั้งชีตใหม่ทุก 10 นาที กันกรณีมีการลบ/ย้ายแถวในชีต
+
+class CaseTailFeed:
+    """เก็บ Snapshot คอลัมน์เบาของชีตคดี แต่ละรอบดึงเฉพาะแถวใหม่ + สแกนคอลัมน์ Status"""
+
+    def __init__(self, sheet_name, columns=WAR_ROOM_COLUMNS):
+        self.sheet_name = sheet_name
+        self.columns = list(columns)
+        self.df = pd.DataFrame(columns=self.columns)
+        self.last_row = 1  # แถวล่าสุดที่อ่านแล้ว (1 = หัวตาราง)
+        self.synced_at = 0
+
+    def refresh(self, storage):
+        if time.time() - self.synced_at > WAR_ROOM_RESYNC_SECONDS:
+            self.df, self.last_row = pd.DataFrame(columns=self.columns), 1
+            self.synced_at = time.time()
+        tail, status = storage.read_cases_since(self.sheet_name, self.last_row, self.columns)
+
+        # แถวเดิมที่สถานะเปลี่ยน -> ดึงคอลัมน์เบาของแถวนั้นใหม่ (เช่น ผู้เข้าเหตุ)
+        if not self.df.empty:
+            now_status = status.reindex(self.df.index, fill_value="").astype(str)
+            changed = self.df.index[now_status != self.df['Status'].astype(str)].tolist()
+            if changed:
+                fresh = storage.read_case_rows(self.sheet_name, changed, self.columns)
+                self.df.loc[fresh.index, self.columns] = fresh[self.columns].values
+
+        if not tail.empty:
+            self.df = tail if self.df.empty else pd.concat([self.df, tail])
+            self.last_row = int(self.df.index.max())
+        return len(tail)
+
+WAR_ROOM_POLL_SECONDS = 10
+WAR_ROOM_IDLE_SECONDS = 60  # ไม่มีจอไหนเปิดชีตนั้นเกิน 1 นาที -> หยุดดึง
+
+class WarRoomPoller:
+    """Thread เดียวต่อโปรเซส ดึงข้อมูล War Room แล้วเผยแพร่เป็น Snapshot มีเลขเวอร์ชันให้ทุก Session อ่านจากหน่วยความจำ"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._lock = threading.Lock()
+        self._feeds, self._snaps, self._seen = {}, {}, {}
+        self._ready = {}
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, name="war-room-poller", daemon=True).start()
+
+    def snapshot(self, sheet_name, wait=0):
+        with self._lock:
+            self._seen[sheet_name] = time.time()
+            if sheet_name not in self._feeds:
+                self._feeds[sheet_name] = CaseTailFeed(sheet_name)
+                self._ready[sheet_name] = threading.Event()
+                self._wake.set()
+            ready = self._ready[sheet_name]
+        if wait: ready.wait(wait)
+        with self._lock:
+            return self._snaps.get(sheet_name)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                active = [n for n, t in self._seen.items() if time.time() - t < WAR_ROOM_IDLE_SECONDS]
+                for n in list(self._feeds):
+                    if n not in active: self._drop(n)
+            for name in active:
+                self._poll(name)
+            self._wake.wait(WAR_ROOM_POLL_SECONDS)
+            self._wake.clear()
+
+    def _drop(self, name):
+        for d in (self._feeds, self._snaps, self._seen): d.pop(name, None)
+        self._ready.pop(name, None)
+
+    def _poll(self, name):
+        with self._lock:
+            feed, prev = self._feeds.get(name), self._snaps.get(name)
+        if feed is None: return
+        try:
+            feed.refresh(self.storage)
+            changed = prev is None or not feed.df.equals(prev['df'])
+            snap = {
+                'version': (prev['version'] + 1 if prev else 1) if changed else prev['version'],
+                'df': feed.df.copy() if changed else prev['df'],
+                'updated_at': get_now_th(), 'error': None,
+            }
+        except Exception as e:
+            base = prev or {'version': 0, 'df': pd.DataFrame(columns=feed.columns), 'updated_at': get_now_th()}
+            snap = dict(base, error=str(e))
+            print(f"War Room poll error ({name}): {e}")
+        with self._lock:
+            if name in self._feeds: self._snaps[name] = snap
+            if name in self._ready: self._ready[name].set()
+
+@st.cache_resource
+def get_war_room_poller():
+    return WarRoomPoller(get_storage())
+
 def monitor_center_module():
     # --- 1. เตรียม State ---
     if "last_row_count" not in st.session_state:
@@ -1488,11 +3361,14 @@ def monitor_center_module():
             st.rerun()
 
     try:
-        conn = st.connection("gsheets", type=GSheetsConnection)
         now_th = get_now_th()
         cur_year = (now_th.year + 543) if now_th.month >= 5 else (now_th.year + 542)
-        df_raw = conn.read(worksheet=f"Investigation_{cur_year}", ttl=0).fillna("")
-        st.caption(f"🔄 Last Update: {now_th.strftime('%H:%M:%S')}")
+        # ✅ อ่าน Snapshot จาก Poller กลางของเซิร์ฟเวอร์ (ทุกจอใช้ชุดเดียวกัน ไม่ยิง Sheets เอง)
+        snap = get_war_room_poller().snapshot(f"Investigation_{cur_year}", wait=8)
+        if snap is None: raise Exception("กำลังโหลดข้อมูลครั้งแรก...")
+        if snap['error']: st.warning(f"⚠️ ดึงข้อมูลล่าสุดไม่สำเร็จ แสดงข้อมูลเดิม: {snap['error']}")
+        df_raw = snap['df'].fillna("")
+        st.caption(f"🔄 Last Update: {snap['updated_at'].strftime('%H:%M:%S')} (v{snap['version']})")
 
         if not df_raw.empty:
             current_row_count = len(df_raw)
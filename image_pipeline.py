@@ -0,0 +1,23 @@
+# ==========================================
+# IMAGE PIPELINE (แยกไฟล์เพื่อให้ ProcessPoolExecutor import ได้)
+# ==========================================
+import io
+from PIL import Image, ImageOps
+
+# ชื่อ -> (ด้านยาวสุด px, คุณภาพ JPEG) เรียงจากใหญ่ไปเล็ก ย่อต่อจากรูปก่อนหน้าได้เลย
+VARIANTS = {"full": (1600, 85), "md": (800, 80), "sm": (240, 70)}
+
+def make_variants(data, names=None):
+    img = Image.open(io.BytesIO(data))
+    # JPEG ให้ decoder ย่อระหว่างอ่านเลย (เร็วกว่าและใช้หน่วยความจำน้อยกว่าเปิดเต็มขนาด)
+    img.draft('RGB', (VARIANTS["full"][0], VARIANTS["full"][0]))
+    # แก้รูปหมุน (EXIF Orientation) + แปลงเป็น RGB ก่อนเซฟเป็น JPEG
+    img = ImageOps.exif_transpose(img).convert('RGB')
+    out = {}
+    for name, (size, quality) in VARIANTS.items():
+        if names and name not in names: continue
+        img.thumbnail((size, size))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=quality, optimize=True)
+        out[name] = buf.getvalue()
+    return out
@@ -0,0 +1,226 @@
+# ==========================================
+# PDF DOCUMENTS (แยกไฟล์เพื่อให้ ProcessPoolExecutor import ได้ ใช้ตอนส่งออกเอกสารทีละมากๆ)
+# ==========================================
+import io, os, base64, textwrap, threading, html
+from datetime import datetime, timedelta
+from functools import lru_cache
+import qrcode
+from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
+from weasyprint.urls import URLFetcher, URLFetcherResponse
+from reportlab.pdfgen import canvas
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FONT_FILE = os.path.join(BASE_DIR, "THSarabunNew.ttf")
+FONT_BOLD = os.path.join(BASE_DIR, "THSarabunNewBold.ttf")
+
+_font_lock = threading.Lock()
+_fonts = None
+
+def register_fonts():
+    # ลงทะเบียนฟอนต์ของ reportlab ครั้งเดียวต่อโปรเซส (ทั้งโปรเซสเว็บและโปรเซสใน pool)
+    global _fonts
+    with _font_lock:
+        if _fonts is None:
+            if os.path.exists(FONT_FILE):
+                pdfmetrics.registerFont(TTFont('Thai', FONT_FILE))
+                pdfmetrics.registerFont(TTFont('ThaiBold', FONT_BOLD if os.path.exists(FONT_BOLD) else FONT_FILE))
+                _fonts = ('Thai', 'ThaiBold')
+            else: _fonts = ('Helvetica', 'Helvetica-Bold')
+        return _fonts
+
+def render_traffic_pdf(vals, images, printed_by="ระบบอัตโนมัติ"):
+    # images = [รูปหลัง, รูปข้าง, รูปเจ้าของ] แต่ละรูปเป็น (bytes, เหตุผลที่โหลดไม่ได้) หรือ None ถ้าไม่มีลิงก์
+    buffer = io.BytesIO(); c = canvas.Canvas(buffer, pagesize=A4); width, height = A4
+    fn, fb = register_fonts(); errors = []
+    logo = next((f for f in ["logo.png", "logo.jpg", "logo"] if os.path.exists(f)), None)
+    if logo: c.drawImage(logo, 50, height - 85, width=50, height=50, mask='auto')
+    c.setFont(fb, 22); c.drawCentredString(width/2, height - 50, "แบบทะเบียนประวัติรถจักรยานยนต์นักเรียน")
+    c.setFont(fn, 18); c.drawCentredString(width/2, height - 72, "โรงเรียนโพนทองพัฒนาวิทยา")
+    c.line(50, height - 85, width - 50, height - 85)
+    name, std_id, classroom, brand, color, plate = str(vals[1]), str(vals[2]), str(vals[3]), str(vals[4]), str(vals[5]), str(vals[6])
+    lic_s, tax_s, hel_s = str(vals[7]), str(vals[8]), str(vals[9])
+    raw_note = str(vals[12]).strip() if len(vals) > 12 else ""
+    note_text = raw_note if raw_note and raw_note.lower() != "nan" else "ไม่พบประวัติ"
+    score = str(vals[13]) if len(vals) > 13 and str(vals[13]).lower() != "nan" else "100"
+    c.setFont(fn, 16); c.drawString(60, height - 115, f"ชื่อ-นามสกุล: {name}"); c.drawString(300, height - 115, f"ยี่ห้อรถ: {brand}")
+    c.drawString(60, height - 135, f"รหัสนักเรียน: {std_id}"); c.drawString(300, height - 135, f"สีรถ: {color}")
+    c.drawString(60, height - 155, f"ระดับชั้น: {classroom}"); c.setFont(fb, 16); c.drawString(300, height - 155, f"ทะเบียน: {plate}")
+    c.setFont(fb, 18); color_val = (0.7, 0, 0) if int(score) < 80 else (0, 0.5, 0); c.setFillColorRGB(*color_val)
+    c.drawString(60, height - 185, f"คะแนนความประพฤติจราจรคงเหลือ: {score} คะแนน"); c.setFillColorRGB(0, 0, 0)
+    c.setFont(fn, 16); lm = "(/)" if "มี" in lic_s else "( )"; tm = "(/)" if "ปกติ" in tax_s or "✅" in tax_s else "( )"; hm = "(/)" if "มี" in hel_s else "( )"
+    c.drawString(60, height - 210, f"สถานะเอกสาร:  {lm} ใบขับขี่    {tm} ภาษี/พรบ.    {hm} หมวกกันน็อค")
+    def draw_img(img, label, x, y, w, h):
+        if not img: return
+        data, err = img
+        try:
+            if err: raise Exception(err)
+            c.drawImage(ImageReader(io.BytesIO(data)), x, y, width=w, height=h, preserveAspectRatio=True, mask='auto'); c.rect(x, y, w, h)
+        except Exception as e: errors.append(f"{label}: {e}")
+    draw_img(images[0], "รูปหลัง", 70, height - 415, 180, 180); draw_img(images[1], "รูปข้าง", 300, height - 415, 180, 180)
+    note_y = height - 455; c.setFont(fb, 16); c.drawString(60, note_y, "ประวัติบันทึกการทำผิดวินัยจราจร:")
+    c.setFont(fn, 15); text_obj = c.beginText(70, note_y - 25); text_obj.setLeading(20)
+    for line in note_text.split('\n'):
+        for w_line in textwrap.wrap(line, width=75): text_obj.textLine(w_line)
+    c.drawText(text_obj)
+    sign_y = 180 
+    c.setFont(fn, 16); c.drawString(60, sign_y, "ลงชื่อ ......................................... เจ้าของรถ"); c.drawString(100, sign_y - 20, f"({name})")
+    draw_img(images[2], "รูปเจ้าของ", 450, height - 200, 90, 110)
+    c.drawString(320, sign_y, "ลงชื่อ ......................................... ครูผู้ตรวจสอบ"); c.drawString(340, sign_y - 20, "(.........................................)")
+    c.setFont(fn, 10); c.setFillColorRGB(0.5, 0.5, 0.5)
+    print_time = (datetime.now() + timedelta(hours=7)).strftime('%d/%m/%Y %H:%M')
+    c.drawRightString(width - 30, 20, f"พิมพ์โดย: {printed_by} | เมื่อ: {print_time}")
+    # คืนเหตุผลของรูปที่ใส่ไม่ได้ให้ผู้เรียกแสดงผล (PDF ยังสร้างได้ตามปกติ)
+    c.save(); return buffer.getvalue(), errors
+
+# ==========================================
+# DOCUMENT TEMPLATES (WeasyPrint): CSS parse ครั้งเดียว + FontConfiguration ใช้ซ้ำ + ส่วนหัวสำเร็จรูป
+# ==========================================
+GARUDA_URL = "https://upload.wikimedia.org/wikipedia/commons/thumb/c/c5/Garuda_Emblem_of_Thailand.svg/1200px-Garuda_Emblem_of_Thailand.svg.png"
+FONT_FACE_CSS = f"@font-face {{ font-family: 'THSarabunNew'; src: url('file://{FONT_FILE}'); }}"
+
+_local = threading.local()  # FontConfiguration / CSS / URLFetcher ต่อเธรด (WeasyPrint ไม่รับประกันการใช้ร่วมข้ามเธรด)
+_fetch_cache, _fetch_lock = {}, threading.Lock()
+
+class CachedURLFetcher(URLFetcher):
+    # รูป/ไฟล์จากเว็บ (เช่น ตราครุฑ) ดาวน์โหลดครั้งเดียวต่อโปรเซส ไฟล์ในเครื่อง / data: ใช้ตัวปกติของ WeasyPrint
+    def fetch(self, url, headers=None):
+        if not url.startswith("http"): return super().fetch(url, headers)
+        with _fetch_lock:
+            hit = _fetch_cache.get(url)
+        if hit is None:
+            res = super().fetch(url, headers)
+            try: hit = (res.url, res.read(), list(res.headers.items()), res.status)
+            finally: res.close()
+            with _fetch_lock: hit = _fetch_cache.setdefault(url, hit)
+        res_url, body, res_headers, status = hit
+        return URLFetcherResponse(res_url, body, dict(res_headers), status)
+
+def url_fetcher():
+    if not hasattr(_local, "fetcher"): _local.fetcher = CachedURLFetcher()
+    return _local.fetcher
+
+def esc(val):
+    return html.escape(str(val))
+
+@lru_cache(maxsize=256)
+def qr_data_uri(value):
+    qr = qrcode.make(value); qi = io.BytesIO(); qr.save(qi, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(qi.getvalue()).decode()
+
+def logo_img(src, cls="logo"):
+    return f'<img class="{cls}" src="{esc(src)}">' if src else ""
+
+def qr_img(value, cls="qr"):
+    return f'<img class="{cls}" src="{qr_data_uri(str(value))}">' if value else ""
+
+def header_block(title, subtitle="", logo_src=None, qr_value=None):
+    # หัวเอกสาร: โลโก้ซ้าย / ชื่อหน่วยงาน + ชื่อเอกสารกลาง / QR ขวา
+    return (f'<div class="header">{logo_img(logo_src)}<div class="title">{esc(title)}</div>'
+            f'<div class="subtitle">{esc(subtitle)}</div>{qr_img(qr_value)}</div>')
+
+def footer_css(text):
+    # ส่วนท้ายหน้าเปลี่ยนตามผู้พิมพ์ เป็น CSS ชิ้นเล็กที่ parse ต่อเอกสาร
+    text = str(text).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+    return f'@page {{ @bottom-right {{ content: "{text} | หน้า " counter(page); font-family: \'THSarabunNew\'; font-size: 12pt; }} }}'
+
+class DocumentTemplate:
+    def __init__(self, name, css):
+        self.name, self.css = name, FONT_FACE_CSS + css
+
+    def stylesheets(self):
+        if not hasattr(_local, "font_config"): _local.font_config, _local.css = FontConfiguration(), {}
+        if self.name not in _local.css: _local.css[self.name] = CSS(string=self.css, font_config=_local.font_config)
+        return _local.font_config, [_local.css[self.name]]
+
+    def render(self, body, page_css=""):
+        fc, sheets = self.stylesheets()
+        if page_css: sheets = sheets + [CSS(string=page_css, font_config=fc)]
+        doc = HTML(string=f"<html><head><meta charset='utf-8'></head><body>{body}</body></html>", base_url=BASE_DIR,
+                   url_fetcher=url_fetcher())
+        return doc.write_pdf(stylesheets=sheets, font_config=fc)
+
+CASE_TEMPLATE = DocumentTemplate("case", """
+@page { size: A4; margin: 2cm; }
+body { font-family: 'THSarabunNew'; font-size: 16pt; line-height: 1.3; }
+.header { text-align: center; position: relative; min-height: 80px; } .logo { position: absolute; top: 0; left: 0; width: 60px; }
+.header .title { font-size: 22pt; font-weight: bold; } .header .subtitle { font-size: 18pt; }
+.qr { position: absolute; top: 0; right: 0; width: 60px; } .box { border: 1px solid #000; background-color: #f9f9f9; padding: 10px; min-height: 50px; white-space: pre-wrap; }
+.sig-table { width: 100%; margin-top: 30px; text-align: center; border-collapse: collapse; } .sig-table td { padding-bottom: 25px; vertical-align: top; }
+.images { text-align: center; margin-top: 10px; } .images img { object-fit: contain; border: 1px solid #ccc; }
+.images .missing { color: #999; font-size: 12pt; }
+""")
+
+SUMMON_TEMPLATE = DocumentTemplate("summon", """
+@page { size: A4; margin: 2.5cm; }
+body { font-family: 'THSarabunNew'; font-size: 16pt; line-height: 1.5; }
+.header { text-align: center; font-weight: bold; font-size: 20pt; margin-bottom: 20px; }
+.garuda { text-align: center; margin-bottom: 10px; }
+.garuda img { width: 60px; }
+.signature-section { margin-top: 50px; float: right; width: 300px; text-align: center; }
+""")
+
+def _img_tag(uri, box, margin=False):
+    if not uri: return "<div class='missing'>(โหลดรูปไม่สำเร็จ)</div>"
+    return f"<img src='{uri}' style='max-width:{box[0]}px; max-height:{box[1]}px;{' margin: 5px;' if margin else ''}'>"
+
+def case_body(ctx):
+    # ctx มาจาก case_pdf_context() ใน app.py (วันที่ไทย / รูปฝังเป็น data URI เตรียมไว้แล้ว) คืน (body, CSS ส่วนท้าย)
+    row = {k: esc(v) for k, v in ctx["row"].items()}
+    g = lambda k, d="": row.get(k, d)
+    img_html = ""
+    if ctx["evidence"]:
+        many = len(ctx["evidence"]) > 1
+        img_html += "<div class='images'><b>พยานหลักฐาน</b><br>" + "".join(_img_tag(u, ctx["ev_box"], many) for u in ctx["evidence"]) + "</div>"
+    if ctx["has_image_data"]:
+        img_html += f"<div class='images'><b>ภาพประกอบเหตุการณ์</b><br>{_img_tag(ctx['image_data'], (380, 220))}</div>"
+    logo_src = f"data:image/png;base64,{ctx['logo_b64']}" if ctx["logo_b64"] else None
+    sig = "ลงชื่อ.........................................................."
+    body = f"""{header_block("สถานีตำรวจภูธรโรงเรียนโพนทองพัฒนาวิทยา", "ใบสรุปรายงานเหตุการณ์และผลการดำเนินการสอบสวน", logo_src, ctx["rid"])}<hr>
+    <table style="width:100%;"><tr><td width="60%"><b>เลขที่รับแจ้ง:</b> {esc(ctx["rid"])}</td><td width="40%" style="text-align:right;"><b>วันที่แจ้ง:</b> {esc(ctx["date_str"])}<br><b>วันที่บันทึกผล:</b> {esc(ctx["latest_date"])}</td></tr></table>
+    <p><b>ผู้แจ้ง:</b> {g('Reporter','-')} | <b>ประเภทเหตุ:</b> {g('Incident_Type','-')} | <b>สถานที่:</b> {g('Location','-')}</p>
+    <div style="margin-top:10px;"><b>รายละเอียดเหตุการณ์:</b></div><div class="box">{g('Details','-')}</div>
+    <div><b>ผลการดำเนินการสอบสวน:</b></div><div class="box">{g('Statement','-')}</div>{img_html}
+    <table class="sig-table"><tr><td width="50%">{sig}<br>( {g('Victim')} )<br>ผู้เสียหาย</td><td width="50%">{sig}<br>( {g('Accused')} )<br>ผู้ถูกกล่าวหา</td></tr>
+    <tr><td>{sig}<br>( {g('Student_Police_Investigator')} )<br>ตำรวจนักเรียนผู้สอบสวน</td><td>{sig}<br>( {g('Witness')} )<br>พยาน</td></tr>
+    <tr><td colspan="2"><br>{sig}<br>( {g('Teacher_Investigator')} )<br>ครูผู้สอบสวน</td></tr></table>"""
+    return body, footer_css(f"ผู้พิมพ์: {ctx['p_name']} | เวลา: {ctx['p_time']}")
+
+def render_case_pdf(ctx):
+    return CASE_TEMPLATE.render(*case_body(ctx))
+
+def summon_body(ctx):
+    row = ctx["row"]
+    g = lambda k, d: esc(row.get(k, d))
+    dots = '..........................................'
+    return f"""
+    <div class="garuda">{logo_img(GARUDA_URL, "emblem")}</div>
+    <div class="header">หนังสือเรียกสอบถาม (ส่วนงานตำรวจนักเรียน)</div>
+    <div style="text-align: right;">สถานีตำรวจภูธรโรงเรียนโพนทองพัฒนาวิทยา</div>
+    <div style="text-align: right;">วันที่ {esc(ctx["today"])}</div>
+
+    <p><b>เรื่อง:</b> ขอเชิญพบเพื่อสอบถามเหตุการณ์</p>
+    <p><b>เรียน:</b> {g('Accused', '')} (ผู้เกี่ยวข้อง)</p>
+
+    <div style="text-align: justify;">
+        <p>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;ด้วยทางงานป้องกันและปราบปราม(สถานีตำรวจนักเรียน) ได้รับแจ้งเหตุ <b>{g('Incident_Type', '-')}</b> ซึ่งเกิดขึ้นเมื่อวันที่ <b>{esc(ctx["incident_date"])}</b> ตามเลขแจ้งเหตุที่ <b>{g('Report_ID', '')}</b></p>
+
+        <p>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;อาศัยอำนาจหน้าที่ตามระเบียบโรงเรียน จึงขอให้ท่านมาพบคุณครู
+        <span style="color: blue; text-decoration: underline;"><b>ในวันที่ {esc(ctx["appointment"])}</b></span>
+        ณ ห้องปกครอง  เพื่อดำเนินการสอบถามข้อเท็จจริงในกรณี: <i>{esc(str(row.get('Details', '-'))[:100])}...</i> ให้เกิดความเป็นธรรมแก่ทุกฝ่าย</p>
+    </div>
+
+    <p style="margin-top: 20px;">จึงเรียนเชิญมาพบตำรวจนักเรียนตามกำหนดเวลา</p>
+
+    <div class="signature-section">
+        <p>ลงชื่อ..........................................................<br>({g('Teacher_Investigator', dots)})<br>ครูผู้สอบสวน/ครูผู้ออกหมายนัด</p>
+        <br><br>
+        <p>ลงชื่อ..........................................................<br>({g('Student_Police_Investigator', dots)})<br>ตำรวจนักเรียนเจ้าของคดี</p>
+    </div>"""
+
+def render_summon_pdf(ctx):
+    return SUMMON_TEMPLATE.render(summon_body(ctx))